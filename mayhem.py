@@ -22,6 +22,7 @@ anthony.prieur@gmail.com
 Usage example:
 
 python mayhem.py --width=1500 --height=900 --nb_player=2 --sensor=ray -rm=game
+python mayhem.py --width=1500 --height=900 --nb_player=4 --render_scale=0.5
 python mayhem.py --width=1500 --height=900 --nb_player=1 --sensor=ray -rm=training
 
 python3 mayhem.py --sensor=ray --motion=gravity
@@ -29,12 +30,27 @@ python3 mayhem.py --sensor=ray --motion=thrust
 python3 mayhem.py --motion=thrust
 python3 mayhem.py -r=played1.dat --motion=gravity
 python3 mayhem.py -pr=played1.dat --motion=gravity
+python3 mayhem.py -pr=played1.dat --time_scale=8 --display_fps=30
+python3 mayhem.py -rm=training --sensor=ray --render_every=10
+
+python3 mayhem.py -rm=server --nb_player=2 --port=6510 --input_delay=3
+python3 mayhem.py --connect=127.0.0.1:6510
+python3 mayhem.py --connect=127.0.0.1:6510 --rollback=8 (server with --input_delay=1)
+python3 mayhem.py -rm=benchmark --nb_player=4
+python3 mayhem.py --nb_player=2 --bot=2=gen_1068
+
+python3 mayhem.py --nb_player=4 --broadcast=127.0.0.1:6511
+python3 mayhem.py -rm=spectator --connect=127.0.0.1:6511
+
+Gym / Gymnasium: see MayhemGymEnv (registered as "Mayhem-v0" when gymnasium is installed)
 """
 
-import os, sys, argparse, random, math, time, multiprocessing
+import os, sys, argparse, random, math, time, multiprocessing, array, struct, threading, asyncio, queue, json
 from random import randint
+from operator import attrgetter
 import numpy as np
 import datetime as dt
+from collections import deque
 
 import pygame
 from pygame.locals import *
@@ -51,6 +67,22 @@ try:
 except ImportError:
     NEAT_FOUND = False
 
+try:
+    import gymnasium as gym
+    GYM_FOUND = True
+except ImportError:
+    try:
+        import gym
+        GYM_FOUND = True
+    except ImportError:
+        GYM_FOUND = False
+
+try:
+    from scipy.spatial import cKDTree
+    SCIPY_FOUND = True
+except ImportError:
+    SCIPY_FOUND = False
+
 # -------------------------------------------------------------------------------------------------
 # General
 
@@ -59,8 +91,21 @@ global game_window
 DEBUG_SCREEN = 1 # print debug info on the screen
 DEBUG_TEXT_XPOS = 0
 
+HUD_FONT_SIZE   = 10
+HUD_LINE_HEIGHT = 16
+HUD_FPS_REFRESH = 30 # frames between 2 FPS text refresh
+
 MAX_FPS = 60
 
+TIME_SCALE   = 1.0 # simulation speed: 1 = real time, N = N x real time, 0 = uncapped
+RENDER_EVERY = 1   # render (blits + flip) only 1 simulated frame out of RENDER_EVERY
+DISPLAY_FPS  = 0   # cap on the number of display flips per second, 0 = no cap
+RENDER_SCALE = 1.0 # < 1 renders the game in a lower resolution surface upscaled to the window
+
+CAMERA_ZOOM   = 1.0   # < 1 shows more of the level in the player views (scaled down), at least the whole level width or height
+CAMERA_FOLLOW = 1.0   # part of the distance to the ship closed per rendered frame: 1 = locked on the ship, < 1 = smooth scrolling
+MINIMAP_SCALE = 0.125 # whole level overview (-mm option), ie 99 x 150 pixels
+
 MAP_WIDTH  = 792
 MAP_HEIGHT = 1200
 
@@ -84,6 +129,7 @@ SHIP4_X = 451        # ie left
 SHIP4_Y = 501        # ie top
 
 USE_MINI_MASK = True # mask the size of the ship (instead of the player view size)
+USE_SWEPT_COLLISION = True # terrain collisions tested along the move since the previous frame (no tunnelling through thin walls)
 
 # -------------------------------------------------------------------------------------------------
 # Sensor
@@ -91,6 +137,14 @@ USE_MINI_MASK = True # mask the size of the ship (instead of the player view siz
 RAY_AMGLE_STEP = 45
 RAY_BOX_SIZE   = 400
 RAY_MAX_LEN    = ((RAY_BOX_SIZE/2) * math.sqrt(2)) # for now we are at the center of the ray mask box
+RAY_ANGLES     = range(0, 359, RAY_AMGLE_STEP)
+RAY_NB         = len(RAY_ANGLES) # 8 values for angle=45 degres, 12 for 30 degres etc
+
+# ray directions
+RAY_COS = [math.cos(math.radians(angle)) for angle in RAY_ANGLES]
+RAY_SIN = [math.sin(math.radians(angle)) for angle in RAY_ANGLES]
+
+RAY_MASKS = [] # one line mask per ray, see build_ray_masks()
 
 # -------------------------------------------------------------------------------------------------
 # SHIP dynamics
@@ -104,6 +158,17 @@ SHIP_ANGLE_LAND = 30
 SHIP_MAX_LIVES = 100
 SHIP_SPRITE_SIZE = 32
 
+# trigonometry tables: ship angles are always multiples of SHIP_ANGLESTEP, index = int(angle) // SHIP_ANGLESTEP
+SHIP_ANGLES = range(0, 360, SHIP_ANGLESTEP)
+
+SHIP_COS = [math.cos(math.radians(90 - angle)) for angle in SHIP_ANGLES] # thrust direction
+SHIP_SIN = [math.sin(math.radians(90 - angle)) for angle in SHIP_ANGLES]
+
+SHOT_SPAWN_X = [18 * -c for c in SHIP_COS] # from the ship center
+SHOT_SPAWN_Y = [18 * -s for s in SHIP_SIN]
+SHOT_DX = [5.1 * -c for c in SHIP_COS]
+SHOT_DY = [5.1 * -s for s in SHIP_SIN]
+
 iG       = 0.07 / SLOW_DOWN_COEF
 iXfrott  = 0.984
 iYfrott  = 0.99
@@ -114,6 +179,8 @@ iCoeffvy = 0.6
 iCoeffimpact = 0.02
 MAX_SHOOT = 20
 
+CRATER_RADIUS = 3 # terrain removed by a shot impact, -d option (see GameWindow.carve)
+
 # -------------------------------------------------------------------------------------------------
 # Levels / controls
 
@@ -151,6 +218,8 @@ SHIP_4_JOY  = 0 # 0 means no joystick, =!0 means joystck number SHIP_1_JOY - 1
 
 MAP_1 = os.path.join("assets", "level1", "Mayhem_Level1_Map_256c.bmp")
 
+HUD_FONT = os.path.join("assets", "default", "PressStart2P.ttf")
+
 SOUND_THURST  = os.path.join("assets", "default", "sfx_loop_thrust.wav")
 SOUND_EXPLOD  = os.path.join("assets", "default", "sfx_boom.wav")
 SOUND_BOUNCE  = os.path.join("assets", "default", "sfx_rebound.wav")
@@ -173,12 +242,208 @@ SHIP_4_PIC        = os.path.join("assets", "default", "ship4_256c.bmp")
 SHIP_4_PIC_THRUST = os.path.join("assets", "default", "ship4_thrust_256c.bmp")
 SHIP_4_PIC_SHIELD = os.path.join("assets", "default", "ship4_shield_256c.bmp")
 
+# -------------------------------------------------------------------------------------------------
+# Simulation state
+
+# one record per ship, the Ship attributes saved / restored by Ship.get_state / set_state (see MayhemEnv.get_state)
+SHIP_STATE = np.dtype([ ("xpos", np.int32), ("ypos", np.int32),               # screen (map) coordinates
+                        ("xposprecise", np.float64), ("yposprecise", np.float64),
+                        ("vx", np.float64), ("vy", np.float64),
+                        ("ax", np.float64), ("ay", np.float64),
+                        ("impactx", np.float64), ("impacty", np.float64),     # shot received when shield is on
+                        ("angle", np.float64), ("thrust", np.float64),
+                        ("shield", np.bool_), ("shoot", np.bool_), ("shoot_delay", np.bool_),
+                        ("landed", np.bool_), ("bounce", np.bool_), ("explod", np.bool_),
+                        ("lives", np.int32) ])
+
+SHIP_STATE_FIELDS = attrgetter(*SHIP_STATE.names) # ship => tuple of its state values
+
+MAX_SHIPS = 4
+
+SHOT_STATE = np.dtype([ ("x", np.float64), ("y", np.float64),
+                        ("xposprecise", np.float64), ("yposprecise", np.float64),
+                        ("dx", np.float64), ("dy", np.float64) ])
+
+RNG_STATE_SIZE = 625 # random.Random().getstate()[1]: 624 words + position
+
+# fixed layout snapshot of a whole env (see MayhemEnv.get_state / set_state)
+SIM_STATE = np.dtype([ ("ships", SHIP_STATE, (MAX_SHIPS,)),
+                       ("shots", SHOT_STATE, (MAX_SHIPS, MAX_SHOOT)),
+                       ("nb_shots", np.uint8, (MAX_SHIPS,)),
+                       ("frames", np.int64),
+                       ("total_dist", np.float64),
+                       ("collision", np.bool_),
+                       ("rng", np.uint32, (RNG_STATE_SIZE,)),
+                       ("rng_gauss", np.float64),
+                       ("rng_has_gauss", np.bool_) ])
+
+# -------------------------------------------------------------------------------------------------
+# Network
+
+NET_HOST = "127.0.0.1"
+NET_PORT = 6510
+NET_INPUT_DELAY = 3 # frames, local inputs are played N frames later (hides the latency up to N/60 s)
+NET_TIMEOUT = 10    # s, to connect
+
+ROLLBACK_FRAMES  = 8     # max frames simulated with predicted inputs, re-simulated when the real ones arrive
+BENCHMARK_FRAMES = 6000  # -rm=benchmark
+
+# one byte per ship and per frame, bits in the recorded plays order: (left, right, thrust, shield, shoot)
+INPUT_BITS = (1, 2, 4, 8, 16)
+
+# packets
+NET_HELLO = struct.Struct("<BBB") # server => client: player id, nb players, input delay
+NET_INPUT = struct.Struct("<IB")  # client => server: frame, input bits
+NET_FRAME = struct.Struct("<I")   # server => clients: frame, followed by the input bits of every player
+
+# broadcast to spectators (see BroadcastServer / SpectatorClient)
+BROADCAST_PORT        = 6511
+BROADCAST_KEYFRAME    = 120   # frames between 2 full states, ie the max wait of a spectator which has missed some deltas
+BROADCAST_MAX_BUFFER  = 65536 # bytes not sent yet to a spectator above which it gets no more deltas (until a keyframe)
+BROADCAST_MAX_PENDING = 240   # frames received by a spectator and not drawn yet, the oldest are dropped
+
+# server => spectators: length prefixed messages, a BC_FRAME header followed by the ships, shot births and shot deaths
+BC_LENGTH = struct.Struct("<I")      # message size
+BC_FRAME  = struct.Struct("<IBBBB")  # frame, keyframe, nb ships, nb shot births, nb shot deaths
+BC_SHIP   = struct.Struct("<BhhBBh") # ship, xpos, ypos, angle / SHIP_ANGLESTEP, flags, lives
+BC_BIRTH  = struct.Struct("<HBdddd") # shot id, ship, xposprecise, yposprecise, dx, dy
+BC_DEATH  = struct.Struct("<H")      # shot id
+
+BC_SHIP_THRUST = 1
+BC_SHIP_SHIELD = 2
+BC_SHIP_LANDED = 4
+
 # -------------------------------------------------------------------------------------------------
 # Training
 
 START_POSITIONS = [(430, 730), (473, 195), (647, 227), (645, 600), (647, 950), (510, 1070), (298, 1037), \
                    (273, 777), (275, 506), (70, 513), (89, 208), (434, 452), (289, 153)]
 
+# training start states (see StartStateSampler), empty = always start at (430, 730)
+START_SOURCES = () # "positions" (START_POSITIONS), "recorded" (snapshots of recorded plays), "crashes" (where the agents crashed)
+
+START_RECORD_EVERY = 50   # frames between 2 snapshots of a recorded play
+START_CRASH_BACK   = 30   # crash states are taken at least N frames before the crash
+START_MAX_CRASHES  = 200  # oldest crash states are dropped
+START_CRASH_WEIGHT = 2.0  # difficulty of the crash states (positions and recorded plays = 1)
+START_MIN_WEIGHT   = 0.1  # so that the states the agents always succeed from are still sampled
+
+# self-play training (see SelfPlayEnv), the genomes play against each other
+SELFPLAY_SHIPS          = 2      # genomes per match, 2 to 4
+SELFPLAY_MATCHES        = 2      # matches per genome and per generation, against other opponents each time
+SELFPLAY_MAX_FRAMES     = 2000
+SELFPLAY_KILL_REWARD    = 500.   # shot down an opponent
+SELFPLAY_DEATH_REWARD   = -1000. # as a crash in the single agent training
+SELFPLAY_SURVIVE_REWARD = 500.   # still flying at the end of the match
+
+# novelty search (see NoveltyArchive), NEAT_NOVELTY in run()
+NOVELTY_DESCRIPTOR    = "final_pos" # "final_pos": where the episode ended, "path": NOVELTY_PATH_POINTS positions along the episode
+NOVELTY_PATH_POINTS   = 8
+NOVELTY_PATH_EVERY    = 100    # frames between 2 path points
+NOVELTY_K             = 15     # nearest neighbours
+NOVELTY_THRESHOLD     = 0.05   # descriptors (map size = 1) at least that novel are archived
+NOVELTY_MAX_ARCHIVE   = 50000  # oldest entries are dropped (when reindexing)
+NOVELTY_CHUNK         = 4096   # archive rows per distance block, brute force (not indexed rows)
+NOVELTY_REINDEX       = 0.25   # the index is rebuilt when the not indexed rows reach that part of the indexed ones (and NOVELTY_CHUNK)
+NOVELTY_GRID_CELL     = 0.025  # "final_pos" index without scipy: uniform grid over the level (map size = 1)
+NOVELTY_WEIGHT        = 1000.  # fitness = NOVELTY_WEIGHT * novelty + NOVELTY_REWARD_WEIGHT * episode reward
+NOVELTY_REWARD_WEIGHT = 1.     # 0 = pure novelty search
+
+# trajectory logs (see TrajectoryLogger), NEAT_TRAJ_LOG in run()
+TRAJ_LOG_EVERY   = 10    # 1 episode out of N is logged
+TRAJ_CHUNK_ROWS  = 8192  # steps per chunk (written at once)
+TRAJ_MAX_PENDING = 16    # chunks not written yet, the training waits beyond
+
+TRAJ_EXPLOD    = 1 # "flags" column bits
+TRAJ_LANDED    = 2
+TRAJ_COLLISION = 4
+
+# heatmaps of the trajectory logs / recorded plays over the level (see Heatmaps), -rm=analytics
+HEATMAP_CELL      = 4       # pixels, ie a 198 x 300 grid over the level
+HEATMAP_CHUNK     = 1 << 22 # log rows read at once
+HEATMAP_TOP       = 10      # most deadly cells printed
+HEATMAP_MAP_DIM   = 0.35    # level brightness under the overlays
+HEATMAP_MIN_ALPHA = 0.3     # overlay opacity of the least hit non empty cell (log scale up to 1)
+
+HEATMAP_COLORS = { "visits": (0, 160, 255), "landings": (0, 255, 0), "deaths": (255, 0, 0) } # drawn in this order
+
+# exploration (see CoverageGrid)
+COVERAGE_CELL    = 16   # pixels, ie a 50 x 75 grid over the level
+COVERAGE_REWARD  = 0.   # training reward per new cell visited, 0 = distance rewards only
+COVERAGE_WINDOW  = 100  # frames, "new_cells" observation feature: new cells visited in the last COVERAGE_WINDOW frames
+
+# observation: (ship attribute, min, max), min / max are used by the "minmax" normalization only
+# its size (x OBS_FRAME_STACK) must be num_inputs in the NEAT config
+OBS_FEATURES = [ #("thrust", 0., SHIP_THRUST_MAX),
+                 ("angle", 0., 360. - SHIP_ANGLESTEP),
+                 ("vx", -5.5, 5.5),   # more or less with default phisical values, for "standard playing"
+                 ("vy", -6.5, 8.5),   # more or less with default phisical values, for "standard playing"
+                 ("ax", -0.16, 0.16), # more or less with default phisical values, for "standard playing"
+                 ("ay", -0.12, 0.20), # more or less with default phisical values, for "standard playing"
+                 ("wall_distances", 0., RAY_MAX_LEN),
+                 ("new_cells", 0., 20.), # exploration, more or less with "standard playing" speeds (see CoverageGrid)
+               ]
+
+OBS_WIDTHS = {"wall_distances": RAY_NB} # features which are arrays
+
+OBS_FRAME_STACK = 1 # > 1 to feed the last N observations
+
+# "minmax": in [-1, 1] using the OBS_FEATURES ranges
+# "running": (x - mean) / std using running statistics (RunningNormalizer) saved along the genomes
+# "": raw inputs
+OBS_NORMALIZE = "minmax"
+OBS_CLIP      = 5.0     # "running" only: normalized values are clipped in [-OBS_CLIP, OBS_CLIP]
+OBS_NORM_EXT  = ".norm" # "running" only: statistics file = genome file + OBS_NORM_EXT
+
+# pixel observation (obs_mode="pixels"): square array centered on the ship
+PIXEL_OBS_SIZE  = 84     # output size
+PIXEL_OBS_SCALE = 2      # downsampling, ie PIXEL_OBS_SIZE * PIXEL_OBS_SCALE map pixels around the ship
+PIXEL_OBS_STACK = 4      # last N frames
+PIXEL_OBS_MODE  = "grey" # "grey": terrain, observed ships and their shots, "palette": level palette indexes (terrain only)
+
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+
+class SimClock():
+
+    def __init__(self, time_scale=TIME_SCALE, render_every=RENDER_EVERY, display_fps=DISPLAY_FPS):
+        self.clock = pygame.time.Clock()
+
+        self.time_scale = time_scale
+        self.render_every = max(1, render_every)
+        self.display_fps = display_fps
+
+        self.last_render = 0
+        self.render_frame = True
+
+    # called once at the start of each simulated frame, tells if this frame has to be displayed
+    def begin_frame(self, frame):
+        self.render_frame = (frame % self.render_every) == 0
+
+        if self.render_frame and self.display_fps:
+            now = pygame.time.get_ticks()
+            if (now - self.last_render) < (1000. / self.display_fps):
+                self.render_frame = False
+            else:
+                self.last_render = now
+
+        return self.render_frame
+
+    def tick(self, paused=False):
+        # no need to spin when nothing is simulated
+        if paused:
+            self.clock.tick(MAX_FPS)
+        elif self.time_scale:
+            self.clock.tick(MAX_FPS * self.time_scale) # https://python-forum.io/thread-16692.html
+        else:
+            self.clock.tick()
+
+    # simulated frames per second
+    def get_fps(self):
+        fps = self.clock.get_fps()
+        return fps if math.isfinite(fps) else 0. # uncapped, < 1 ms frames
+
 # -------------------------------------------------------------------------------------------------
 # -------------------------------------------------------------------------------------------------
 # -------------------------------------------------------------------------------------------------
@@ -196,9 +461,225 @@ class Shot():
 # -------------------------------------------------------------------------------------------------
 # -------------------------------------------------------------------------------------------------
 
+# loaded once, shared by all the ships of all the envs (read only)
+SHIP_PICS = {}
+
+def load_ship_pic(path):
+    try:
+        return SHIP_PICS[path]
+    except KeyError:
+        # ship pic: 32x32, black (0,0,0) background, no alpha
+        pic = pygame.image.load(path).convert()
+        pic.set_colorkey( (0, 0, 0) ) # used for the mask, black = background, not the ship
+        SHIP_PICS[path] = pic
+        return pic
+
+# the ray masks only depend on the ray angle: built once, in the quadrant given by abs(cos), abs(sin)
+# (the map masks are flipped instead, see ray_sensor)
+def build_ray_masks():
+
+    if RAY_MASKS:
+        return RAY_MASKS
+
+    ray_surface = pygame.Surface((RAY_BOX_SIZE, RAY_BOX_SIZE))
+    ray_surface_center = (int(RAY_BOX_SIZE/2), int(RAY_BOX_SIZE/2))
+
+    for c, s in zip(RAY_COS, RAY_SIN):
+
+        # ray final point
+        x_dest = ray_surface_center[0] + RAY_BOX_SIZE/2 * abs(c)
+        y_dest = ray_surface_center[1] + RAY_BOX_SIZE/2 * abs(s)
+
+        ray_surface.fill((0, 0, 0))
+        ray_surface.set_colorkey((0, 0, 0))
+        pygame.draw.line(ray_surface, WHITE, ray_surface_center, (x_dest, y_dest))
+        RAY_MASKS.append(pygame.mask.from_surface(ray_surface))
+
+    return RAY_MASKS
+
+# rotated ships: (image, angle) => rotated image, mask, mask of the part in the 32x32 ship box, x / y offsets
+SHIP_SPRITES = {}
+
+def rotated_sprite(image, angle):
+    try:
+        return SHIP_SPRITES[(image, angle)]
+    except KeyError:
+        image_rotated = pygame.transform.rotate(image, angle)
+        mask = pygame.mask.from_surface(image_rotated)
+
+        rect = image_rotated.get_rect()
+        rot_xoffset = int( ((SHIP_SPRITE_SIZE - rect.width)/2) )  # used in draw() and collide_map()
+        rot_yoffset = int( ((SHIP_SPRITE_SIZE - rect.height)/2) ) # used in draw() and collide_map()
+
+        box = pygame.mask.Mask((SHIP_SPRITE_SIZE, SHIP_SPRITE_SIZE), fill=True)
+        mini_mask = mask.overlap_mask(box, (-rot_xoffset, -rot_yoffset))
+
+        SHIP_SPRITES[(image, angle)] = (image_rotated, mask, mini_mask, rot_xoffset, rot_yoffset)
+        return SHIP_SPRITES[(image, angle)]
+
+# policy outputs (steering, thrust, optional shoot, optional shield) => (left, right, up, down, thrust, shoot, shield) pressed
+# shoot / shield are used when the NEAT config has 3 / 4 num_outputs
+def action_to_pressed(action):
+    left_pressed   = bool(action[0] < -0.33)
+    right_pressed  = bool(action[0] > 0.33) and not left_pressed
+    thrust_pressed = bool(action[1] <= 0)
+    shoot_pressed  = len(action) > 2 and bool(action[2] > 0)
+    shield_pressed = len(action) > 3 and bool(action[3] > 0)
+
+    return left_pressed, right_pressed, False, False, thrust_pressed, shoot_pressed, shield_pressed
+
+# pixels of the segment (x0, y0) => (x1, y1), (x0, y0) excluded (Bresenham), for the swept collisions
+def line_points(x0, y0, x1, y1):
+    dx = abs(x1 - x0)
+    dy = -abs(y1 - y0)
+    sx = 1 if x0 < x1 else -1
+    sy = 1 if y0 < y1 else -1
+    err = dx + dy
+
+    while x0 != x1 or y0 != y1:
+        e2 = 2 * err
+        if e2 >= dy:
+            err += dy
+            x0 += sx
+        if e2 <= dx:
+            err += dx
+            y0 += sy
+
+        yield x0, y0
+
+# segments (0, 0) => (dx, dy) as masks (line_points), for a single overlap() per swept shot: mask, left, top (relative to (0, 0))
+LINE_MASKS = {}
+
+def line_mask(dx, dy):
+    try:
+        return LINE_MASKS[(dx, dy)]
+    except KeyError:
+        left = min(dx, 0)
+        top = min(dy, 0)
+
+        mask = pygame.mask.Mask((abs(dx) + 1, abs(dy) + 1))
+        for x, y in line_points(0, 0, dx, dy):
+            mask.set_at((x - left, y - top))
+
+        LINE_MASKS[(dx, dy)] = (mask, left, top)
+        return LINE_MASKS[(dx, dy)]
+
+# -------------------------------------------------------------------------------------------------
+
+# level platforms indexed by ship ypos: O(1) landing / collision exemption tests
+class PlatformIndex():
+
+    # ypos - yflat for which the ship is on the platform
+    LANDING_ROWS = (0, 1, 2, 3)
+    SHIELD_ROWS  = (-1, 0, 1, 2, 3) # no collision test with the shield on
+    THRUST_ROWS  = (-1, 0, 1)       # no collision test when taking off
+
+    def __init__(self, platforms=PLATFORMS_1):
+
+        # (xmin, xmax, yflat) in ship (top left) coordinates
+        self.platforms = [ (xmin - (SHIP_SPRITE_SIZE - 23), xmax - (SHIP_SPRITE_SIZE - 9), y - (SHIP_SPRITE_SIZE - 2)) for xmin, xmax, y in platforms ]
+
+        # ypos => [(xmin, xmax, yflat), ...] in the level order
+        self.landing_rows = self.build_rows(self.LANDING_ROWS)
+        self.shield_rows  = self.build_rows(self.SHIELD_ROWS)
+        self.thrust_rows  = self.build_rows(self.THRUST_ROWS)
+
+    def build_rows(self, dys):
+        rows = {}
+
+        for platform in self.platforms:
+            for dy in dys:
+                rows.setdefault(platform[2] + dy, []).append(platform)
+
+        return rows
+
+    # yflat of the platform the ship is on, None if not on a platform
+    def landing(self, xpos, ypos):
+        for xmin, xmax, yflat in self.landing_rows.get(ypos, ()):
+            if xmin <= xpos <= xmax:
+                return yflat
+
+        return None
+
+    # no ship / map collision test when landing with the shield on or taking off
+    def exempt(self, xpos, ypos, shield, thrust, upright):
+        if shield and upright:
+            for xmin, xmax, yflat in self.shield_rows.get(ypos, ()):
+                if xmin <= xpos <= xmax:
+                    return True
+
+        if thrust:
+            for xmin, xmax, yflat in self.thrust_rows.get(ypos, ()):
+                if xmin <= xpos <= xmax:
+                    return True
+
+        return False
+
+# -------------------------------------------------------------------------------------------------
+
+# cells of the level visited during an episode (exploration): one byte per COVERAGE_CELL x COVERAGE_CELL cell,
+# visit() is O(1) and also counts the new cells of the last COVERAGE_WINDOW frames ("new_cells" observation)
+class CoverageGrid():
+
+    def __init__(self, cell=COVERAGE_CELL, window=COVERAGE_WINDOW):
+
+        self.cell = cell
+        self.cols = (MAP_WIDTH + cell - 1) // cell
+        self.rows = (MAP_HEIGHT + cell - 1) // cell
+
+        self.grid = bytearray(self.rows * self.cols)
+        self.count = 0 # visited cells in the episode
+
+        # new cells of the last frames: ring buffer + running sum
+        self.window = window
+        self.recent = bytearray(window)
+        self.recent_index = 0
+        self.new_cells = 0
+
+    def clear(self):
+        self.grid = bytearray(self.rows * self.cols)
+        self.count = 0
+
+        self.recent = bytearray(self.window)
+        self.recent_index = 0
+        self.new_cells = 0
+
+    # map position => 1 if its cell had not been visited, 0 otherwise (once per frame)
+    def visit(self, x, y):
+        col = min(max(int(x) // self.cell, 0), self.cols - 1)
+        row = min(max(int(y) // self.cell, 0), self.rows - 1)
+
+        i = row * self.cols + col
+        new = 1 - self.grid[i]
+
+        if new:
+            self.grid[i] = 1
+            self.count += 1
+
+        self.new_cells += new - self.recent[self.recent_index]
+        self.recent[self.recent_index] = new
+        self.recent_index = (self.recent_index + 1) % self.window
+
+        return new
+
+# -------------------------------------------------------------------------------------------------
+
 class Ship():
 
-    def __init__(self, mode, screen_width, screen_height, ship_number, nb_player, xpos, ypos, ship_pic, ship_pic_thrust, ship_pic_shield, keys_mapping, joystick_number, lives):
+    # no per ship __dict__: smaller ships, faster attribute access in the simulation (SHIP_STATE fields first)
+    __slots__ = SHIP_STATE.names + ("state_index", "platforms", "view_width", "view_height", "view_left", "view_top", "camera",
+                                    "init_xpos", "init_ypos", "prev_xpos", "prev_ypos", "shots", "bot", "keys_mapping", "joystick_number",
+                                    "ship_pic", "ship_pic_thrust", "ship_pic_shield", "image", "image_rotated", "mask", "mini_mask",
+                                    "rot_xoffset", "rot_yoffset", "wall_distances", "new_cells")
+
+    def __init__(self, mode, screen_width, screen_height, ship_number, nb_player, xpos, ypos, ship_pic, ship_pic_thrust, ship_pic_shield, keys_mapping, joystick_number, lives, \
+                 state_index=0, platforms=None):
+
+        # row of the ship in the env SIM_STATE snapshots (and its sounds channels)
+        self.state_index = state_index
+
+        # level platforms
+        self.platforms = platforms if platforms is not None else PlatformIndex()
 
         margin_size = 0
         w_percent = 1.0
@@ -229,6 +710,9 @@ class Ship():
                 self.view_left = margin_size + self.view_width + margin_size
                 self.view_top = margin_size + self.view_height + margin_size
 
+        # where the player view is in the level (see SplitScreenRenderer)
+        self.camera = Camera(self.view_left, self.view_top, self.view_width, self.view_height)
+
         self.init_xpos = xpos
         self.init_ypos = ypos
         
@@ -257,20 +741,10 @@ class Ship():
         self.lives = lives
         self.shots = []
 
-        # sound
-        self.sound_thrust = pygame.mixer.Sound(SOUND_THURST)
-        self.sound_explod = pygame.mixer.Sound(SOUND_EXPLOD)
-        self.sound_bounce = pygame.mixer.Sound(SOUND_BOUNCE)
-        self.sound_shoot  = pygame.mixer.Sound(SOUND_SHOOT)
-        self.sound_shield = pygame.mixer.Sound(SOUND_SHIELD)
-
         # ship pic: 32x32, black (0,0,0) background, no alpha
-        self.ship_pic = pygame.image.load(ship_pic).convert()
-        self.ship_pic.set_colorkey( (0, 0, 0) ) # used for the mask, black = background, not the ship
-        self.ship_pic_thrust = pygame.image.load(ship_pic_thrust).convert()
-        self.ship_pic_thrust.set_colorkey( (0, 0, 0) ) # used for the mask, black = background, not the ship
-        self.ship_pic_shield = pygame.image.load(ship_pic_shield).convert()
-        self.ship_pic_shield.set_colorkey( (0, 0, 0) ) # used for the mask, black = background, not the ship
+        self.ship_pic = load_ship_pic(ship_pic)
+        self.ship_pic_thrust = load_ship_pic(ship_pic_thrust)
+        self.ship_pic_shield = load_ship_pic(ship_pic_shield)
 
         self.image = self.ship_pic
         self.mask = pygame.mask.from_surface(self.image)
@@ -278,11 +752,26 @@ class Ship():
         self.keys_mapping = keys_mapping
         self.joystick_number = joystick_number
 
-        self.ray_surface = pygame.Surface((RAY_BOX_SIZE, RAY_BOX_SIZE))
+        self.bot = None # BotPlayer instead of the keys / joystick
+
+        # position before the last do_move(), for the swept collision
+        self.prev_xpos = self.xpos
+        self.prev_ypos = self.ypos
+
+        self.wall_distances = np.zeros(RAY_NB) # filled by ray_sensor()
+        self.new_cells = 0 # cells visited for the first time in the last COVERAGE_WINDOW frames, see MayhemEnv.step()
+
+    # simulation state: SHIP_STATE fields values, in order
+    def get_state(self):
+        return SHIP_STATE_FIELDS(self)
+
+    def set_state(self, values):
+        for name, value in zip(SHIP_STATE.names, values):
+            setattr(self, name, value)
 
     def reset(self, env):
-        if env.mode == "training" and 0:
-            self.xpos, self.ypos = random.choice(START_POSITIONS)
+        if env.random_start:
+            self.xpos, self.ypos = env.rng.choice(START_POSITIONS)
         else:
             self.xpos = self.init_xpos
             self.ypos = self.init_ypos
@@ -309,31 +798,13 @@ class Ship():
 
         self.lives -= 1
 
-        if env.render:
-            self.sound_thrust.stop()
-            self.sound_shoot.stop()
-            self.sound_shield.stop()
-            self.sound_bounce.stop()
-            self.sound_explod.play()
+        env.audio.stop_all(self.state_index)
+        env.audio.play(self.state_index, "explod")
 
     def step(self, env, action):
 
         if not env.play_recorded:
-            left_pressed   = False
-            right_pressed  = False
-            thrust_pressed = False
-            up_pressed     = False
-            down_pressed   = False
-            shoot_pressed  = False
-            shield_pressed = False
-
-            if action[0] < -0.33:
-                left_pressed = True
-            elif action[0] > 0.33:
-                right_pressed = True
-
-            if action[1] <= 0:
-                thrust_pressed = True
+            left_pressed, right_pressed, up_pressed, down_pressed, thrust_pressed, shoot_pressed, shield_pressed = action_to_pressed(action)
 
             #if action == 1:
             #    left_pressed = True
@@ -356,6 +827,8 @@ class Ship():
                 thrust_pressed = True if data_i[2] else False
                 shield_pressed = True if data_i[3] else False
                 shoot_pressed  = True if data_i[4] else False
+                up_pressed     = False
+                down_pressed   = False
             except:
                 print("End of playback")
                 print("Frames=", env.frames)
@@ -364,50 +837,59 @@ class Ship():
 
         self.do_move(env, left_pressed, right_pressed, up_pressed, down_pressed, thrust_pressed, shoot_pressed, shield_pressed)
 
-    def update(self, env):
+    # keyboard / joystick, or the last action of the bot playing this ship
+    def read_input(self):
+        if self.bot is not None:
+            return self.bot.read_input(self)
 
-        # normal play
-        if not env.play_recorded:
-            keys = pygame.key.get_pressed()
+        keys = pygame.key.get_pressed()
 
-            left_pressed   = keys[self.keys_mapping["left"]]
-            right_pressed  = keys[self.keys_mapping["right"]]
-            up_pressed     = keys[self.keys_mapping["up"]]
-            down_pressed   = keys[self.keys_mapping["down"]]
-            thrust_pressed = keys[self.keys_mapping["thrust"]]
-            shoot_pressed  = keys[self.keys_mapping["shoot"]]
-            shield_pressed = keys[self.keys_mapping["shield"]]
+        left_pressed   = keys[self.keys_mapping["left"]]
+        right_pressed  = keys[self.keys_mapping["right"]]
+        up_pressed     = keys[self.keys_mapping["up"]]
+        down_pressed   = keys[self.keys_mapping["down"]]
+        thrust_pressed = keys[self.keys_mapping["thrust"]]
+        shoot_pressed  = keys[self.keys_mapping["shoot"]]
+        shield_pressed = keys[self.keys_mapping["shield"]]
 
-            if self.joystick_number:
-                try:
-                    if pygame.joystick.Joystick(self.joystick_number-1).get_button(0):
-                        thrust_pressed = True
-                    else:
-                        thrust_pressed = False
+        if self.joystick_number:
+            try:
+                if pygame.joystick.Joystick(self.joystick_number-1).get_button(0):
+                    thrust_pressed = True
+                else:
+                    thrust_pressed = False
 
-                    if pygame.joystick.Joystick(self.joystick_number-1).get_button(5):
-                        shoot_pressed = True
-                    else:
-                        shoot_pressed = False
+                if pygame.joystick.Joystick(self.joystick_number-1).get_button(5):
+                    shoot_pressed = True
+                else:
+                    shoot_pressed = False
 
-                    if pygame.joystick.Joystick(self.joystick_number-1).get_button(1):
-                        shield_pressed = True
-                    else:
-                        shield_pressed = False
+                if pygame.joystick.Joystick(self.joystick_number-1).get_button(1):
+                    shield_pressed = True
+                else:
+                    shield_pressed = False
 
-                    horizontal_axis = pygame.joystick.Joystick(self.joystick_number-1).get_axis(0)
+                horizontal_axis = pygame.joystick.Joystick(self.joystick_number-1).get_axis(0)
 
-                    if int(round(horizontal_axis)) == 1:
-                        right_pressed = True
-                    else:
-                        right_pressed = False
+                if int(round(horizontal_axis)) == 1:
+                    right_pressed = True
+                else:
+                    right_pressed = False
 
-                    if int(round(horizontal_axis)) == -1:
-                        left_pressed = True
-                    else:
-                        left_pressed = False
-                except:
-                    pass
+                if int(round(horizontal_axis)) == -1:
+                    left_pressed = True
+                else:
+                    left_pressed = False
+            except:
+                pass
+
+        return left_pressed, right_pressed, up_pressed, down_pressed, thrust_pressed, shoot_pressed, shield_pressed
+
+    def update(self, env):
+
+        # normal play
+        if not env.play_recorded:
+            left_pressed, right_pressed, up_pressed, down_pressed, thrust_pressed, shoot_pressed, shield_pressed = self.read_input()
 
             # record play ?
             if env.record_play:
@@ -436,9 +918,18 @@ class Ship():
 
         self.do_move(env, left_pressed, right_pressed, up_pressed, down_pressed, thrust_pressed, shoot_pressed, shield_pressed)
 
+    # inputs from a session (see encode_input)
+    def apply_input(self, env, bits):
+        left_pressed, right_pressed, thrust_pressed, shield_pressed, shoot_pressed = decode_input(bits)
+
+        # not recorded here (predicted / re-simulated frames with a rollback), see MayhemEnv.record_inputs()
+        self.do_move(env, left_pressed, right_pressed, False, False, thrust_pressed, shoot_pressed, shield_pressed)
 
     def do_move(self, env, left_pressed, right_pressed, up_pressed, down_pressed, thrust_pressed, shoot_pressed, shield_pressed):
 
+        self.prev_xpos = self.xpos
+        self.prev_ypos = self.ypos
+
         if env.motion == "basic":
 
             # pic
@@ -480,8 +971,9 @@ class Ship():
 
             if thrust_pressed:
                 coef = 2
-                self.xposprecise -= coef * math.cos( math.radians(90 - self.angle) )
-                self.yposprecise -= coef * math.sin( math.radians(90 - self.angle) )
+                a = int(self.angle) // SHIP_ANGLESTEP
+                self.xposprecise -= coef * SHIP_COS[a]
+                self.yposprecise -= coef * SHIP_SIN[a]
                 
                 # transfer to screen coordinates
                 self.xpos = int(self.xposprecise)
@@ -497,16 +989,11 @@ class Ship():
             if shield_pressed:
                 self.image = self.ship_pic_shield
                 self.shield = True
-                if env.render:
-                    self.sound_thrust.stop()
-
-                if env.render:
-                    if not pygame.mixer.get_busy():
-                        self.sound_shield.play(-1)
+                env.audio.stop(self.state_index, "thrust")
+                env.audio.play(self.state_index, "shield")
             else:
                 self.shield = False
-                if env.render:
-                    self.sound_shield.stop()
+                env.audio.stop(self.state_index, "shield")
 
                 # thrust
                 if thrust_pressed:
@@ -516,16 +1003,13 @@ class Ship():
                     #if self.thrust >= SHIP_THRUST_MAX:
                     self.thrust = SHIP_THRUST_MAX
 
-                    if env.render:
-                        if not pygame.mixer.get_busy():
-                            self.sound_thrust.play(-1)
+                    env.audio.play(self.state_index, "thrust")
 
                     self.landed = False
 
                 else:
                     self.thrust = 0.0
-                    if env.render:
-                        self.sound_thrust.stop()
+                    env.audio.stop(self.state_index, "thrust")
 
             # shoot delay
             if shoot_pressed and not self.shoot:
@@ -539,15 +1023,11 @@ class Ship():
 
                 if self.shoot_delay:
                     if len(self.shots) < MAX_SHOOT:
-                        if env.render:
-                            if not pygame.mixer.get_busy():
-                                self.sound_shoot.play()
-
+                        env.audio.play(self.state_index, "shoot")
                         self.add_shots()
             else:
                 self.shoot = False
-                if env.render:
-                    self.sound_shoot.stop()
+                env.audio.stop(self.state_index, "shoot")
 
             #
             self.bounce = False
@@ -563,8 +1043,9 @@ class Ship():
                 self.angle = self.angle % 360
 
                 # https://gafferongames.com/post/integration_basics/
-                self.ax = self.thrust * -math.cos( math.radians(90 - self.angle) ) # ax = thrust * sin1
-                self.ay = iG + (self.thrust * -math.sin( math.radians(90 - self.angle))) # ay = g + thrust * (-cos1)
+                a = int(self.angle) // SHIP_ANGLESTEP
+                self.ax = self.thrust * -SHIP_COS[a] # ax = thrust * sin1
+                self.ay = iG + (self.thrust * -SHIP_SIN[a]) # ay = g + thrust * (-cos1)
 
                 # shoot when shield is on
                 if self.impactx or self.impacty:
@@ -596,35 +1077,55 @@ class Ship():
             if env.mode != "training": # at the moment no landing in training (because NEAT algo is too lazy !)
                 self.is_landed(env)
 
-        #
-        # rotate
-        self.image_rotated = pygame.transform.rotate(self.image, self.angle)
-        self.mask = pygame.mask.from_surface(self.image_rotated)
+        self.update_sprite()
+
+    # rotated sprite, mask and offsets from the current image and angle
+    def update_sprite(self):
+        self.image_rotated, self.mask, self.mini_mask, self.rot_xoffset, self.rot_yoffset = rotated_sprite(self.image, self.angle)
 
-        rect = self.image_rotated.get_rect()
-        self.rot_xoffset = int( ((SHIP_SPRITE_SIZE - rect.width)/2) )  # used in draw() and collide_map()
-        self.rot_yoffset = int( ((SHIP_SPRITE_SIZE - rect.height)/2) ) # used in draw() and collide_map()
+    # shots motion, removed when hitting the terrain, impacts: list to append the terrain pixels hit to (or None)
+    def move_shots(self, map_buffer_mask, impacts=None):
+        width, height = map_buffer_mask.get_size()
 
-    def plot_shots(self, map_buffer):
         for shot in list(self.shots): # copy of self.shots
+            x0 = int(shot.xposprecise)
+            y0 = int(shot.yposprecise)
+
             shot.xposprecise += shot.dx
             shot.yposprecise += shot.dy
             shot.x = int(shot.xposprecise)
             shot.y = int(shot.yposprecise)
 
-            try:
-                c = map_buffer.get_at((int(shot.x), int(shot.y)))
-                if (c.r != 0) or (c.g != 0) or (c.b != 0):
-                    self.shots.remove(shot)
+            # out of the map (the whole segment is inside otherwise)
+            if not (0 <= shot.x < width and 0 <= shot.y < height):
+                self.shots.remove(shot)
+                continue
 
-                #gfxdraw.pixel(map_buffer, int(shot.x) , int(shot.y), WHITE)
-                pygame.draw.circle(map_buffer, WHITE, (int(shot.x) , int(shot.y)), 1)
-                #pygame.draw.line(map_buffer, WHITE, (int(self.xpos + SHIP_SPRITE_SIZE/2), int(self.ypos + SHIP_SPRITE_SIZE/2)), (int(shot.x), int(shot.y)))
+            # every pixel crossed (~5 per frame), or only the new one
+            if USE_SWEPT_COLLISION:
+                mask, left, top = line_mask(shot.x - x0, shot.y - y0)
+                hit = map_buffer_mask.overlap(mask, (x0 + left, y0 + top))
+            else:
+                hit = map_buffer_mask.get_at((shot.x, shot.y))
 
-            # out of surface
-            except IndexError:
+            if hit:
                 self.shots.remove(shot)
 
+                if impacts is not None:
+                    if USE_SWEPT_COLLISION:
+                        hit = next((x, y) for x, y in line_points(x0, y0, shot.x, shot.y) if map_buffer_mask.get_at((x, y)))
+                    else:
+                        hit = (shot.x, shot.y)
+                    impacts.append(hit)
+
+    def draw_shots(self, map_buffer, dirty_rects=None):
+        for shot in self.shots:
+            #gfxdraw.pixel(map_buffer, int(shot.x) , int(shot.y), WHITE)
+            rect = pygame.draw.circle(map_buffer, WHITE, (int(shot.x) , int(shot.y)), 1)
+            if dirty_rects is not None:
+                dirty_rects.append(rect)
+            #pygame.draw.line(map_buffer, WHITE, (int(self.xpos + SHIP_SPRITE_SIZE/2), int(self.ypos + SHIP_SPRITE_SIZE/2)), (int(shot.x), int(shot.y)))
+
         if 0:
             for i in range(len(self.shots)):
                 try:
@@ -637,12 +1138,14 @@ class Ship():
     def add_shots(self):
         shot = Shot()
 
-        shot.x = (self.xpos+15) + 18 * -math.cos(math.radians(90 - self.angle))
-        shot.y = (self.ypos+16) + 18 * -math.sin(math.radians(90 - self.angle))
+        a = int(self.angle) // SHIP_ANGLESTEP
+
+        shot.x = (self.xpos+15) + SHOT_SPAWN_X[a]
+        shot.y = (self.ypos+16) + SHOT_SPAWN_Y[a]
         shot.xposprecise = shot.x
         shot.yposprecise = shot.y
-        shot.dx = 5.1 * -math.cos(math.radians(90 - self.angle))
-        shot.dy = 5.1 * -math.sin(math.radians(90 - self.angle))
+        shot.dx = SHOT_DX[a]
+        shot.dy = SHOT_DY[a]
         shot.dx += self.vx / 3.5
         shot.dy += self.vy / 3.5
 
@@ -650,81 +1153,61 @@ class Ship():
 
     def is_landed(self, env):
 
-        for plaform in PLATFORMS_1:
-            xmin  = plaform[0] - (SHIP_SPRITE_SIZE - 23)
-            xmax  = plaform[1] - (SHIP_SPRITE_SIZE - 9)
-            yflat = plaform[2] - (SHIP_SPRITE_SIZE - 2)
-
-            #print(self.ypos, yflat)
+        yflat = self.platforms.landing(self.xpos, self.ypos)
 
-            if ((xmin <= self.xpos) and (self.xpos <= xmax) and
-               ((self.ypos == yflat) or ((self.ypos-1) == yflat) or ((self.ypos-2) == yflat) or ((self.ypos-3) == yflat) ) and
-               (self.vy > 0) and (self.angle<=SHIP_ANGLE_LAND or self.angle>=(360-SHIP_ANGLE_LAND)) ):
+        if (yflat is not None) and (self.vy > 0) and (self.angle<=SHIP_ANGLE_LAND or self.angle>=(360-SHIP_ANGLE_LAND)):
 
-                self.vy = - self.vy / 1.2
-                self.vx = self.vx / 1.1
-                self.angle = 0
-                self.ypos = yflat
-                self.yposprecise = yflat
+            self.vy = - self.vy / 1.2
+            self.vx = self.vx / 1.1
+            self.angle = 0
+            self.ypos = yflat
+            self.yposprecise = yflat
 
-                if ( (-1.0/SLOW_DOWN_COEF <= self.vx) and (self.vx < 1.0/SLOW_DOWN_COEF) and (-1.0/SLOW_DOWN_COEF < self.vy) and (self.vy < 1.0/SLOW_DOWN_COEF) ):
-                    self.landed = True
-                    self.bounce = False
-                else:
-                    self.bounce = True
-                    if env.render:
-                        self.sound_bounce.play()
+            if ( (-1.0/SLOW_DOWN_COEF <= self.vx) and (self.vx < 1.0/SLOW_DOWN_COEF) and (-1.0/SLOW_DOWN_COEF < self.vy) and (self.vy < 1.0/SLOW_DOWN_COEF) ):
+                self.landed = True
+                self.bounce = False
+            else:
+                self.bounce = True
+                env.audio.play(self.state_index, "bounce")
 
-                return True
+            return True
 
         return False
 
     def do_test_collision(self):
-        test_it = True
-
-        for plaform in PLATFORMS_1:
-            xmin  = plaform[0] - (SHIP_SPRITE_SIZE - 23)
-            xmax  = plaform[1] - (SHIP_SPRITE_SIZE - 9)
-            yflat = plaform[2] - (SHIP_SPRITE_SIZE - 2)
-
-            #if ((xmin<=self.xpos) and (self.xpos<=xmax) and ((self.ypos==yflat) or ((self.ypos-1)==yflat) or ((self.ypos-2)==yflat) or ((self.ypos-3)==yflat))  and  (self.angle<=SHIP_ANGLE_LAND or self.angle>=(360-SHIP_ANGLE_LAND)) ):
-            #    test_it = False
-            #    break
-            if (self.shield and (xmin<=self.xpos) and (self.xpos<=xmax) and ((self.ypos==yflat) or ((self.ypos-1)==yflat) or ((self.ypos-2)==yflat) or ((self.ypos-3)==yflat) or ((self.ypos+1)==yflat)) and  (self.angle<=SHIP_ANGLE_LAND or self.angle>=(360-SHIP_ANGLE_LAND)) ):
-                test_it = False
-                break
-            if ((self.thrust) and (xmin<=self.xpos) and (self.xpos<=xmax) and ((self.ypos==yflat) or ((self.ypos-1)==yflat) or ((self.ypos+1)==yflat) )):
-                test_it = False
-                break
+        upright = self.angle<=SHIP_ANGLE_LAND or self.angle>=(360-SHIP_ANGLE_LAND)
 
-        return test_it
+        return not self.platforms.exempt(self.xpos, self.ypos, self.shield, self.thrust, upright)
 
     def draw(self, map_buffer):
         #game_window.blit(self.image_rotated, (self.view_width/2 + self.view_left + self.rot_xoffset, self.view_height/2 + self.view_top + self.rot_yoffset))
-        map_buffer.blit(self.image_rotated, (self.xpos + self.rot_xoffset, self.ypos + self.rot_yoffset))
+        return map_buffer.blit(self.image_rotated, (self.xpos + self.rot_xoffset, self.ypos + self.rot_yoffset))
 
-    def collide_map(self, map_buffer, map_buffer_mask):
+    # against the terrain mask only (the map buffer with the ships and shots drawn is never read)
+    def collide_map(self, map_buffer_mask):
 
-        # ship size mask
-        if USE_MINI_MASK:
-            mini_area = Rect(self.xpos, self.ypos, SHIP_SPRITE_SIZE, SHIP_SPRITE_SIZE)
-            mini_subsurface = map_buffer.subsurface(mini_area)
-            mini_subsurface.set_colorkey( (0, 0, 0) ) # used for the mask, black = background
-            mini_mask = pygame.mask.from_surface(mini_subsurface)
+        # ship size mask: only the part of the ship in its 32x32 box
+        mask = self.mini_mask if USE_MINI_MASK else self.mask
 
-            if self.do_test_collision():
-                offset = (self.rot_xoffset, self.rot_yoffset) # pos of the ship
+        # swept: every position crossed since the previous frame (current mask), the ship is stopped at the first collision
+        if USE_SWEPT_COLLISION and max(abs(self.xpos - self.prev_xpos), abs(self.ypos - self.prev_ypos)) > 1:
+            upright = self.angle<=SHIP_ANGLE_LAND or self.angle>=(360-SHIP_ANGLE_LAND)
 
-                if mini_mask.overlap(self.mask, offset): # https://stackoverflow.com/questions/55817422/collision-between-masks-in-pygame/55818093#55818093
+            for x, y in line_points(self.prev_xpos, self.prev_ypos, self.xpos, self.ypos):
+                if self.platforms.exempt(x, y, self.shield, self.thrust, upright):
+                    continue
+
+                if map_buffer_mask.overlap(mask, (x + self.rot_xoffset, y + self.rot_yoffset)):
+                    self.xpos = self.xposprecise = x
+                    self.ypos = self.yposprecise = y
                     self.explod = True
+                    break
 
-        # player view size mask
-        else:
-            if self.do_test_collision():
-                offset = (self.xpos + self.rot_xoffset, self.ypos + self.rot_yoffset) # pos of the ship
+        elif self.do_test_collision():
+            offset = (self.xpos + self.rot_xoffset, self.ypos + self.rot_yoffset) # pos of the ship
 
-                if map_buffer_mask.overlap(self.mask, offset): # https://stackoverflow.com/questions/55817422/collision-between-masks-in-pygame/55818093#55818093
-                    self.explod = True
+            if map_buffer_mask.overlap(mask, offset): # https://stackoverflow.com/questions/55817422/collision-between-masks-in-pygame/55818093#55818093
+                self.explod = True
 
     # 
     def collide_ship(self, ships):
@@ -739,73 +1222,43 @@ class Ship():
     def collide_shots(self, ships):
         for ship in ships:
             if self != ship:
+                mask = ship.mask
+                w, h = mask.get_size()
+                xpos = ship.xpos
+                ypos = ship.ypos
                 for shot in self.shots:
-                    try:
-                        if ship.mask.get_at((shot.x - ship.xpos, shot.y - ship.ypos)):
-                            if not ship.shield:
-                                ship.explod = True
-                                return
-                            else:
-                                ship.impactx = shot.dx
-                                ship.impacty = shot.dy
+                    x = shot.x - xpos
+                    y = shot.y - ypos
                     # out of ship mask => no collision
-                    except IndexError:
-                        pass
+                    if x < 0 or y < 0 or x >= w or y >= h:
+                        continue
+                    if mask.get_at((x, y)):
+                        if not ship.shield:
+                            ship.explod = True
+                            return
+                        else:
+                            ship.impactx = shot.dx
+                            ship.impacty = shot.dy
 
     def ray_sensor(self, env, render=True):
         # TODO use smaller map masks
         # TODO use only 0 to 90 degres ray mask quadran: https://github.com/Rabbid76/PyGameExamplesAndAnswers/blob/master/examples/minimal_examples/pygame_minimal_mask_intersect_surface_line_2.py
 
-        # clipping translation for window coordinates
-        rx = self.xpos - self.view_width/2
-        ry = self.ypos - self.view_height/2
-
-        dx = 0
-        dy = 0
-
-        if rx < 0:
-            dx = rx
-        elif rx > (MAP_WIDTH - self.view_width):
-            dx = rx - (MAP_WIDTH - self.view_width)
-        if ry < 0:
-            dy = ry
-        elif ry > (MAP_HEIGHT - self.view_height):
-            dy = ry - (MAP_HEIGHT - self.view_height)
+        # in window coord, center of the ship (camera of the last rendered frame)
+        if render:
+            ship_window_pos = self.camera.to_window(self.xpos + SHIP_SPRITE_SIZE/2, self.ypos + SHIP_SPRITE_SIZE/2)
+            #print("ship_window_pos", ship_window_pos)
 
-        #sub_area1 = Rect(rx, ry, self.view_width, self.view_height)
-        #self.env.game.window.blit(self.env.game.map_buffer, (self.view_left, self.view_top), sub_area1)
-
-        # in window coord, center of the player view
-        ship_window_pos = (int(self.view_width/2) + self.view_left + SHIP_SPRITE_SIZE/2 + dx, int(self.view_height/2) + self.view_top + SHIP_SPRITE_SIZE/2 + dy)
-        #print("ship_window_pos", ship_window_pos)
-
-        ray_surface_center = (int(RAY_BOX_SIZE/2), int(RAY_BOX_SIZE/2))
-
-        wall_distances = []
+        wall_distances = self.wall_distances
 
         # 30 degres step
-        for angle in range(0, 359, RAY_AMGLE_STEP):
-
-            c = math.cos(math.radians(angle))
-            s = math.sin(math.radians(angle))
+        for i in range(RAY_NB):
 
-            flip_x = c < 0
-            flip_y = s < 0
+            flip_x = RAY_COS[i] < 0
+            flip_y = RAY_SIN[i] < 0
 
             filpped_map_mask = env.game.flipped_masks_map_buffer[flip_x][flip_y]
-
-            # ray final point
-            x_dest = ray_surface_center[0] + RAY_BOX_SIZE/2 * abs(c)
-            y_dest = ray_surface_center[1] + RAY_BOX_SIZE/2 * abs(s)
-
-            #x_dest = ray_surface_center[0] + RAY_BOX_SIZE * abs(c)
-            #y_dest = ray_surface_center[1] + RAY_BOX_SIZE * abs(s)
-
-            self.ray_surface.fill((0, 0, 0))
-            self.ray_surface.set_colorkey((0, 0, 0))
-            pygame.draw.line(self.ray_surface, WHITE, ray_surface_center, (x_dest, y_dest))
-            ray_mask = pygame.mask.from_surface(self.ray_surface)
-            pygame.draw.circle(self.ray_surface, RED, ray_surface_center, 3)
+            ray_mask = RAY_MASKS[i]
 
             # offset = ray mask (left/top) coordinate in the map (ie where to put our lines mask in the map)
             if flip_x:
@@ -833,7 +1286,7 @@ class Ship():
                 dy_hit = hit[1] - (self.ypos+SHIP_SPRITE_SIZE/2)
 
                 if render:
-                    pygame.draw.line(env.game.window, LVIOLET, ship_window_pos, (ship_window_pos[0] + dx_hit, ship_window_pos[1] + dy_hit))
+                    pygame.draw.line(env.game.window, LVIOLET, ship_window_pos, self.camera.to_window(hit[0], hit[1]))
                     #pygame.draw.circle(map, RED, hit, 2)
 
                 # Note: this is the distance from the center of the ship, not the borders
@@ -848,7 +1301,7 @@ class Ship():
             if dist_wall < 0:
                 dist_wall = 0
 
-            wall_distances.append(dist_wall)
+            wall_distances[i] = dist_wall
 
             #print("Sensor for angle=%s, dist wall=%.2f" % (str(angle), dist_wall))
 
@@ -861,11 +1314,330 @@ class Ship():
 # -------------------------------------------------------------------------------------------------
 # -------------------------------------------------------------------------------------------------
 
+class RunningNormalizer():
+
+    def __init__(self, size, clip=OBS_CLIP):
+
+        self.size = size
+        self.clip = clip
+        self.frozen = False # no more update (evaluation)
+
+        # Welford running mean / variance: m2 = sum of the squared differences from the mean
+        # https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Welford's_online_algorithm
+        self.count = 0
+        self.mean = np.zeros(size)
+        self.m2 = np.zeros(size)
+
+        # preallocated for the per step update / normalize
+        self.delta = np.zeros(size)
+        self.tmp = np.zeros(size)
+        self.std = np.ones(size)
+        self.std_count = 0 # count when std was computed
+
+    # x: one observation (size,) or a batch of observations (n, size)
+    def update(self, x):
+        if self.frozen:
+            return
+
+        if x.ndim == 1:
+            self.count += 1
+
+            np.subtract(x, self.mean, out=self.delta)
+            np.multiply(self.delta, 1. / self.count, out=self.tmp)
+            self.mean += self.tmp
+
+            np.subtract(x, self.mean, out=self.tmp)
+            np.multiply(self.delta, self.tmp, out=self.tmp)
+            self.m2 += self.tmp
+        else:
+            batch_mean = x.mean(axis=0)
+            self.merge_stats(len(x), batch_mean, ((x - batch_mean)**2).sum(axis=0))
+
+    # parallel version: https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
+    def merge_stats(self, count, mean, m2):
+        if count == 0:
+            return
+
+        total = self.count + count
+        delta = mean - self.mean
+
+        self.mean += delta * (count / total)
+        self.m2 += m2 + (delta**2) * (self.count * count / total)
+        self.count = total
+
+    def merge(self, other):
+        self.merge_stats(other.count, other.mean, other.m2)
+
+    def normalize(self, x, out):
+        if self.count > 1 and self.count != self.std_count:
+            np.divide(self.m2, self.count, out=self.std)
+            np.sqrt(self.std, out=self.std)
+            np.maximum(self.std, 1e-6, out=self.std) # constant inputs
+            self.std_count = self.count
+
+        np.subtract(x, self.mean, out=out)
+        np.divide(out, self.std, out=out)
+        np.clip(out, -self.clip, self.clip, out=out)
+
+        return out
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump({"count": self.count, "mean": self.mean, "m2": self.m2, "clip": self.clip}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # loaded statistics are frozen
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            stats = pickle.load(f)
+
+        normalizer = cls(len(stats["mean"]), stats["clip"])
+        normalizer.merge_stats(stats["count"], stats["mean"], stats["m2"])
+        normalizer.frozen = True
+
+        return normalizer
+
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+
+class ObservationSpec():
+
+    def __init__(self, features=OBS_FEATURES, frame_stack=OBS_FRAME_STACK, normalize=OBS_NORMALIZE, normalizer=None, collector=None):
+
+        self.features = features
+        self.frame_stack = frame_stack
+
+        # where each feature goes in the observation
+        self.scalars = [] # (index, ship attribute)
+        self.arrays  = [] # (slice, ship attribute)
+
+        mins = []
+        maxs = []
+
+        i = 0
+        for name, vmin, vmax in self.features:
+            width = OBS_WIDTHS.get(name, 1)
+
+            if name in OBS_WIDTHS:
+                self.arrays.append( (slice(i, i + width), name) )
+            else:
+                self.scalars.append( (i, name) )
+
+            mins.extend([vmin] * width)
+            maxs.extend([vmax] * width)
+            i += width
+
+        self.frame_size = i
+        self.size = self.frame_size * self.frame_stack
+
+        # https://www.baeldung.com/cs/normalizing-inputs-artificial-neural-network
+        # https://machinelearningmastery.com/how-to-improve-neural-network-stability-and-modeling-performance-with-data-scaling/
+        # min-max: (((x - min) / (max - min)) * 2) - 1 = x * scale + offset, precomputed
+        mins = np.array(mins)
+        maxs = np.array(maxs)
+
+        if normalize == "minmax":
+            self.scale  = 2. / (maxs - mins)
+            self.offset = -1. - (mins * self.scale)
+        else:
+            self.scale  = np.ones(self.frame_size)
+            self.offset = np.zeros(self.frame_size)
+
+        # running statistics: normalizer is used to normalize, collector gathers the new samples (usually the same object)
+        self.normalizer = None
+
+        if normalize == "running":
+            self.normalizer = normalizer if normalizer is not None else RunningNormalizer(self.frame_size)
+            self.collector  = collector if collector is not None else self.normalizer
+
+        # preallocated, filled in place at each step
+        self.raw  = np.zeros(self.frame_size)
+        self.norm = np.zeros(self.frame_size)
+
+        self.frames = np.zeros((self.frame_stack, self.frame_size), dtype=np.float32) # most recent first
+        self.observation = self.frames.reshape(self.size) # view on self.frames
+
+    def clear(self):
+        self.frames.fill(0.)
+        return self.observation
+
+    def observe(self, ship):
+        raw = self.raw
+
+        for i, name in self.scalars:
+            raw[i] = getattr(ship, name)
+
+        for sl, name in self.arrays:
+            raw[sl] = getattr(ship, name)
+
+        if self.normalizer is not None:
+            self.collector.update(raw)
+            self.normalizer.normalize(raw, self.norm)
+        else:
+            np.multiply(raw, self.scale, out=self.norm)
+            np.add(self.norm, self.offset, out=self.norm)
+
+        # shift the stacked frames
+        for k in range(self.frame_stack - 1, 0, -1):
+            self.frames[k] = self.frames[k-1]
+
+        self.frames[0] = self.norm
+
+        return self.observation
+
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+
+class PixelObservation():
+
+    def __init__(self, game, nb_ships=1, size=PIXEL_OBS_SIZE, scale=PIXEL_OBS_SCALE, frame_stack=PIXEL_OBS_STACK, mode=PIXEL_OBS_MODE):
+
+        self.game = game
+        self.size = size
+        self.scale = scale
+        self.frame_stack = frame_stack
+        self.mode = mode
+
+        self.shape = (self.frame_stack, self.size, self.size)
+
+        # (ship, frame, y, x), most recent frame first
+        self.frames = np.zeros((nb_ships, ) + self.shape, dtype=np.uint8)
+
+        # preallocated for the grey conversion
+        self.tmp = np.zeros((self.size, self.size), dtype=np.uint32)
+        self.acc = np.zeros((self.size, self.size), dtype=np.uint32)
+
+        self.shifts = self.game.map.get_shifts()[:3]
+
+        # rotated ship image => grey (y, x) pixels, (y, x) mask of the non black ones
+        self.sprites = {}
+
+    def clear(self):
+        self.frames.fill(0)
+        return self.frames
+
+    # grey: the ships are drawn in every crop, from their current pose (not from the shared and maybe not yet drawn
+    # map buffer)
+    def observe(self, ships):
+
+        # shift the stacked frames
+        for k in range(self.frame_stack - 1, 0, -1):
+            self.frames[:, k] = self.frames[:, k-1]
+
+        # (x, y) view on the terrain pixels, no copy (locks the surface until released)
+        pixels = pygame.surfarray.pixels2d(self.game.map) if self.mode == "grey" else None
+
+        for ship, frames in zip(ships, self.frames):
+            self.crop(ship, pixels, frames[0])
+
+            if self.mode == "grey":
+                for other in ships:
+                    self.stamp(other, ship, frames[0])
+
+        del pixels
+
+        return self.frames
+
+    def crop(self, ship, pixels, out):
+        s = self.scale
+        half = (self.size * s) // 2
+
+        # map coordinates of out[0, 0]
+        x0 = ship.xpos + SHIP_SPRITE_SIZE//2 - half
+        y0 = ship.ypos + SHIP_SPRITE_SIZE//2 - half
+
+        # part of out inside the map, the rest is black
+        i0 = max(0, -(x0 // s))
+        i1 = min(self.size, -((x0 - MAP_WIDTH) // s))
+        j0 = max(0, -(y0 // s))
+        j1 = min(self.size, -((y0 - MAP_HEIGHT) // s))
+
+        out.fill(0)
+
+        if i0 >= i1 or j0 >= j1:
+            return
+
+        xs = slice(x0 + i0*s, x0 + (i1-1)*s + 1, s)
+        ys = slice(y0 + j0*s, y0 + (j1-1)*s + 1, s)
+
+        dst = out[j0:j1, i0:i1]
+
+        if self.mode == "palette":
+            dst[...] = self.game.map_index[ys, xs]
+            return
+
+        # grey = (77*r + 150*g + 29*b) / 256, computed on the cropped pixels only
+        src = pixels[xs, ys].T
+        tmp = self.tmp[j0:j1, i0:i1]
+        acc = self.acc[j0:j1, i0:i1]
+
+        acc.fill(0)
+        for shift, coef in zip(self.shifts, (77, 150, 29)):
+            np.right_shift(src, shift, out=tmp)
+            np.bitwise_and(tmp, 0xff, out=tmp)
+            np.multiply(tmp, coef, out=tmp)
+            acc += tmp
+
+        np.right_shift(acc, 8, out=acc)
+        dst[...] = acc
+
+    def sprite(self, image):
+        try:
+            return self.sprites[image]
+        except KeyError:
+            rgb = pygame.surfarray.array3d(image).transpose(1, 0, 2).astype(np.uint32)
+            grey = ((77*rgb[..., 0] + 150*rgb[..., 1] + 29*rgb[..., 2]) >> 8).astype(np.uint8)
+            self.sprites[image] = (grey, rgb.any(axis=2))
+            return self.sprites[image]
+
+    # ship sprite and shots of ship into the crop around center_ship, same sampling as crop()
+    def stamp(self, ship, center_ship, out):
+        s = self.scale
+        half = (self.size * s) // 2
+
+        x0 = center_ship.xpos + SHIP_SPRITE_SIZE//2 - half
+        y0 = center_ship.ypos + SHIP_SPRITE_SIZE//2 - half
+
+        grey, mask = self.sprite(ship.image_rotated)
+
+        # first sprite pixel on the sampling grid, and its place in out
+        x = ship.xpos + ship.rot_xoffset
+        y = ship.ypos + ship.rot_yoffset
+        ox = (x0 - x) % s
+        oy = (y0 - y) % s
+        i = (x + ox - x0) // s
+        j = (y + oy - y0) // s
+
+        grey = grey[oy::s, ox::s]
+        mask = mask[oy::s, ox::s]
+        h, w = grey.shape
+
+        i0, i1 = max(i, 0), min(i + w, self.size)
+        j0, j1 = max(j, 0), min(j + h, self.size)
+
+        if i0 < i1 and j0 < j1:
+            np.copyto(out[j0:j1, i0:i1], grey[j0-j:j1-j, i0-i:i1-i], where=mask[j0-j:j1-j, i0-i:i1-i])
+
+        for shot in ship.shots:
+            i = (int(shot.x) - x0) // s
+            j = (int(shot.y) - y0) // s
+            if 0 <= i < self.size and 0 <= j < self.size:
+                out[j, i] = 255
+
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+
 class MayhemEnv():
     
-    def __init__(self, game, render, nb_player, mode="game", motion="gravity", sensor="", record_play="", play_recorded=""):
+    def __init__(self, game, render, nb_player, mode="game", motion="gravity", sensor="", record_play="", play_recorded="", \
+                 time_scale=TIME_SCALE, render_every=RENDER_EVERY, display_fps=DISPLAY_FPS, obs_normalizer=None, obs_collector=None, \
+                 obs_mode="vector", session=None, rollback_frames=0, broadcast=None, destructible=False, \
+                 zoom=CAMERA_ZOOM, camera_follow=CAMERA_FOLLOW, minimap=False, random_start=False):
 
-        self.myfont = pygame.font.SysFont('Arial', 20)
+        self.hud = Hud()
 
         self.render = render
         self.nb_player = nb_player
@@ -889,7 +1661,26 @@ class MayhemEnv():
                 self.played_data = pickle.load(f)
 
         # FPS
-        self.clock = pygame.time.Clock()
+        self.clock = SimClock(time_scale, render_every, display_fps)
+
+        # sound effects (no-op when not rendered)
+        self.audio = AudioManager(MAX_SHIPS, enabled=self.render)
+
+        # game mode inputs from a LocalSession / LockstepClient instead of the ships keyboard / joysticks
+        self.session = session
+        self.input_sent = 0 # next frame to send the local inputs for
+
+        # predicted remote inputs, re-simulated when they turn out wrong (None = lockstep)
+        self.rollback = None
+        if session is not None and rollback_frames:
+            self.rollback = RollbackSession(session, rollback_frames)
+
+        # BroadcastServer: every simulated frame is streamed to the spectators
+        self.broadcast = broadcast
+
+        # shots carve the terrain (shared by the envs of this process, not part of get_state)
+        self.destructible = destructible
+        self.fps_text = 'FPS 0'
         self.paused = False
         self.frames = 0
 
@@ -897,18 +1688,22 @@ class MayhemEnv():
 
         self.ships = []
 
+
+        # level platforms, shared by the ships
+        self.platforms = PlatformIndex(PLATFORMS_1)
+
         if self.mode == "game":
             self.ship_1 = Ship(self.mode, self.game.screen_width, self.game.screen_height, 1, self.nb_player, SHIP1_X, SHIP1_Y, \
-                                   SHIP_1_PIC, SHIP_1_PIC_THRUST, SHIP_1_PIC_SHIELD, SHIP_1_KEYS, SHIP_1_JOY, SHIP_MAX_LIVES - self.nb_dead)
+                                   SHIP_1_PIC, SHIP_1_PIC_THRUST, SHIP_1_PIC_SHIELD, SHIP_1_KEYS, SHIP_1_JOY, SHIP_MAX_LIVES - self.nb_dead, 0, self.platforms)
 
             self.ship_2 = Ship(self.mode, self.game.screen_width, self.game.screen_height, 2, self.nb_player, SHIP2_X, SHIP2_Y, \
-                               SHIP_2_PIC, SHIP_2_PIC_THRUST, SHIP_2_PIC_SHIELD, SHIP_2_KEYS, SHIP_2_JOY, SHIP_MAX_LIVES - self.nb_dead)
+                               SHIP_2_PIC, SHIP_2_PIC_THRUST, SHIP_2_PIC_SHIELD, SHIP_2_KEYS, SHIP_2_JOY, SHIP_MAX_LIVES - self.nb_dead, 1, self.platforms)
 
             self.ship_3 = Ship(self.mode, self.game.screen_width, self.game.screen_height, 3, self.nb_player, SHIP3_X, SHIP3_Y, \
-                               SHIP_3_PIC, SHIP_3_PIC_THRUST, SHIP_3_PIC_SHIELD, SHIP_3_KEYS, SHIP_3_JOY, SHIP_MAX_LIVES - self.nb_dead)
+                               SHIP_3_PIC, SHIP_3_PIC_THRUST, SHIP_3_PIC_SHIELD, SHIP_3_KEYS, SHIP_3_JOY, SHIP_MAX_LIVES - self.nb_dead, 2, self.platforms)
 
             self.ship_4 = Ship(self.mode, self.game.screen_width, self.game.screen_height, 4, self.nb_player, SHIP4_X, SHIP4_Y, \
-                               SHIP_4_PIC, SHIP_4_PIC_THRUST, SHIP_4_PIC_SHIELD, SHIP_4_KEYS, SHIP_4_JOY, SHIP_MAX_LIVES - self.nb_dead)
+                               SHIP_4_PIC, SHIP_4_PIC_THRUST, SHIP_4_PIC_SHIELD, SHIP_4_KEYS, SHIP_4_JOY, SHIP_MAX_LIVES - self.nb_dead, 3, self.platforms)
 
             self.ships.append(self.ship_1)
             
@@ -921,10 +1716,31 @@ class MayhemEnv():
 
         # -- training params
         self.done = False
+        self.total_dist = 0
+
+        # "vector": ObservationSpec (ship physics + sensors), "pixels": PixelObservation
+        self.obs_mode = obs_mode
+        self.obs_spec = ObservationSpec(normalizer=obs_normalizer, collector=obs_collector)
+
+        if self.obs_mode == "pixels":
+            self.pixel_obs = PixelObservation(self.game)
+
+        self.rng = random.Random() # seeded by MayhemGymEnv.reset()
+        self.random_start = random_start # reset() at one of the START_POSITIONS (self.rng), init_xpos / init_ypos otherwise
+        self.collision = False
+
+        # level cells visited in the episode (training)
+        self.coverage = CoverageGrid()
 
         if self.mode == "training":
             self.ship_1 = Ship(self.mode, self.game.screen_width, self.game.screen_height, 1, 1, 430, 730, \
-                               SHIP_1_PIC, SHIP_1_PIC_THRUST, SHIP_1_PIC_SHIELD, SHIP_1_KEYS, SHIP_1_JOY, SHIP_MAX_LIVES)
+                               SHIP_1_PIC, SHIP_1_PIC_THRUST, SHIP_1_PIC_SHIELD, SHIP_1_KEYS, SHIP_1_JOY, SHIP_MAX_LIVES, 0, self.platforms)
+
+            self.renderer = SplitScreenRenderer(self.game, [self.ship_1], False, zoom, camera_follow, minimap)
+        else:
+            self.renderer = SplitScreenRenderer(self.game, self.ships, True, zoom, camera_follow, minimap)
+
+        self.sim_state = np.zeros((), dtype=SIM_STATE) # get_state() buffer
 
     def main_loop(self):
 
@@ -941,11 +1757,10 @@ class MayhemEnv():
                 self.game_loop()
 
             for ship in self.ships:
-                ship.sound_thrust.stop()
-                ship.sound_bounce.stop()
-                ship.sound_shield.stop()
-                ship.sound_shoot.stop()
-                ship.sound_explod.play()
+                self.audio.stop_all(ship.state_index)
+                self.audio.play(ship.state_index, "explod")
+
+            self.audio.flush()
 
             self.nb_dead += 1
 
@@ -979,85 +1794,161 @@ class MayhemEnv():
                     elif event.key == pygame.K_p:
                         self.paused = not self.paused
 
-            if not self.paused:
+                elif event.type == pygame.VIDEOEXPOSE:
+                    self.renderer.invalidate()
 
-                # clear screen
-                self.game.window.fill((0,0,0))
+            frame = self.frames
 
-                # map copy (TODO reduce)
-                self.game.map_buffer.blit(self.game.map, (0, 0))
+            # lockstep / rollback: no new frame until the inputs of all the players are there
+            if not self.paused and self.advance():
 
-                # update ship pos
-                for ship in self.ships:
-                    ship.update(self)
+                if self.broadcast is not None:
+                    self.broadcast.publish(self)
 
-                # collide_map and ship tp ship
-                for ship in self.ships:
-                    ship.collide_map(self.game.map_buffer, self.game.map_buffer_mask)
+                render_frame = self.clock.begin_frame(frame)
 
-                for ship in self.ships:
-                    ship.collide_ship(self.ships)
-                    
-                for ship in self.ships:
-                    ship.plot_shots(self.game.map_buffer)
+                if render_frame:
+                    # erase last frame ships and shots from the map buffer
+                    self.renderer.restore_map()
 
-                for ship in self.ships:
-                    ship.collide_shots(self.ships)
+                    # blit shots and ships in the map
+                    for ship in self.ships:
+                        ship.draw_shots(self.game.map_buffer, self.renderer.map_dirty_rects)
 
-                # blit ship in the map
-                for ship in self.ships:
-                    ship.draw(self.game.map_buffer)
-
-                for ship in self.ships:
-
-                    # clipping to avoid black when the ship is close to the edges
-                    rx = ship.xpos - ship.view_width/2
-                    ry = ship.ypos - ship.view_height/2
-                    if rx < 0:
-                        rx = 0
-                    elif rx > (MAP_WIDTH - ship.view_width):
-                        rx = (MAP_WIDTH - ship.view_width)
-                    if ry < 0:
-                        ry = 0
-                    elif ry > (MAP_HEIGHT - ship.view_height):
-                        ry = (MAP_HEIGHT - ship.view_height)
-
-                    # blit the map area around the ship on the screen
-                    sub_area1 = Rect(rx, ry, ship.view_width, ship.view_height)
-                    self.game.window.blit(self.game.map_buffer, (ship.view_left, ship.view_top), sub_area1)
+                    for ship in self.ships:
+                        self.renderer.map_dirty_rects.append(ship.draw(self.game.map_buffer))
+
+                    self.renderer.draw_views()
 
                 # sensors
                 if self.sensor == "ray":
-                    for ship in self.ships:
-                        ship.ray_sensor(self)
-
-                for ship in self.ships:
-                    if ship.explod:
-                        ship.reset(self)
+                    for ship, view_rect in zip(self.ships, self.renderer.view_rects):
+                        self.game.window.set_clip(view_rect)
+                        ship.ray_sensor(self, render_frame)
+                    self.game.window.set_clip(None)
 
-                # debug on screen
-                self.screen_print_info()
+                if render_frame:
+                    # debug on screen
+                    self.screen_print_info()
 
-                cv = (225, 225, 225)
-                pygame.draw.line( self.game.window, cv, (0, int(self.game.screen_height/2)), (self.game.screen_width, int(self.game.screen_height/2)) )
-                pygame.draw.line( self.game.window, cv, (int(self.game.screen_width/2), 0), (int(self.game.screen_width/2), (self.game.screen_height)) )
+                    # display
+                    self.renderer.present()
 
-                # display
-                pygame.display.flip()
-                self.frames += 1
+                self.audio.flush()
 
-            self.clock.tick(MAX_FPS) # https://python-forum.io/thread-16692.html
+            self.clock.tick(self.paused)
 
             #print(self.clock.get_fps())
 
+    # one game frame, no drawing: re-runnable from a get_state() snapshot (rollback)
+    # inputs: bits of every ship (see encode_input), None = keyboard / joysticks / recorded play
+    def sim_step(self, inputs=None):
+
+        # update ship pos
+        if inputs is None:
+            for ship in self.ships:
+                ship.update(self)
+        else:
+            for ship, bits in zip(self.ships, inputs):
+                ship.apply_input(self, bits)
+
+        # collide_map and ship tp ship
+        for ship in self.ships:
+            ship.collide_map(self.game.map_buffer_mask)
+
+        for ship in self.ships:
+            ship.collide_ship(self.ships)
+
+        impacts = [] if self.destructible else None
+
+        for ship in self.ships:
+            ship.move_shots(self.game.map_buffer_mask, impacts)
+
+        # once all the shots have moved: the same terrain for every ship in a frame
+        if impacts:
+            for x, y in impacts:
+                self.game.carve(x, y)
+
+        for ship in self.ships:
+            ship.collide_shots(self.ships)
+
+        for ship in self.ships:
+            if ship.explod:
+                ship.reset(self)
+
+        self.frames += 1
+
+    # simulate the next frame, False when waiting for the inputs of the other players
+    def advance(self):
+        if self.rollback is not None:
+            return self.rollback.advance(self)
+
+        if self.session is not None:
+            inputs = self.session_inputs()
+            if inputs is None:
+                return False
+
+            self.sim_step(inputs)
+            self.record_inputs(inputs)
+
+        else:
+            self.sim_step()
+
+        return True
+
+    # record play ? confirmed session inputs only, once per frame
+    def record_inputs(self, inputs):
+        if self.record_play:
+            for bits in inputs:
+                self.played_data.append(decode_input(bits))
+
+    # send the local players inputs (once per frame, input_delay frames ahead)
+    def send_inputs(self):
+        if self.input_sent <= self.frames:
+            # local player N plays with the keys / joystick of ship N (ship 1 for a network client)
+            for player, ship in zip(self.session.local_players, self.ships):
+                left_pressed, right_pressed, up_pressed, down_pressed, thrust_pressed, shoot_pressed, shield_pressed = ship.read_input()
+                bits = encode_input((left_pressed, right_pressed, thrust_pressed, shield_pressed, shoot_pressed))
+                self.session.send(self.frames + self.session.input_delay, player, bits)
+
+            self.input_sent = self.frames + 1
+
+    # the inputs of all the players for this frame, None if not complete
+    def session_inputs(self):
+        self.send_inputs()
+
+        return self.session.confirmed(self.frames)
+
+    # headless simulation speed, and rollback cost: restore a snapshot and re-simulate rollback_frames frames
+    def benchmark(self, nb_frames=BENCHMARK_FRAMES, rollback_frames=ROLLBACK_FRAMES):
+        rng = random.Random(0)
+        inputs = [ tuple(rng.randrange(32) for ship in self.ships) for frame in range(nb_frames) ]
+
+        t = time.perf_counter()
+        for frame_inputs in inputs:
+            self.sim_step(frame_inputs)
+        sim_time = (time.perf_counter() - t) / nb_frames
+
+        t = time.perf_counter()
+        for i in range(nb_frames // rollback_frames):
+            state = self.get_state()
+            self.set_state(state)
+            for frame_inputs in inputs[i*rollback_frames:(i+1)*rollback_frames]:
+                self.sim_step(frame_inputs)
+        rollback_time = (time.perf_counter() - t) / (nb_frames // rollback_frames)
+
+        frame_time = 1. / MAX_FPS
+
+        print("%d ships, %d frames" % (len(self.ships), nb_frames))
+        print("sim_step: %.3f ms / frame = %.0fx real time" % (sim_time * 1e3, frame_time / sim_time))
+        print("rollback of %d frames (get_state + set_state + %d sim_step): %.2f ms = %.0f%% of a frame" % \
+              (rollback_frames, rollback_frames, rollback_time * 1e3, 100. * rollback_time / frame_time))
+
     def practice_loop(self):
 
         # Game Main Loop
         while not self.ship_1.explod:
 
-            # clear screen
-            self.game.window.fill((0,0,0))
-
             # pygame events
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
@@ -1069,96 +1960,177 @@ class MayhemEnv():
                     elif event.key == pygame.K_p:
                         self.paused = not self.paused
 
-            if not self.paused:            
-                # map copy (TODO reduce)
-                self.game.map_buffer.blit(self.game.map, (0, 0))
+            if not self.paused:
+                render_frame = self.clock.begin_frame(self.frames)
+
+                # erase last frame ship from the map buffer
+                self.renderer.restore_map()
 
                 self.ship_1.update(self)
 
                 # collision
-                self.ship_1.collide_map(self.game.map_buffer, self.game.map_buffer_mask)
+                self.ship_1.collide_map(self.game.map_buffer_mask)
 
-                # blit ship in the map
-                self.ship_1.draw(self.game.map_buffer)
-
-                # clipping to avoid black when the ship is close to the edges
-                rx = self.ship_1.xpos - self.ship_1.view_width/2
-                ry = self.ship_1.ypos - self.ship_1.view_height/2
-                if rx < 0:
-                    rx = 0
-                elif rx > (MAP_WIDTH - self.ship_1.view_width):
-                    rx = (MAP_WIDTH - self.ship_1.view_width)
-                if ry < 0:
-                    ry = 0
-                elif ry > (MAP_HEIGHT - self.ship_1.view_height):
-                    ry = (MAP_HEIGHT - self.ship_1.view_height)
-
-                # blit the map area around the ship on the screen
-                sub_area1 = Rect(rx, ry, self.ship_1.view_width, self.ship_1.view_height)
-                self.game.window.blit(self.game.map_buffer, (self.ship_1.view_left, self.ship_1.view_top), sub_area1)
+                if render_frame:
+                    # blit ship in the map
+                    self.renderer.map_dirty_rects.append(self.ship_1.draw(self.game.map_buffer))
+                    self.renderer.draw_views()
 
                 # sensors
                 if self.sensor == "ray":
-                    self.ship_1.ray_sensor(self)
+                    self.ship_1.ray_sensor(self, render_frame)
 
-                # debug on screen
-                self.screen_print_info()
+                if render_frame:
+                    # debug on screen
+                    self.screen_print_info()
 
-                # display
-                pygame.display.flip()
+                    # display
+                    self.renderer.present()
+
+                self.audio.flush()
 
                 self.frames += 1
                 #print(self.clock.get_fps())
 
-            self.clock.tick(MAX_FPS) # https://python-forum.io/thread-16692.html
+            self.clock.tick(self.paused)
 
 
     def screen_print_info(self):
         # debug text
         if DEBUG_SCREEN:
-            ship_pos = self.myfont.render('Pos: %s %s' % (self.ship_1.xpos, self.ship_1.ypos), False, (255, 255, 255))
-            self.game.window.blit(ship_pos, (DEBUG_TEXT_XPOS + 5, 30))
+            if (self.frames % HUD_FPS_REFRESH) == 0:
+                self.fps_text = 'FPS %d' % self.clock.get_fps()
+
+            for i, (ship, view_rect) in enumerate(zip(self.renderer.ships, self.renderer.view_rects)):
+                x = view_rect.left + DEBUG_TEXT_XPOS + 5
+                y = view_rect.top + 10
+
+                self.hud.draw(self.game.window, (i, 0), 'P%d Lives %d' % (i+1, ship.lives), (x, y))
+                self.hud.draw(self.game.window, (i, 1), 'Pos %d %d' % (ship.xpos, ship.ypos), (x, y + HUD_LINE_HEIGHT))
+                self.hud.draw(self.game.window, (i, 2), 'v %.2f %.2f' % (ship.vx, ship.vy), (x, y + 2*HUD_LINE_HEIGHT))
+                self.hud.draw(self.game.window, (i, 3), 'a %.2f %.2f' % (ship.ax, ship.ay), (x, y + 3*HUD_LINE_HEIGHT))
+                self.hud.draw(self.game.window, (i, 4), 'Angle %d' % ship.angle, (x, y + 4*HUD_LINE_HEIGHT))
+
+                if ship.bot is not None:
+                    self.hud.draw(self.game.window, (i, 5), 'Bot %d / %d frames' % (ship.bot.nb_actions, ship.bot.nb_frames), (x, y + 5*HUD_LINE_HEIGHT))
+
+            x = self.renderer.view_rects[0].left + DEBUG_TEXT_XPOS + 5
+            y = self.renderer.view_rects[0].top + 10 + 6*HUD_LINE_HEIGHT
 
-            ship_va = self.myfont.render('vx=%.2f, vy=%.2f, ax=%.2f, ay=%.2f' % (self.ship_1.vx,self.ship_1.vy, self.ship_1.ax, self.ship_1.ay), False, (255, 255, 255))
-            self.game.window.blit(ship_va, (DEBUG_TEXT_XPOS + 5, 55))
+            self.hud.draw(self.game.window, "frames", 'Frames %d' % self.frames, (x, y))
+            self.hud.draw(self.game.window, "fps", self.fps_text, (x, y + HUD_LINE_HEIGHT))
 
-            ship_angle = self.myfont.render('Angle: %s' % (self.ship_1.angle,), False, (255, 255, 255))
-            self.game.window.blit(ship_angle, (DEBUG_TEXT_XPOS + 5, 80))
+            if self.rollback is not None:
+                self.hud.draw(self.game.window, "rollbacks", 'Rollbacks %d resim %d' % (self.rollback.nb_rollbacks, self.rollback.nb_resimulated), (x, y + 2*HUD_LINE_HEIGHT))
 
-            dt = self.myfont.render('Frames: %s' % (self.frames,), False, (255, 255, 255))
-            self.game.window.blit(dt, (DEBUG_TEXT_XPOS + 5, 105))
+            if self.broadcast is not None:
+                self.hud.draw(self.game.window, "broadcast", 'Spectators %d dropped %d' % (len(self.broadcast.spectators), self.broadcast.nb_dropped), (x, y + 3*HUD_LINE_HEIGHT))
+
+    # snapshot of the simulation (ships, shots, frame counter, rng) as a fixed layout SIM_STATE bytes blob
+    def get_state(self):
+        state = self.sim_state
+
+        state["frames"] = self.frames
+        state["total_dist"] = self.total_dist
+        state["collision"] = self.collision
+
+        shots = state["shots"]
+        nb_shots = state["nb_shots"]
+
+        ships = state["ships"]
+
+        for ship in self.renderer.ships:
+            i = ship.state_index
+            ships[i] = ship.get_state()
+            nb_shots[i] = len(ship.shots)
+
+            for j, shot in enumerate(ship.shots):
+                shots[i, j] = (shot.x, shot.y, shot.xposprecise, shot.yposprecise, shot.dx, shot.dy)
+
+            # the slots of older shots: equal states => equal blobs
+            shots[i, len(ship.shots):] = 0
+
+        _, words, gauss = self.rng.getstate()
+        state["rng"] = np.frombuffer(array.array("I", words), dtype=np.uint32) # faster than from the tuple
+        state["rng_has_gauss"] = gauss is not None
+        state["rng_gauss"] = gauss or 0.
+
+        return state.tobytes()
+
+    # restore a get_state() blob (from this env or any env with the same players)
+    def set_state(self, blob):
+        state = np.frombuffer(blob, dtype=SIM_STATE)[0]
+
+        self.frames = int(state["frames"])
+        self.total_dist = float(state["total_dist"])
+        self.collision = bool(state["collision"])
+
+        ships = state["ships"].tolist()
+
+        for ship in self.renderer.ships:
+            i = ship.state_index
+            ship.set_state(ships[i])
+            ship.shots = []
+
+            for x, y, xposprecise, yposprecise, dx, dy in state["shots"][i, :state["nb_shots"][i]].tolist():
+                shot = Shot()
+                shot.x = x
+                shot.y = y
+                shot.xposprecise = xposprecise
+                shot.yposprecise = yposprecise
+                shot.dx = dx
+                shot.dy = dy
+                ship.shots.append(shot)
+
+            # the sprite only depends on the state
+            if ship.shield:
+                ship.image = ship.ship_pic_shield
+            elif ship.thrust:
+                ship.image = ship.ship_pic_thrust
+            else:
+                ship.image = ship.ship_pic
 
-            fps = self.myfont.render('FPS: %.2f' % self.clock.get_fps(), False, (255, 255, 255))
-            self.game.window.blit(fps, (DEBUG_TEXT_XPOS + 5, 130))
+            ship.update_sprite()
 
-            #ship_lives = self.myfont.render('Lives: %s' % (self.ship_1.lives,), False, (255, 255, 255))
-            #self.game.window.blit(ship_lives, (DEBUG_TEXT_XPOS + 5, 105))
+        gauss = float(state["rng_gauss"]) if state["rng_has_gauss"] else None
+        self.rng.setstate((3, tuple(state["rng"].tolist()), gauss))
 
     # training only
-    def reset(self):
+    def reset(self, start_state=None):
         self.frames = 0
         self.total_dist = 0
         self.done = False
         self.paused = False
         self.ship_1.reset(self)
 
-        #new_state = [angle_norm, vx_norm, vy_norm, ax_norm, ay_norm]
-        #new_state.extend(wall_distances)
+        # craters of the previous episode
+        self.game.restore_terrain()
+
+        self.coverage.clear()
+        self.ship_1.new_cells = 0
+
+        # start from a snapshot (get_state)
+        if start_state is not None:
+            self.set_state(start_state)
+
+        # for the end of episode reward
+        self.start_xpos = self.ship_1.xpos
+        self.start_ypos = self.ship_1.ypos
 
-        #new_state = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
-        new_state = [0.0, 0.0, 0.0, 0.0, 0.0]
-        #new_state = [0.0]
-        wall_distances = [0, 0, 0, 0, 0, 0, 0, 0]
-        new_state.extend(wall_distances)
+        if self.obs_mode == "pixels":
+            return self.pixel_obs.clear()[0]
 
-        return np.array(new_state, dtype=np.float32)
+        return self.obs_spec.clear()
 
     # training only
     def step(self, action, max_frame=2000):
 
         if not self.paused:
-            
-            self.game.window.fill((0,0,0))
+
+            render_frame = self.clock.begin_frame(self.frames)
+
+            if render_frame:
+                self.game.window.fill((0,0,0))
 
             done = False
 
@@ -1167,66 +2139,17 @@ class MayhemEnv():
 
             self.ship_1.step(self, action)
 
-            # https://www.baeldung.com/cs/normalizing-inputs-artificial-neural-network
-            # https://machinelearningmastery.com/how-to-improve-neural-network-stability-and-modeling-performance-with-data-scaling/
-            # min-max: (((x - min) / (max - min)) * (end - start)) + start (typically start=0, end=1)
-
-            NORMALIZE = 1
-
-            # not normalized (8 values for angle=45 degres, 12 for 30 degres etc)
-            wall_distances = [0, 0, 0, 0, 0, 0, 0, 0]
+            # exploration, before the observation which may use it
+            new_cell = self.coverage.visit(self.ship_1.xpos + SHIP_SPRITE_SIZE/2, self.ship_1.ypos + SHIP_SPRITE_SIZE/2)
+            self.ship_1.new_cells = self.coverage.new_cells
 
             if self.sensor == "ray":
-                wall_distances = self.ship_1.ray_sensor(self)
-
-                if NORMALIZE:
-                    for i, dist in enumerate(wall_distances):
-                        #wall_distances[i] = dist / RAY_MAX_LEN # [0, 1]
-                        wall_distances[i] = ((dist / RAY_MAX_LEN)*2) - 1 # [-1, 1]
-
-            # normalized wall_distances in [0, 1] or [-1, 1]
-            #print(wall_distances)
-
-            # normalized ship physic params
-            if NORMALIZE:
-                #angle_norm = self.ship_1.angle / (360. - SHIP_ANGLESTEP)
-                angle_norm = ((self.ship_1.angle / (360. - SHIP_ANGLESTEP)) * 2) - 1
-
-                # vx range = [-5.5, +5.5] (more or less with default phisical values, for "standard playing")
-                # vy range = [-6.5, +8.5] (more or less with default phisical values, for "standard playing")
-                # ax range = [-0.16, +0.16] (more or less with default phisical values, for "standard playing")
-                # vx range = [-0.12, +0.20] (more or less with default phisical values, for "standard playing")
-
-                vx_min = -5.5  ; vx_max = 5.5
-                vy_min = -6.5  ; vy_max = 8.5
-                ax_min = -0.16 ; ax_max = 0.16
-                ay_min = -0.12 ; ay_max = 0.20
-
-                vx_norm = (((self.ship_1.vx - vx_min) / (vx_max - vx_min)) * 2) - 1
-                vy_norm = (((self.ship_1.vy - vy_min) / (vy_max - vy_min)) * 2) - 1
-                ax_norm = (((self.ship_1.ax - ax_min) / (ax_max - ax_min)) * 2) - 1
-                ay_norm = (((self.ship_1.ay - ay_min) / (ay_max - ay_min)) * 2) - 1
+                self.ship_1.ray_sensor(self, render_frame)
 
-            # raw input
+            if self.obs_mode == "pixels":
+                observation = self.pixel_obs.observe((self.ship_1, ))[0]
             else:
-                angle_norm = self.ship_1.angle
-                vy_norm    = self.ship_1.vy
-                vx_norm    = self.ship_1.vx
-                ay_norm    = self.ship_1.ay
-                ax_norm    = self.ship_1.ax
-
-            if self.ship_1.thrust:
-                thrust_on = 1
-            else:
-                thrust_on = -1
-
-            #print(angle_norm)
-            #new_state = [thrust_on, angle_norm, vx_norm, vy_norm, ax_norm, ay_norm]
-            new_state = [angle_norm, vx_norm, vy_norm, ax_norm, ay_norm]
-            #new_state = [angle_norm]
-            new_state.extend(wall_distances)
-
-            #print(new_state)
+                observation = self.obs_spec.observe(self.ship_1)
 
             reward = 1
 
@@ -1239,18 +2162,16 @@ class MayhemEnv():
             else:
                 self.total_dist += d
 
-            collision = False
-            for dist in wall_distances:
-                #if dist == 0:  # if normalized in [0, 1]
-                if dist == -1: # if normalized in [-1, 1]
-                    collision = True
-                    break
+            reward += COVERAGE_REWARD * new_cell
+
+            collision = self.sensor == "ray" and self.ship_1.wall_distances.min() == 0
+            self.collision = collision
 
             done = self.ship_1.explod
             done |= self.frames > max_frame
             done |= collision
 
-            d_end = math.sqrt((self.ship_1.init_xpos - self.ship_1.xpos)**2 + (self.ship_1.init_ypos - self.ship_1.ypos)**2)
+            d_end = math.sqrt((self.start_xpos - self.ship_1.xpos)**2 + (self.start_ypos - self.ship_1.ypos)**2)
 
             if collision or self.ship_1.explod:
                 reward = -1000
@@ -1259,10 +2180,12 @@ class MayhemEnv():
                 reward += self.total_dist
                 reward += d_end*2
 
+            self.audio.flush()
+
             self.frames += 1
             #print(self.total_dist)
 
-            return np.array(new_state, dtype=np.float32), reward, done, {}
+            return observation, reward, done, {}
         else:
             return None, None, None, {}
 
@@ -1284,269 +2207,2600 @@ class MayhemEnv():
 
         if not self.paused:
 
-            # clear screen: done in self.step()
+            # decided in self.step() for this frame
+            render_frame = self.clock.render_frame
 
-            # map copy (TODO reduce)
-            self.game.map_buffer.blit(self.game.map, (0, 0))
+            # clear screen: done in self.step()
 
             # collision (when false we use the sensor to detect a collision)
             if collision_check:
-                self.ship_1.collide_map(self.game.map_buffer, self.game.map_buffer_mask)
-
-            # blit ship in the map
-            self.ship_1.draw(self.game.map_buffer)
-
-            # clipping to avoid black when the ship is close to the edges
-            rx = self.ship_1.xpos - self.ship_1.view_width/2
-            ry = self.ship_1.ypos - self.ship_1.view_height/2
-            if rx < 0:
-                rx = 0
-            elif rx > (MAP_WIDTH - self.ship_1.view_width):
-                rx = (MAP_WIDTH - self.ship_1.view_width)
-            if ry < 0:
-                ry = 0
-            elif ry > (MAP_HEIGHT - self.ship_1.view_height):
-                ry = (MAP_HEIGHT - self.ship_1.view_height)
+                self.ship_1.collide_map(self.game.map_buffer_mask)
 
-            # blit the map area around the ship on the screen
-            sub_area1 = Rect(rx, ry, self.ship_1.view_width, self.ship_1.view_height)
-            self.game.window.blit(self.game.map_buffer, (self.ship_1.view_left, self.ship_1.view_top), sub_area1)
+            if render_frame:
+                # erase last frame ship
+                self.renderer.restore_map()
 
-            # debug on screen
-            self.screen_print_info()
+                # blit ship in the map
+                self.renderer.map_dirty_rects.append(self.ship_1.draw(self.game.map_buffer))
+                self.renderer.draw_views()
 
-            # display
-            pygame.display.flip()
+                # debug on screen
+                self.screen_print_info()
+
+                # display
+                self.renderer.present()
 
             if self.render:
-                self.clock.tick(MAX_FPS)
+                self.clock.tick()
 
 # -------------------------------------------------------------------------------------------------
 # -------------------------------------------------------------------------------------------------
 # -------------------------------------------------------------------------------------------------
 
-class GameWindow():
+# ships sound effects: one dedicated mixer channel per ship and per sound, no mixer polling
+# the ships post play / stop commands, flush() applies them once per frame and only the changes reach the mixer
+class AudioManager():
 
-    def __init__(self, screen_width, screen_height, mode):
+    SOUNDS = { "thrust": SOUND_THURST, "shield": SOUND_SHIELD, "shoot": SOUND_SHOOT, "bounce": SOUND_BOUNCE, "explod": SOUND_EXPLOD }
+    LOOPS  = ("thrust", "shield")
 
-        pygame.display.set_caption('Mayhem')
+    sounds = {} # loaded once, shared by all the envs
 
-        if mode == "training":
-            self.screen_width = 400
-            self.screen_height = 400
+    def __init__(self, nb_ships=MAX_SHIPS, enabled=True):
 
-            self.window = pygame.display.set_mode((self.screen_width, self.screen_height))
-        else:
-            self.screen_width = screen_width
-            self.screen_height = screen_height
+        # no-op without sound output (training, headless)
+        self.enabled = enabled and pygame.mixer.get_init() is not None
 
-            flags = pygame.DOUBLEBUF #| pygame.NOFRAME # | pygame.FULLSCREEN 
-            self.window = pygame.display.set_mode((screen_width, screen_height), flags)
+        self.commands = {}   # (ship, sound) => True = play, False = stop, the last command of the frame wins
+        self.playing = set() # (ship, sound) started and not stopped since
+        self.channels = {}
 
-        # Background
-        self.map = pygame.image.load(MAP_1).convert() # .convert_alpha()
-        #self.map.set_colorkey( (0, 0, 0) ) # used for the mask, black = background
-        #self.map_rect = self.map.get_rect()
-        #self.map_mask = pygame.mask.from_surface(self.map)
-        #self.mask_map_fx = pygame.mask.from_surface(pygame.transform.flip(self.map, True, False))
-        #self.mask_map_fy = pygame.mask.from_surface(pygame.transform.flip(self.map, False, True))
-        #self.mask_map_fx_fy = pygame.mask.from_surface(pygame.transform.flip(self.map, True, True))
-        #self.flipped_masks = [[self.map_mask, self.mask_map_fy], [self.mask_map_fx, self.mask_map_fx_fy]]
+        if not self.enabled:
+            return
 
-        self.map_buffer = self.map.copy() # pygame.Surface((self.map.get_width(), self.map.get_height()))
+        if not AudioManager.sounds:
+            for name, path in self.SOUNDS.items():
+                AudioManager.sounds[name] = pygame.mixer.Sound(path)
 
-        self.map_buffer.set_colorkey( (0, 0, 0) )
-        self.map_buffer_mask = pygame.mask.from_surface(self.map_buffer)
-        self.mask_map_buffer_fx = pygame.mask.from_surface(pygame.transform.flip(self.map_buffer, True, False))
-        self.mask_map_buffer_fy = pygame.mask.from_surface(pygame.transform.flip(self.map_buffer, False, True))
-        self.mask_map_buffer_fx_fy = pygame.mask.from_surface(pygame.transform.flip(self.map_buffer, True, True))
-        self.flipped_masks_map_buffer = [[self.map_buffer_mask, self.mask_map_buffer_fy], [self.mask_map_buffer_fx, self.mask_map_buffer_fx_fy]]
+        # reserved: never picked by Sound.play()
+        nb_channels = nb_ships * len(self.SOUNDS)
+        pygame.mixer.set_num_channels(max(pygame.mixer.get_num_channels(), nb_channels))
+        pygame.mixer.set_reserved(nb_channels)
+
+        for ship in range(nb_ships):
+            for i, name in enumerate(self.SOUNDS):
+                self.channels[(ship, name)] = pygame.mixer.Channel(ship * len(self.SOUNDS) + i)
+
+    def play(self, ship, name):
+        if self.enabled:
+            self.commands[(ship, name)] = True
+
+    def stop(self, ship, name):
+        if self.enabled:
+            self.commands[(ship, name)] = False
+
+    def stop_all(self, ship):
+        for name in self.SOUNDS:
+            self.stop(ship, name)
+
+    def flush(self):
+        for key, play in self.commands.items():
+            if play:
+                # loops: already playing
+                if key in self.playing and key[1] in self.LOOPS:
+                    continue
+
+                self.channels[key].play(self.sounds[key[1]], loops=-1 if key[1] in self.LOOPS else 0)
+                self.playing.add(key)
+
+            elif key in self.playing:
+                self.channels[key].stop()
+                self.playing.discard(key)
+
+        self.commands.clear()
 
 # -------------------------------------------------------------------------------------------------
 # -------------------------------------------------------------------------------------------------
 # -------------------------------------------------------------------------------------------------
 
-class CustomNeatReporter(neat.reporting.BaseReporter):
+class Hud():
+
+    # shared by all the envs (one env per genome in training): the font file is loaded once
+    font = None
+    glyphs = {}
+    glyph_size = (0, 0)
 
     def __init__(self):
-        self.generation = None
 
-    def start_generation(self, generation):
-        self.generation = generation
+        if Hud.font is None:
+            Hud.font = pygame.font.Font(HUD_FONT, HUD_FONT_SIZE)
+            Hud.glyph_size = Hud.font.size("0") # monospaced font
 
-    def post_evaluate(self, config, population, species, best_genome):
-        if best_genome.fitness > 1000:
-            now = dt.datetime.now()
-            net_name = f"gen{self.generation}_{best_genome.fitness}_{now.hour}h{now.minute}m{now.second}s"
+        # key -> [text, surface], a line surface is only rebuilt when its text changes
+        self.lines = {}
 
-            with open(net_name, 'wb') as f:
-                pickle.dump(best_genome, f)
+    def glyph(self, c):
+        try:
+            return Hud.glyphs[c]
+        except KeyError:
+            g = Hud.font.render(c, False, WHITE, (0, 0, 0))
+            Hud.glyphs[c] = g
+            return g
 
-            print(f"=> Dumped genome with fitness={best_genome.fitness} : {net_name}")
+    def line(self, key, text):
+        cached = self.lines.get(key)
 
-# -------------------------------------------------------------------------------------------------
+        if cached is not None and cached[0] == text:
+            return cached[1]
 
-class NeatTraining():
+        gw, gh = Hud.glyph_size
+        width = max(1, gw * len(text))
 
-    def __init__(self, runs_per_net, max_gen, multi):
+        if cached is not None and cached[1].get_width() == width:
+            surface = cached[1]
+        else:
+            surface = pygame.Surface((width, gh)).convert()
+            surface.set_colorkey( (0, 0, 0) )
 
-        self.runs_per_net = runs_per_net
-        self.max_gen = max_gen
-        self.multi = multi
+        # the font is monospaced: a line is just a row of cached glyphs
+        surface.fill((0, 0, 0))
+        for i, c in enumerate(text):
+            surface.blit(self.glyph(c), (i * gw, 0))
 
-    def render_loaded_genome(self, g):
-        config = neat.Config( neat.DefaultGenome, neat.DefaultReproduction,
-                              neat.DefaultSpeciesSet, neat.DefaultStagnation,
-                              os.path.join(os.getcwd(), 'config') )
+        self.lines[key] = [text, surface]
 
-        net = neat.nn.RecurrentNetwork.create(g, config)
-        #net = neat.nn.FeedForwardNetwork.create(g, config)
+        return surface
 
-        neat_env = MayhemEnv(game_window, False, 1, mode="training", motion="gravity", sensor="ray", record_play="", play_recorded="")
-        observation = neat_env.reset()
+    def draw(self, surface, key, text, pos):
+        surface.blit(self.line(key, text), pos)
 
-        done = False
-        while not done:
-            action = net.activate(observation)
-            #action = np.argmax(net.activate(observation))
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
 
-            observation, reward, done, info = neat_env.step(action, max_frame=20000)
-            neat_env.display(collision_check=False)
+# player view of the level: its top left corner in the level (clamped to the level) and its scale,
+# updated once per rendered frame by follow(), read by the renderer and the ray sensor drawing
+class Camera():
 
-    def load_net(self, net_name=None):
+    def __init__(self, view_left, view_top, view_width, view_height, zoom=CAMERA_ZOOM, follow=CAMERA_FOLLOW):
 
-        if not net_name:
-            file_list = [ x for x in os.listdir(os.getcwd()) if os.path.isfile(os.path.join(os.getcwd(), x)) and x.startswith("gen") ]
+        # the view in the window
+        self.view_left = view_left
+        self.view_top = view_top
 
-            for fname in file_list:
-                with open(fname, 'rb') as f:
-                    g = pickle.load(f)
+        # zoomed out: no more than the whole level
+        if zoom < 1:
+            zoom = min(max(zoom, view_width / MAP_WIDTH, view_height / MAP_HEIGHT), 1)
 
-                print('Loaded genome:')
-                print(g)
+        self.zoom = zoom
+        self.follow_rate = follow
 
-                self.render_loaded_genome(g)
-                time.sleep(1)
+        # level area shown
+        self.width = view_width / zoom
+        self.height = view_height / zoom
 
-        with open(net_name, 'rb') as f:
-            g = pickle.load(f)
+        self.left = 0.
+        self.top = 0.
+        self.following = False # the first follow() jumps to the ship
 
-        print('Loaded genome:')
-        print(g)
+    # ship at the center of the view, or closer to it (smooth scrolling), but never outside the level
+    def follow(self, xpos, ypos):
+        x = xpos - self.width/2
+        y = ypos - self.height/2
 
-        self.render_loaded_genome(g)
+        if self.following and self.follow_rate < 1:
+            x = self.left + (x - self.left) * self.follow_rate
+            y = self.top + (y - self.top) * self.follow_rate
 
-    def train_it(self):
-        local_dir = os.path.dirname(__file__)
-        config_path = os.path.join(local_dir, 'config')
+        self.following = True
 
-        config = neat.Config(neat.DefaultGenome, neat.DefaultReproduction,
-                             neat.DefaultSpeciesSet, neat.DefaultStagnation,
-                             config_path)
+        # clipping to avoid black when the ship is close to the edges
+        if x < 0:
+            x = 0
+        elif x > (MAP_WIDTH - self.width):
+            x = (MAP_WIDTH - self.width)
+        if y < 0:
+            y = 0
+        elif y > (MAP_HEIGHT - self.height):
+            y = (MAP_HEIGHT - self.height)
 
-        pop = neat.Population(config)
-        stats = neat.StatisticsReporter()
+        self.left = x
+        self.top = y
 
-        pop.add_reporter(stats)
-        pop.add_reporter(neat.StdOutReporter(True))
-        pop.add_reporter(CustomNeatReporter())
+    # level => window coordinates
+    def to_window(self, x, y):
+        return ((x - self.left) * self.zoom + self.view_left, (y - self.top) * self.zoom + self.view_top)
 
-        if self.multi:
-            pe = neat.ParallelEvaluator(multiprocessing.cpu_count(), self.eval_genome)
-            winner = pop.run(pe.evaluate, self.max_gen)
-        else:
-            if 0:
-                pe = neat.ParallelEvaluator(1, self.eval_genome)
-                winner = pop.run(pe.evaluate, self.max_gen)
-            else:
-                winner = pop.run(self.eval_genomes, self.max_gen)
+# -------------------------------------------------------------------------------------------------
 
-        # Save the winner.
-        with open('winner', 'wb') as f:
-            pickle.dump(winner, f)
+# whole level overview: the level scaled once (and again after a terrain change, see GameWindow.carve),
+# the ships and their camera areas drawn over it every frame
+class Minimap():
 
-        print(winner)
+    def __init__(self, game, pos, scale=MINIMAP_SCALE):
 
-    def eval_genome(self, genome, config):
-        #for i, g in enumerate(genome):
-        #    print(i, g)
+        self.game = game
+        self.scale = scale
+        self.rect = Rect(pos, (int(MAP_WIDTH * scale), int(MAP_HEIGHT * scale)))
 
-        net = neat.nn.RecurrentNetwork.create(genome, config)
-        #net = neat.nn.FeedForwardNetwork.create(genome, config)
+        self.level = None
+        self.terrain_version = -1
+        self.craters = None   # game.craters when self.level was scaled
+        self.nb_craters = 0   # already patched in self.level
 
-        fitnesses = []
+    # scaled once, then only the new craters areas (like SplitScreenRenderer.zoomed_level)
+    def update_level(self):
+        if self.craters is not self.game.craters:
+            self.level = pygame.transform.smoothscale(self.game.map, self.rect.size)
+            self.craters = self.game.craters
 
-        for runs in range(self.runs_per_net):
+        else:
+            s = self.scale
 
-            neat_env = MayhemEnv(game_window, False, 1, mode="training", motion="gravity", sensor="ray", record_play="", play_recorded="")
-            observation = neat_env.reset()
+            for crater in self.craters[self.nb_craters:]:
+                # whole minimap pixels: the same averaged area as the full scaling
+                left, top = int(crater.left * s), int(crater.top * s)
+                right = min(int(np.ceil(crater.right * s)), self.rect.width)
+                bottom = min(int(np.ceil(crater.bottom * s)), self.rect.height)
+                left, top = max(left, 0), max(top, 0)
 
-            fitness = 0.0
-            done = False
-            while not done:
+                if left < right and top < bottom:
+                    area = Rect(int(left / s), int(top / s), 0, 0)
+                    area.width = min(int(right / s), MAP_WIDTH) - area.left
+                    area.height = min(int(bottom / s), MAP_HEIGHT) - area.top
+                    self.level.blit(pygame.transform.smoothscale(self.game.map.subsurface(area), (right - left, bottom - top)), (left, top))
 
-                #action = np.argmax(net.activate(observation))
-                action = net.activate(observation) # [-1.0, -0.17934807670239852, 1.0, -0.3551236740213184]
-                #print(action)
-                observation, reward, done, info = neat_env.step(action, max_frame=4000)
-                
-                if not self.multi:
-                    neat_env.display(collision_check=False)
+        self.nb_craters = len(self.craters)
+        self.terrain_version = self.game.terrain_version
 
-                #print(observation)
+    def draw(self, surface, ships):
+        if self.terrain_version != self.game.terrain_version:
+            self.update_level()
 
-                fitness += reward
-                #print(fitness)
+        surface.blit(self.level, self.rect)
 
-                # dump network
-                for event in pygame.event.get():
-                    if event.type == pygame.KEYDOWN:
-                        if event.key == pygame.K_d:
-                            now = dt.datetime.now()
-                            net_name = f"gen_{genome.fitness}_{now.hour}h{now.minute}m{now.second}s"
-                            with open(net_name, 'wb') as f:
-                                pickle.dump(genome, f)
-                            print("Dumped ", net_name)
+        s = self.scale
+        left, top = self.rect.topleft
 
+        for ship in ships:
+            camera = ship.camera
+            pygame.draw.rect(surface, LVIOLET, (left + camera.left * s, top + camera.top * s, camera.width * s, camera.height * s), 1)
 
-            fitnesses.append(fitness)
+            x = left + int((ship.xpos + SHIP_SPRITE_SIZE/2) * s)
+            y = top + int((ship.ypos + SHIP_SPRITE_SIZE/2) * s)
+            surface.fill(WHITE, (x - 1, y - 1, 3, 3))
 
+# -------------------------------------------------------------------------------------------------
 
-        mean_fit = np.mean(fitnesses)
-        print(mean_fit)
+class SplitScreenRenderer():
 
-        return mean_fit
+    def __init__(self, game, ships, dividers=True, zoom=CAMERA_ZOOM, follow=CAMERA_FOLLOW, minimap=False):
 
-    def eval_genomes(self, genomes, config):
-        for genome_id, genome in genomes:
-            genome.fitness = self.eval_genome(genome, config)
+        self.game = game
+        self.ships = ships
 
-# -------------------------------------------------------------------------------------------------
-# -------------------------------------------------------------------------------------------------
-# -------------------------------------------------------------------------------------------------
+        sw = self.game.screen_width
+        sh = self.game.screen_height
 
-def run():
-    pygame.mixer.pre_init(frequency=22050)
-    pygame.init()
-    #pygame.display.init()
+        # static HUD: drawn once, never part of the per frame updates
+        self.dividers = []
+        if dividers:
+            self.dividers = [ ((0, int(sh/2)), (sw, int(sh/2))), ((int(sw/2), 0), (int(sw/2), sh)) ]
 
-    pygame.mouse.set_visible(False)
-    pygame.font.init()
-    pygame.mixer.init() # frequency=22050
+        # player views, minus the divider lines overlapping them
+        self.view_rects = []
 
-    #pygame.event.set_blocked((MOUSEMOTION, MOUSEBUTTONUP, MOUSEBUTTONDOWN))
+        for ship in self.ships:
+            rect = Rect(ship.view_left, ship.view_top, ship.view_width, ship.view_height)
 
-    # joystick
-    pygame.joystick.init()
-    joystick_count = pygame.joystick.get_count()
-    print("joystick_count", joystick_count)
+            for (x0, y0), (x1, y1) in self.dividers:
+                if y0 == y1:
+                    if rect.top == y0:
+                        rect.top += 1
+                        rect.height -= 1
+                    elif rect.bottom - 1 == y0:
+                        rect.height -= 1
+                else:
+                    if rect.left == x0:
+                        rect.left += 1
+                        rect.width -= 1
+                    elif rect.right - 1 == x0:
+                        rect.width -= 1
 
-    for i in range(joystick_count):
-        j = pygame.joystick.Joystick(i)
-        j.init()
+            self.view_rects.append(rect)
 
-    # options
-    parser = argparse.ArgumentParser()
+        # at the center of the split screen, top right corner of a single view
+        self.minimap = None
+        if minimap:
+            size = (int(MAP_WIDTH * MINIMAP_SCALE), int(MAP_HEIGHT * MINIMAP_SCALE))
+            pos = ((sw - size[0]) // 2, (sh - size[1]) // 2) if dividers else (sw - size[0], 0)
+            self.minimap = Minimap(self.game, pos)
+
+        # updated areas of the display: the views, and the minimap over them (and over the dividers)
+        self.update_rects = self.view_rects + ([self.minimap.rect] if self.minimap is not None else [])
+
+        # lower resolution render target: views are upscaled into the display rect by rect
+        self.scaled = self.game.window is not self.game.display
+
+        if self.scaled:
+            fx = self.game.display.get_width() / sw
+            fy = self.game.display.get_height() / sh
+
+            self.display_rects = []
+            self.scale_pairs = []
+
+            for rect in self.update_rects:
+                drect = Rect(int(rect.left * fx), int(rect.top * fy), 0, 0)
+                drect.width  = int(rect.right * fx) - drect.left
+                drect.height = int(rect.bottom * fy) - drect.top
+
+                self.display_rects.append(drect)
+                self.scale_pairs.append( (self.game.window.subsurface(rect), self.game.display.subsurface(drect)) )
+        else:
+            self.display_rects = self.update_rects
+
+        # areas drawn in the map buffer (ships, shots), the whole map at first as the buffer is shared between envs
+        self.map_dirty_rects = [self.game.map.get_rect()]
+
+        # cameras with the renderer settings, the zoomed views are drawn into these window subsurfaces
+        self.zoom_targets = []
+
+        # zoom => [terrain_version, level scaled once, craters, nb craters scaled], the ships and shots are drawn
+        # over it at the zoomed positions
+        self.zoomed_levels = {}
+
+        for ship, rect in zip(self.ships, self.view_rects):
+            ship.camera = Camera(ship.view_left, ship.view_top, ship.view_width, ship.view_height, zoom, follow)
+            self.zoom_targets.append(self.game.window.subsurface(rect) if ship.camera.zoom != 1 else None)
+
+        self.full_update = True
+
+    # next present() redraws and updates the whole display (first frame, window exposed...)
+    def invalidate(self):
+        self.full_update = True
+
+    # instead of a full map copy, only restore what has been drawn over it in the last frame
+    def restore_map(self):
+        for rect in self.map_dirty_rects:
+            self.game.map_buffer.blit(self.game.map, rect, rect)
+
+        del self.map_dirty_rects[:]
+
+    # the level (without ships and shots) at this zoom: scaled once, then only the new craters areas
+    def zoomed_level(self, zoom):
+        zoomed = self.zoomed_levels.get(zoom)
+
+        if zoomed is None or zoomed[2] is not self.game.craters:
+            size = (int(np.ceil(MAP_WIDTH * zoom)), int(np.ceil(MAP_HEIGHT * zoom)))
+            zoomed = [self.game.terrain_version, pygame.transform.scale(self.game.map, size), self.game.craters, len(self.game.craters)]
+            self.zoomed_levels[zoom] = zoomed
+
+        elif zoomed[0] != self.game.terrain_version:
+            level = zoomed[1]
+            map_rect = self.game.map.get_rect()
+
+            for crater in self.game.craters[zoomed[3]:]:
+                area = crater.inflate(2, 2).clip(map_rect)
+                if area.width and area.height:
+                    left, top = round(area.left * zoom), round(area.top * zoom)
+                    size = (round(area.right * zoom) - left, round(area.bottom * zoom) - top)
+                    level.blit(pygame.transform.scale(self.game.map.subsurface(area), size), (left, top))
+
+            zoomed[0] = self.game.terrain_version
+            zoomed[3] = len(self.game.craters)
+
+        return zoomed[1]
+
+    def draw_views(self):
+        zoomed_ships = {} # zoom => ship sprites scaled once per frame for all the views
+
+        for ship, rect, target in zip(self.ships, self.view_rects, self.zoom_targets):
+            camera = ship.camera
+            camera.follow(ship.xpos, ship.ypos)
+
+            # rect is the view minus the dividers
+            x = rect.left - camera.view_left
+            y = rect.top - camera.view_top
+
+            # blit the map area around the ship on the screen
+            if target is None:
+                sub_area = Rect(camera.left + x, camera.top + y, rect.width, rect.height)
+                self.game.window.blit(self.game.map_buffer, rect, sub_area)
+
+            # or the same area of the zoomed level, then the ships and shots
+            else:
+                z = camera.zoom
+                left = int(camera.left * z + x)
+                top = int(camera.top * z + y)
+
+                target.blit(self.zoomed_level(z), (0, 0), Rect(left, top, rect.width, rect.height))
+
+                if z not in zoomed_ships:
+                    zoomed_ships[z] = [ pygame.transform.scale(s.image_rotated, (round(s.image_rotated.get_width() * z), round(s.image_rotated.get_height() * z)))
+                                        for s in self.ships ]
+
+                radius = max(1, round(z))
+
+                for s, image in zip(self.ships, zoomed_ships[z]):
+                    for shot in s.shots:
+                        pygame.draw.circle(target, WHITE, (int(int(shot.x) * z) - left, int(int(shot.y) * z) - top), radius)
+
+                for s, image in zip(self.ships, zoomed_ships[z]):
+                    target.blit(image, (int((s.xpos + s.rot_xoffset) * z) - left, int((s.ypos + s.rot_yoffset) * z) - top))
+
+        if self.minimap is not None:
+            self.minimap.draw(self.game.window, self.ships)
+
+    def present(self):
+
+        if self.full_update:
+            self.full_update = False
+
+            cv = (225, 225, 225)
+            for p0, p1 in self.dividers:
+                pygame.draw.line(self.game.window, cv, p0, p1)
+
+            if self.scaled:
+                pygame.transform.scale(self.game.window, self.game.display.get_size(), self.game.display)
+
+            pygame.display.flip()
+            return
+
+        if self.scaled:
+            for src, dst in self.scale_pairs:
+                pygame.transform.scale(src, dst.get_size(), dst)
+
+        # only the player views (and the minimap) have changed
+        pygame.display.update(self.display_rects)
+
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+
+class GameWindow():
+
+    def __init__(self, screen_width, screen_height, mode, render_scale=RENDER_SCALE):
+
+        pygame.display.set_caption('Mayhem')
+
+        if mode in ("training", "analytics"):
+            self.screen_width = 400
+            self.screen_height = 400
+
+            self.window = pygame.display.set_mode((self.screen_width, self.screen_height))
+            self.display = self.window
+        else:
+            flags = pygame.DOUBLEBUF #| pygame.NOFRAME # | pygame.FULLSCREEN 
+            self.display = pygame.display.set_mode((screen_width, screen_height), flags)
+
+            # everything is drawn in window, which is upscaled to the display if smaller
+            if render_scale != 1.0:
+                self.screen_width = int(screen_width * render_scale)
+                self.screen_height = int(screen_height * render_scale)
+                self.window = pygame.Surface((self.screen_width, self.screen_height)).convert()
+            else:
+                self.screen_width = screen_width
+                self.screen_height = screen_height
+                self.window = self.display
+
+        # Background
+        self.map = pygame.image.load(MAP_1).convert() # .convert_alpha()
+        #self.map.set_colorkey( (0, 0, 0) ) # used for the mask, black = background
+        #self.map_rect = self.map.get_rect()
+        #self.map_mask = pygame.mask.from_surface(self.map)
+        #self.mask_map_fx = pygame.mask.from_surface(pygame.transform.flip(self.map, True, False))
+        #self.mask_map_fy = pygame.mask.from_surface(pygame.transform.flip(self.map, False, True))
+        #self.mask_map_fx_fy = pygame.mask.from_surface(pygame.transform.flip(self.map, True, True))
+        #self.flipped_masks = [[self.map_mask, self.mask_map_fy], [self.mask_map_fx, self.mask_map_fx_fy]]
+
+        self.map_buffer = self.map.copy() # pygame.Surface((self.map.get_width(), self.map.get_height()))
+
+        # (y, x) palette indexes of the level, for the pixel observations
+        self.map_index = np.ascontiguousarray(pygame.surfarray.array2d(pygame.image.load(MAP_1)).T)
+
+        self.map_buffer.set_colorkey( (0, 0, 0) )
+        self.map_buffer_mask = pygame.mask.from_surface(self.map_buffer)
+        self.mask_map_buffer_fx = pygame.mask.from_surface(pygame.transform.flip(self.map_buffer, True, False))
+        self.mask_map_buffer_fy = pygame.mask.from_surface(pygame.transform.flip(self.map_buffer, False, True))
+        self.mask_map_buffer_fx_fy = pygame.mask.from_surface(pygame.transform.flip(self.map_buffer, True, True))
+        self.flipped_masks_map_buffer = [[self.map_buffer_mask, self.mask_map_buffer_fy], [self.mask_map_buffer_fx, self.mask_map_buffer_fx_fy]]
+
+        build_ray_masks()
+
+        # masks are built: the player views are blitted opaque so the window never needs to be cleared
+        self.map_buffer.set_colorkey(None)
+
+        # crater (destructible terrain): disc mask, black disc surface, disc as a (y, x) array
+        d = 2*CRATER_RADIUS + 1
+        self.crater_disc = np.add.outer((np.arange(d) - CRATER_RADIUS)**2, (np.arange(d) - CRATER_RADIUS)**2) <= CRATER_RADIUS * (CRATER_RADIUS + 1)
+
+        self.crater_mask = pygame.mask.Mask((d, d))
+        for y, x in zip(*np.nonzero(self.crater_disc)):
+            self.crater_mask.set_at((int(x), int(y)))
+
+        self.crater = self.crater_mask.to_surface(setcolor=(0, 0, 0, 255), unsetcolor=(0, 0, 0, 0))
+
+        self.terrain_version = 0 # + 1 per carve() / restore_terrain()
+        self.pristine = None     # level before the first carve(), see restore_terrain()
+        self.craters = []        # carve() areas since the level was loaded or restored (a new list then)
+
+    # remove the terrain around (x, y): level surfaces, collision / sensor masks and palette indexes, in the crater area only
+    def carve(self, x, y):
+        if self.pristine is None:
+            self.pristine = (self.map.copy(), self.map_buffer_mask.copy(), self.mask_map_buffer_fx.copy(),
+                             self.mask_map_buffer_fy.copy(), self.mask_map_buffer_fx_fy.copy(), self.map_index.copy())
+
+        r = CRATER_RADIUS
+        left, top = x - r, y - r
+
+        # the disc is symmetric: same mask in the flipped masks, at the flipped position
+        fx_left = MAP_WIDTH - 1 - x - r
+        fy_top = MAP_HEIGHT - 1 - y - r
+
+        self.map_buffer_mask.erase(self.crater_mask, (left, top))
+        self.mask_map_buffer_fx.erase(self.crater_mask, (fx_left, top))
+        self.mask_map_buffer_fy.erase(self.crater_mask, (left, fy_top))
+        self.mask_map_buffer_fx_fy.erase(self.crater_mask, (fx_left, fy_top))
+
+        self.map.blit(self.crater, (left, top))
+        self.map_buffer.blit(self.crater, (left, top))
+        self.craters.append(Rect(left, top, 2*r + 1, 2*r + 1))
+        self.terrain_version += 1
+
+        # palette index 0 = black (background)
+        x0, x1 = max(left, 0), min(left + 2*r + 1, MAP_WIDTH)
+        y0, y1 = max(top, 0), min(top + 2*r + 1, MAP_HEIGHT)
+
+        if x0 < x1 and y0 < y1:
+            self.map_index[y0:y1, x0:x1][self.crater_disc[y0-top:y1-top, x0-left:x1-left]] = 0
+
+    # the level as loaded (new game), in place: the masks are referenced by the envs and flipped_masks_map_buffer
+    def restore_terrain(self):
+        if self.pristine is None:
+            return
+
+        level, mask, mask_fx, mask_fy, mask_fx_fy, index = self.pristine
+
+        self.map.blit(level, (0, 0))
+        self.map_buffer.blit(level, (0, 0))
+
+        for dest, src in ((self.map_buffer_mask, mask), (self.mask_map_buffer_fx, mask_fx),
+                          (self.mask_map_buffer_fy, mask_fy), (self.mask_map_buffer_fx_fy, mask_fx_fy)):
+            dest.clear()
+            dest.draw(src, (0, 0))
+
+        self.map_index[:] = index
+
+        self.pristine = None
+        self.craters = []
+        self.terrain_version += 1
+
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+
+# Gym / Gymnasium API on top of the training env:
+#
+# env = MayhemGymEnv(render_mode=None) # headless
+# observation, info = env.reset(seed=0)
+# observation, reward, terminated, truncated, info = env.step(env.action_space.sample())
+#
+# the observation is a view on a preallocated buffer, overwritten by the next step() / reset(): copy it to keep it
+# (or use copy_obs=True, which is also what gymnasium env_checker expects)
+#
+# the ship starts at one of the START_POSITIONS drawn with the reset() seed (random_start=False: always the same)
+
+class MayhemGymEnv(gym.Env if GYM_FOUND else object):
+
+    metadata = {"render_modes": ["human", "rgb_array"], "render_fps": MAX_FPS}
+
+    def __init__(self, render_mode=None, motion="gravity", sensor="ray", max_frame=2000, obs_normalizer=None, copy_obs=False, obs_mode="vector", \
+                 random_start=True):
+
+        self.render_mode = render_mode
+        self.max_frame = max_frame
+        self.copy_obs = copy_obs
+
+        # no window / sound device needed when nothing is rendered
+        if render_mode is None and not pygame.display.get_init():
+            os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+            os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+        if not pygame.get_init():
+            pygame.init()
+            pygame.font.init()
+            pygame.mixer.init()
+
+        self.game = GameWindow(400, 400, "training")
+        # random_start: the reset(seed=...) start position
+        self.env = MayhemEnv(self.game, False, 1, mode="training", motion=motion, sensor=sensor, obs_normalizer=obs_normalizer, obs_mode=obs_mode, \
+                             random_start=random_start)
+
+        if GYM_FOUND:
+            if obs_mode == "pixels":
+                self.observation_space = gym.spaces.Box(0, 255, shape=self.env.pixel_obs.shape, dtype=np.uint8)
+            else:
+                # [-1, 1] with the "minmax" normalization is not guaranteed (ranges are approximations)
+                self.observation_space = gym.spaces.Box(-np.inf, np.inf, shape=(self.env.obs_spec.size,), dtype=np.float32)
+
+            # action[0]: < -0.33 left, > 0.33 right, action[1]: <= 0 thrust (see Ship.step())
+            self.action_space = gym.spaces.Box(-1., 1., shape=(2,), dtype=np.float32)
+
+    def reset(self, seed=None, options=None):
+        if GYM_FOUND:
+            super().reset(seed=seed)
+
+        if seed is not None:
+            self.env.rng.seed(seed)
+
+        observation = self.env.reset((options or {}).get("start_state"))
+
+        if self.render_mode == "human":
+            self.env.clock.begin_frame(self.env.frames)
+            self.env.display(collision_check=False)
+
+        if self.copy_obs:
+            observation = observation.copy()
+
+        return observation, {}
+
+    def step(self, action):
+
+        # paused from the window (human only)
+        while self.env.paused:
+            self.env.display(collision_check=False)
+            pygame.time.wait(10)
+
+        observation, reward, done, info = self.env.step(action, max_frame=self.max_frame)
+
+        terminated = bool(self.env.ship_1.explod or self.env.collision)
+        truncated = bool(done) and not terminated
+
+        if self.render_mode == "human":
+            self.env.display(collision_check=False)
+
+        if self.copy_obs:
+            observation = observation.copy()
+
+        return observation, reward, terminated, truncated, info
+
+    def render(self):
+        if self.render_mode == "rgb_array":
+            self.env.clock.render_frame = True
+            self.env.display(collision_check=False)
+
+            return pygame.surfarray.array3d(self.game.window).swapaxes(0, 1)
+
+if GYM_FOUND:
+    gym.register(id="Mayhem-v0", entry_point="mayhem:MayhemGymEnv")
+
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+
+# 2 to 4 ships played by different agents in the same map (self-play training), no respawn: an agent is out
+# when its ship explodes. Per agent rewards: moving (as in the single agent training), killing with a shot, surviving
+#
+# env = SelfPlayEnv(2) # or SelfPlayEnv.shared(2)
+# observations = env.reset()
+# observations, rewards, dones, done = env.step(actions) # one action per agent, ignored for the agents which are out
+
+class SelfPlayEnv():
+
+    envs = {} # nb ships => env, see shared()
+
+    def __init__(self, nb_ships=SELFPLAY_SHIPS, max_frames=SELFPLAY_MAX_FRAMES, render_every=RENDER_EVERY, display_fps=DISPLAY_FPS, \
+                 obs_normalizer=None, obs_collector=None):
+
+        self.nb_ships = nb_ships
+        self.max_frames = max_frames
+
+        # game mode: one view per ship, game start positions, landing
+        self.env = MayhemEnv(game_window, False, nb_ships, mode="game", motion="gravity", sensor="ray", \
+                             render_every=render_every, display_fps=display_fps)
+        self.ships = self.env.ships
+
+        self.obs_specs = [ ObservationSpec(normalizer=obs_normalizer, collector=obs_collector) for ship in self.ships ]
+
+        # level cells visited in the match, per ship ("new_cells" observation, as MayhemEnv.step)
+        self.coverages = [ CoverageGrid() for ship in self.ships ]
+
+        # every match starts from the same snapshot
+        self.start_state = self.env.get_state()
+
+        self.rewards = np.zeros(nb_ships)
+        self.dones = [False] * nb_ships
+        self.observations = [None] * nb_ships
+
+    # built once per process and reused by all the matches
+    @classmethod
+    def shared(cls, nb_ships, render_every=RENDER_EVERY, display_fps=DISPLAY_FPS):
+        if nb_ships not in cls.envs:
+            cls.envs[nb_ships] = cls(nb_ships, render_every=render_every, display_fps=display_fps)
+        return cls.envs[nb_ships]
+
+    def reset(self):
+        self.env.set_state(self.start_state)
+
+        self.rewards.fill(0.)
+        self.dones = [False] * self.nb_ships
+
+        for ship, coverage in zip(self.ships, self.coverages):
+            coverage.clear()
+            ship.new_cells = 0
+
+        self.observations = [ obs_spec.clear() for obs_spec in self.obs_specs ]
+
+        return self.observations
+
+    def step(self, actions):
+        env = self.env
+        map_mask = env.game.map_buffer_mask
+
+        alive = [ i for i in range(self.nb_ships) if not self.dones[i] ]
+        ships = [ self.ships[i] for i in alive ]
+
+        self.rewards.fill(0.)
+
+        old_pos = [ (ship.xposprecise, ship.yposprecise) for ship in ships ]
+
+        for i, ship in zip(alive, ships):
+            ship.do_move(env, *action_to_pressed(actions[i]))
+
+        # as MayhemEnv.sim_step, between the ships still in the match, the shots are credited to their ship
+        for ship in ships:
+            ship.collide_map(map_mask)
+
+        for ship in ships:
+            ship.collide_ship(ships)
+
+        for ship in ships:
+            ship.move_shots(map_mask)
+
+        for i, ship in zip(alive, ships):
+            exploded = sum(s.explod for s in ships)
+            ship.collide_shots(ships)
+            self.rewards[i] += SELFPLAY_KILL_REWARD * (sum(s.explod for s in ships) - exploded)
+
+        for i, ship, (old_xpos, old_ypos) in zip(alive, ships, old_pos):
+
+            if ship.explod:
+                self.rewards[i] += SELFPLAY_DEATH_REWARD
+                self.dones[i] = True
+                self.observations[i] = None
+                continue
+
+            # do not move ?
+            if math.sqrt((old_xpos - ship.xposprecise)**2 + (old_ypos - ship.yposprecise)**2) >= 1.0:
+                self.rewards[i] += 1
+
+            self.coverages[i].visit(ship.xpos + SHIP_SPRITE_SIZE/2, ship.ypos + SHIP_SPRITE_SIZE/2)
+            ship.new_cells = self.coverages[i].new_cells
+
+            ship.ray_sensor(env, render=False)
+            self.observations[i] = self.obs_specs[i].observe(ship)
+
+        env.audio.flush()
+        env.frames += 1
+
+        # last ship in the match, or time out
+        alive = [ i for i in range(self.nb_ships) if not self.dones[i] ]
+        done = len(alive) <= 1 or env.frames >= self.max_frames
+
+        if done:
+            for i in alive:
+                self.rewards[i] += SELFPLAY_SURVIVE_REWARD
+                self.dones[i] = True
+
+        return self.observations, self.rewards, self.dones, done
+
+    def display(self):
+        env = self.env
+
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
+                sys.exit(0)
+
+        if not env.clock.begin_frame(env.frames):
+            return
+
+        env.renderer.restore_map()
+
+        for ship, done in zip(self.ships, self.dones):
+            if not done:
+                ship.draw_shots(env.game.map_buffer, env.renderer.map_dirty_rects)
+                env.renderer.map_dirty_rects.append(ship.draw(env.game.map_buffer))
+
+        env.renderer.draw_views()
+        env.screen_print_info()
+        env.renderer.present()
+
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+
+class CustomNeatReporter(neat.reporting.BaseReporter if NEAT_FOUND else object):
+
+    def __init__(self, obs_normalizer=None):
+        self.generation = None
+        self.obs_normalizer = obs_normalizer
+
+    def start_generation(self, generation):
+        self.generation = generation
+
+    def post_evaluate(self, config, population, species, best_genome):
+        if best_genome.fitness > 1000:
+            now = dt.datetime.now()
+            net_name = f"gen{self.generation}_{best_genome.fitness}_{now.hour}h{now.minute}m{now.second}s"
+
+            with open(net_name, 'wb') as f:
+                pickle.dump(best_genome, f)
+
+            if self.obs_normalizer is not None:
+                self.obs_normalizer.save(net_name + OBS_NORM_EXT)
+
+            print(f"=> Dumped genome with fitness={best_genome.fitness} : {net_name}")
+
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+
+class StartState():
+    def __init__(self, blob, kind, difficulty=1.0):
+        self.blob = blob # MayhemEnv.get_state()
+        self.kind = kind
+        self.difficulty = difficulty
+        self.runs = 0
+        self.fails = 0
+
+# -------------------------------------------------------------------------------------------------
+
+# training episodes start from states drawn from START_SOURCES, weighted by difficulty x agents failure rate
+# (multiprocess: the workers return their runs statistics and crash states, see apply())
+class StartStateSampler():
+
+    def __init__(self, sources=START_SOURCES, recorded=(), seed=None):
+
+        self.sources = sources
+        self.recorded = recorded # played data files (-r option)
+        self.rng = random.Random(seed)
+        self.states = []
+        self.nb_crashes = 0
+
+    # env: training env used to build the snapshots
+    def build(self, env):
+
+        if "positions" in self.sources:
+            for xpos, ypos in START_POSITIONS:
+                env.reset()
+                env.ship_1.xpos = env.ship_1.xposprecise = xpos
+                env.ship_1.ypos = env.ship_1.yposprecise = ypos
+                self.add(env.get_state(), "position")
+
+        if "recorded" in self.sources:
+            for played_data in self.recorded:
+                self.add_recorded(env, played_data)
+
+        print("%d start states" % len(self.states))
+
+    # replay a recorded play and take a snapshot every START_RECORD_EVERY frames (until a crash)
+    def add_recorded(self, env, played_data):
+
+        with open(played_data, "rb") as f:
+            env.played_data = pickle.load(f)
+
+        env.play_recorded = played_data
+        env.reset()
+
+        done = False
+        while not done and env.frames < len(env.played_data):
+            if env.frames % START_RECORD_EVERY == 0:
+                self.add(env.get_state(), "recorded")
+
+            _, _, done, _ = env.step(None, max_frame=len(env.played_data))
+
+        env.play_recorded = ""
+        env.played_data = []
+
+    def add(self, blob, kind, difficulty=1.0):
+
+        # an episode starts at frame 0, whatever the snapshot
+        state = np.frombuffer(blob, dtype=SIM_STATE)[0].copy()
+        state["frames"] = 0
+        state["total_dist"] = 0
+        state["collision"] = False
+
+        self.states.append(StartState(state.tobytes(), kind, difficulty))
+
+    def add_crash(self, blob):
+
+        if self.nb_crashes >= START_MAX_CRASHES:
+            oldest = next(i for i, start in enumerate(self.states) if start.kind == "crash")
+            del self.states[oldest]
+            self.nb_crashes -= 1
+
+        self.add(blob, "crash", START_CRASH_WEIGHT)
+        self.nb_crashes += 1
+
+    def sample(self):
+
+        if not self.states:
+            return None
+
+        # failure rate with a prior of 1 fail / 2 runs for the never tried states
+        weights = [ start.difficulty * (START_MIN_WEIGHT + (start.fails + 1) / (start.runs + 2)) for start in self.states ]
+
+        return self.rng.choices(self.states, weights)[0]
+
+    def report(self, start, crashed):
+        start.runs += 1
+        start.fails += crashed
+
+    # results of worker processes: (index in self.states when the workers got it, crashed, crash snapshot or None)
+    def apply(self, results):
+        starts = list(self.states) # add_crash() can drop some
+
+        for index, crashed, crash in results:
+            if index is not None:
+                self.report(starts[index], crashed)
+
+        for index, crashed, crash in results:
+            if crash is not None:
+                self.add_crash(crash)
+
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+
+# per step trajectories of selected training episodes, for offline analysis (see TrajectoryLogger.load)
+# one append-only raw file per column (numpy dtype, no header) + meta.json (columns, rows, episodes),
+# the steps are stored in fixed size chunks which are written by a background thread
+class TrajectoryLogger():
+
+    # name, dtype, shape of a row
+    COLUMNS = ( ("episode", np.int32, ()), ("frame", np.int32, ()),
+                ("x", np.float32, ()), ("y", np.float32, ()),            # xposprecise, yposprecise
+                ("vx", np.float32, ()), ("vy", np.float32, ()),
+                ("angle", np.float32, ()),
+                ("action", np.uint8, ()),                                 # pressed keys, see encode_input
+                ("reward", np.float32, ()),
+                ("flags", np.uint8, ()),                                  # TRAJ_EXPLOD, TRAJ_LANDED, TRAJ_COLLISION
+                ("wall_distances", np.float32, (RAY_NB,)) )
+
+    def __init__(self, path, every=TRAJ_LOG_EVERY, chunk_rows=TRAJ_CHUNK_ROWS):
+
+        self.path = path
+        self.every = every
+        self.chunk_rows = chunk_rows
+
+        os.makedirs(path, exist_ok=True)
+
+        self.chunk = self.new_chunk()
+        self.row = 0   # in the current chunk
+        self.rows = 0  # total, current chunk included
+
+        self.nb_episodes = 0
+        self.episode = None  # logged episode: {"episode", "first_row", "rows", + info}
+        self.episodes = []
+
+        # an existing log is continued (rows and episodes numbers follow)
+        if os.path.exists(os.path.join(path, "meta.json")):
+            self.resume()
+
+        # full chunks => writer thread, blocks the training if the disk does not follow
+        self.queue = queue.Queue(maxsize=TRAJ_MAX_PENDING)
+
+        self.thread = threading.Thread(target=self.write_chunks, daemon=True)
+        self.thread.start()
+
+    def resume(self):
+        with open(os.path.join(self.path, "meta.json")) as f:
+            meta = json.load(f)
+
+        columns = { name: {"dtype": np.dtype(dtype).str, "shape": list(shape)} for name, dtype, shape in self.COLUMNS }
+
+        if meta["columns"] != columns:
+            print("%s: the trajectory log columns are different, use another directory" % self.path)
+            sys.exit(0)
+
+        self.rows = meta["rows"]
+        self.episodes = meta["episodes"]
+        self.nb_episodes = meta.get("nb_episodes", self.episodes[-1]["episode"] + 1 if self.episodes else 0)
+
+        # drop what was written after the last meta (interrupted run)
+        for name, dtype, shape in self.COLUMNS:
+            file_name = os.path.join(self.path, name + ".bin")
+            if os.path.exists(file_name):
+                with open(file_name, "r+b") as f:
+                    f.truncate(self.rows * np.dtype(dtype).itemsize * int(np.prod(shape)))
+
+    def new_chunk(self):
+        return { name: np.zeros((self.chunk_rows, ) + shape, dtype=dtype) for name, dtype, shape in self.COLUMNS }
+
+    # True if this episode is logged (1 out of self.every)
+    def begin_episode(self, **info):
+        logged = (self.nb_episodes % self.every) == 0
+        self.nb_episodes += 1
+
+        self.episode = dict(episode=self.nb_episodes - 1, first_row=self.rows, rows=0, **info) if logged else None
+        return logged
+
+    def end_episode(self, **info):
+        if self.episode is not None:
+            self.episode.update(info)
+            self.episodes.append(self.episode)
+            self.episode = None
+
+    # after env.step(action): the state reached, the action which led there and its reward
+    def record(self, env, ship, action, reward):
+        if self.episode is None:
+            return
+
+        chunk = self.chunk
+        row = self.row
+
+        left_pressed, right_pressed, up_pressed, down_pressed, thrust_pressed, shoot_pressed, shield_pressed = action_to_pressed(action)
+
+        flags = 0
+        if ship.explod:
+            flags |= TRAJ_EXPLOD
+        if ship.landed:
+            flags |= TRAJ_LANDED
+        if env.collision:
+            flags |= TRAJ_COLLISION
+
+        chunk["episode"][row] = self.episode["episode"]
+        chunk["frame"][row] = env.frames
+        chunk["x"][row] = ship.xposprecise
+        chunk["y"][row] = ship.yposprecise
+        chunk["vx"][row] = ship.vx
+        chunk["vy"][row] = ship.vy
+        chunk["angle"][row] = ship.angle
+        chunk["action"][row] = encode_input((left_pressed, right_pressed, thrust_pressed, shield_pressed, shoot_pressed))
+        chunk["reward"][row] = reward
+        chunk["flags"][row] = flags
+        chunk["wall_distances"][row] = ship.wall_distances
+
+        self.episode["rows"] += 1
+        self.rows += 1
+        self.row += 1
+
+        if self.row == self.chunk_rows:
+            self.flush()
+
+    # hand the current chunk (even partial) to the writer
+    def flush(self):
+        if self.row:
+            self.queue.put( (self.chunk, self.row, self.rows, self.nb_episodes, list(self.episodes)) )
+            self.chunk = self.new_chunk()
+            self.row = 0
+
+    def write_chunks(self):
+        files = { name: open(os.path.join(self.path, name + ".bin"), "ab") for name, dtype, shape in self.COLUMNS }
+
+        while True:
+            item = self.queue.get()
+
+            if item is None:
+                break
+
+            chunk, nb_rows, rows, nb_episodes, episodes = item
+
+            for name, f in files.items():
+                f.write(chunk[name][:nb_rows].tobytes())
+                f.flush()
+
+            # after the data: the rows of the meta are always in the files
+            self.write_meta(rows, nb_episodes, episodes)
+
+        for f in files.values():
+            f.close()
+
+    def write_meta(self, rows, nb_episodes, episodes):
+        meta = { "rows": rows,
+                 "nb_episodes": nb_episodes,
+                 "columns": { name: {"dtype": np.dtype(dtype).str, "shape": list(shape)} for name, dtype, shape in self.COLUMNS },
+                 "episodes": episodes }
+
+        tmp = os.path.join(self.path, "meta.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(self.path, "meta.json"))
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+    # columns memory mapped (read only, nothing is loaded), meta
+    @staticmethod
+    def load(path):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+
+        rows = meta["rows"]
+        columns = {}
+
+        for name, column in meta["columns"].items():
+            shape = (rows, ) + tuple(column["shape"])
+            if rows:
+                columns[name] = np.memmap(os.path.join(path, name + ".bin"), dtype=column["dtype"], mode="r", shape=shape)
+            else:
+                columns[name] = np.zeros(shape, dtype=column["dtype"])
+
+        return columns, meta
+
+# -------------------------------------------------------------------------------------------------
+
+# 2D histograms over the level of the ship centre: visits (every step), deaths (first exploded / collision step)
+# and landings (first landed step), from trajectory logs (read by chunks of the memory mapped columns) or recorded plays
+class Heatmaps():
+
+    KINDS = ("visits", "landings", "deaths") # drawn in this order
+
+    def __init__(self, cell=HEATMAP_CELL):
+
+        self.cell = cell
+        self.cols = (MAP_WIDTH + cell - 1) // cell
+        self.rows = (MAP_HEIGHT + cell - 1) // cell
+
+        self.counts = { kind: np.zeros(self.rows * self.cols, dtype=np.int64) for kind in self.KINDS }
+        self.samples = 0
+
+    # ship positions (top left, as in xposprecise) => cells
+    def cells(self, xs, ys):
+        # truncation instead of floor: the same once clipped, 2x faster
+        cols = np.clip(((xs + SHIP_SPRITE_SIZE/2) * (1. / self.cell)).astype(np.intp), 0, self.cols - 1)
+        rows = np.clip(((ys + SHIP_SPRITE_SIZE/2) * (1. / self.cell)).astype(np.intp), 0, self.rows - 1)
+
+        return rows * self.cols + cols
+
+    # first step of each run of True within an episode, prev: value of the step before the first one
+    @staticmethod
+    def onsets(values, new_episode, prev):
+        before = np.concatenate(([prev], values[:-1]))
+
+        return values & (~before | new_episode)
+
+    # a batch of consecutive steps, prev: {"dead", "landed", "episode"} of the step before, updated
+    def add_steps(self, xs, ys, dead, landed, episodes, prev):
+
+        if not len(xs):
+            return
+
+        nb_cells = self.rows * self.cols
+        cells = self.cells(xs, ys)
+
+        new_episode = episodes != np.concatenate(([prev["episode"]], episodes[:-1]))
+
+        deaths = self.onsets(dead, new_episode, prev["dead"])
+        landings = self.onsets(landed, new_episode, prev["landed"])
+
+        self.counts["visits"] += np.bincount(cells, minlength=nb_cells)
+        self.counts["deaths"] += np.bincount(cells[deaths], minlength=nb_cells)
+        self.counts["landings"] += np.bincount(cells[landings], minlength=nb_cells)
+
+        prev.update(dead=dead[-1], landed=landed[-1], episode=episodes[-1])
+        self.samples += len(xs)
+
+    # path: TrajectoryLogger directory
+    def add_trajectories(self, path, chunk_rows=HEATMAP_CHUNK):
+
+        columns, meta = TrajectoryLogger.load(path)
+        prev = dict(dead=False, landed=False, episode=-1)
+
+        for start in range(0, meta["rows"], chunk_rows):
+            end = min(start + chunk_rows, meta["rows"])
+
+            flags = np.asarray(columns["flags"][start:end])
+
+            self.add_steps(np.asarray(columns["x"][start:end]), np.asarray(columns["y"][start:end]),
+                           (flags & (TRAJ_EXPLOD | TRAJ_COLLISION)) != 0, (flags & TRAJ_LANDED) != 0,
+                           np.asarray(columns["episode"][start:end]), prev)
+
+        print("%s: %d steps, %d episodes" % (path, meta["rows"], len(meta["episodes"])))
+
+    # played_data: recorded play file (-r option), replayed in env (training mode) until the end or a crash
+    def add_recorded(self, env, played_data):
+
+        with open(played_data, "rb") as f:
+            env.played_data = pickle.load(f)
+
+        env.play_recorded = played_data
+        env.reset()
+
+        xs, ys, dead, landed = [], [], [], []
+
+        done = False
+        while not done and env.frames < len(env.played_data):
+            _, _, done, _ = env.step(None, max_frame=len(env.played_data))
+
+            xs.append(env.ship_1.xposprecise)
+            ys.append(env.ship_1.yposprecise)
+            dead.append(env.ship_1.explod or env.collision)
+            landed.append(env.ship_1.landed)
+
+        env.play_recorded = ""
+        env.played_data = []
+
+        self.add_steps(np.array(xs), np.array(ys), np.array(dead, dtype=bool), np.array(landed, dtype=bool),
+                       np.zeros(len(xs), dtype=np.int32), dict(dead=False, landed=False, episode=-1))
+
+        print("%s: %d steps" % (played_data, len(xs)))
+
+    # level (MAP_WIDTH x MAP_HEIGHT surface) dimmed, kinds overlaid with HEATMAP_COLORS, log scale opacity
+    def render(self, level, kinds=KINDS):
+
+        pixels = pygame.surfarray.array3d(level).astype(np.float32) * HEATMAP_MAP_DIM # (x, y, rgb)
+
+        for kind in kinds:
+            counts = self.counts[kind]
+
+            if not counts.any():
+                continue
+
+            alpha = HEATMAP_MIN_ALPHA + (1. - HEATMAP_MIN_ALPHA) * np.log(np.maximum(counts, 1)) / max(np.log(counts.max()), 1.)
+            alpha[counts == 0] = 0.
+
+            # cells => pixels
+            alpha = alpha.reshape(self.rows, self.cols).repeat(self.cell, axis=0).repeat(self.cell, axis=1)
+            alpha = alpha[:MAP_HEIGHT, :MAP_WIDTH].T[:, :, np.newaxis]
+
+            pixels *= 1. - alpha
+            pixels += alpha * np.array(HEATMAP_COLORS[kind], dtype=np.float32)
+
+        surface = pygame.Surface((MAP_WIDTH, MAP_HEIGHT))
+        pygame.surfarray.blit_array(surface, pixels.astype(np.uint8))
+
+        return surface
+
+    # path.png: all the kinds, path_<kind>.png: one kind, path.npz: the counts (rows x cols grids)
+    def save(self, level, path):
+
+        name = os.path.splitext(path)[0]
+
+        pygame.image.save(self.render(level), name + ".png")
+
+        for kind in self.KINDS:
+            pygame.image.save(self.render(level, (kind, )), "%s_%s.png" % (name, kind))
+
+        np.savez_compressed(name + ".npz", cell=self.cell, **{ kind: counts.reshape(self.rows, self.cols) for kind, counts in self.counts.items() })
+
+        print("Heatmaps saved in %s.png" % name)
+
+    def report(self, top=HEATMAP_TOP):
+
+        print("%d steps, %d deaths, %d landings, %d cells visited" % (self.samples, self.counts["deaths"].sum(), \
+              self.counts["landings"].sum(), np.count_nonzero(self.counts["visits"])))
+
+        deaths = self.counts["deaths"]
+        nb = min(top, np.count_nonzero(deaths))
+
+        if nb:
+            worst = np.argpartition(deaths, -nb)[-nb:]
+            worst = worst[np.argsort(deaths[worst])[::-1]]
+
+            print("Most deadly cells (x, y: deaths, visits):")
+            for i in worst:
+                x = (i % self.cols) * self.cell + self.cell // 2
+                y = (i // self.cols) * self.cell + self.cell // 2
+                print("  %4d, %4d: %d, %d" % (x, y, deaths[i], self.counts["visits"][i]))
+
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+
+# 2D points sorted by cell of a uniform grid over [0, 1] x [0, 1]: the k nearest neighbours are in a few cells
+class NoveltyGrid():
+
+    def __init__(self, points, cell=NOVELTY_GRID_CELL):
+
+        self.cell = cell
+        self.cols = int(np.ceil(1. / cell))
+        self.rows = self.cols
+
+        cells = self.cells(points)
+        order = np.argsort(cells, kind="stable")
+
+        self.points = points[order]
+        self.starts = np.searchsorted(cells[order], np.arange(self.rows * self.cols + 1)) # cell => first point
+
+    def cells(self, points):
+        cols = np.clip((points[:, 0] / self.cell).astype(np.int64), 0, self.cols - 1)
+        rows = np.clip((points[:, 1] / self.cell).astype(np.int64), 0, self.rows - 1)
+        return rows * self.cols + cols
+
+    # k nearest distances of each point, (n, k), k <= number of points
+    def query(self, points, k):
+        nearest = np.zeros((len(points), k))
+
+        for i, cell in enumerate(self.cells(points).tolist()):
+            row, col = divmod(cell, self.cols)
+            r = 0
+
+            while True:
+                # the (2r+1) x (2r+1) cells block around the point, one slice per row
+                col0 = max(col - r, 0)
+                col1 = min(col + r, self.cols - 1)
+                row0 = max(row - r, 0)
+                row1 = min(row + r, self.rows - 1)
+
+                block = np.concatenate([ self.points[self.starts[j*self.cols + col0]:self.starts[j*self.cols + col1 + 1]] for j in range(row0, row1 + 1) ])
+                whole = (col0 == 0 and row0 == 0 and col1 == self.cols - 1 and row1 == self.rows - 1)
+
+                if len(block) >= k:
+                    dist = np.partition(np.sqrt(((block - points[i])**2).sum(axis=1)), k-1)[:k]
+
+                    # the points out of the block are at least r cells away
+                    if whole or dist.max() <= r * self.cell:
+                        nearest[i] = dist
+                        break
+
+                    r = max(r + 1, int(np.ceil(dist.max() / self.cell)))
+                else:
+                    r += 1
+
+        return nearest
+
+# -------------------------------------------------------------------------------------------------
+
+# novelty search: an episode is described by a behaviour descriptor (where the ship went, normalized by the map size),
+# the novelty of a genome is its mean distance to the k nearest descriptors of the archive and of its generation
+# the archive is indexed by a KD-tree (scipy) or a NoveltyGrid ("final_pos") rebuilt when it has grown enough,
+# the rows added since are brute forced (like the whole archive for "path" without scipy)
+class NoveltyArchive():
+
+    def __init__(self, descriptor=NOVELTY_DESCRIPTOR, k=NOVELTY_K, threshold=NOVELTY_THRESHOLD, max_size=NOVELTY_MAX_ARCHIVE):
+
+        self.descriptor = descriptor # "final_pos" or "path"
+        self.k = k
+        self.threshold = threshold
+        self.max_size = max_size
+
+        self.size = 2 if descriptor == "final_pos" else 2 * NOVELTY_PATH_POINTS
+        self.scale = np.tile([1. / MAP_WIDTH, 1. / MAP_HEIGHT], self.size // 2)
+
+        self.archive = np.zeros((0, self.size))
+
+        # cKDTree or NoveltyGrid over self.archive[:self.indexed], None = brute force
+        self.index = None
+        self.indexed = 0
+
+    # worker processes only describe episodes: the archive is not sent to them
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["archive"] = np.zeros((0, self.size))
+        state["index"] = None
+        state["indexed"] = 0
+        return state
+
+    # ship positions every NOVELTY_PATH_EVERY frames and the final position => descriptor
+    def describe(self, path, final_pos):
+        if self.descriptor == "final_pos":
+            points = [final_pos]
+        else:
+            # episodes shorter than the path: they stay where they ended
+            points = (list(path) + [final_pos] * NOVELTY_PATH_POINTS)[:NOVELTY_PATH_POINTS]
+
+        return np.array(points, dtype=np.float64).reshape(self.size) * self.scale
+
+    # k nearest archive distances of each descriptor, (n, <= k)
+    def archive_distances(self, descriptors):
+        k = min(self.k, len(self.archive))
+
+        if k == 0:
+            return np.zeros((len(descriptors), 0))
+
+        if self.index is None:
+            return self.brute_distances(descriptors, self.archive, k)
+
+        k_indexed = min(k, self.indexed)
+
+        if SCIPY_FOUND:
+            dist, idx = self.index.query(descriptors, k=k_indexed)
+            nearest = dist.reshape(len(descriptors), k_indexed)
+        else:
+            nearest = self.index.query(descriptors, k_indexed)
+
+        # the rows added since the index was built
+        if self.indexed < len(self.archive):
+            nearest = np.concatenate([nearest, self.brute_distances(descriptors, self.archive[self.indexed:], k)], axis=1)
+            nearest = np.partition(nearest, k-1, axis=1)[:, :k]
+
+        return nearest
+
+    def brute_distances(self, descriptors, rows, k):
+        k = min(k, len(rows))
+
+        # |a - b|^2 = |a|^2 + |b|^2 - 2 a.b, by chunks of the rows: memory stays (n, NOVELTY_CHUNK)
+        nearest = np.zeros((len(descriptors), 0))
+        norms = (descriptors**2).sum(axis=1)[:, None]
+
+        for start in range(0, len(rows), NOVELTY_CHUNK):
+            chunk = rows[start:start + NOVELTY_CHUNK]
+
+            dist2 = norms + (chunk**2).sum(axis=1)[None, :] - 2. * (descriptors @ chunk.T)
+            np.maximum(dist2, 0., out=dist2)
+
+            nearest = np.concatenate([nearest, dist2], axis=1)
+            if nearest.shape[1] > k:
+                nearest = np.partition(nearest, k-1, axis=1)[:, :k]
+
+        return np.sqrt(nearest)
+
+    # novelty of a generation, the most novel descriptors are archived
+    def score(self, descriptors):
+        descriptors = np.asarray(descriptors, dtype=np.float64)
+
+        # against the other genomes of the generation (not itself)
+        generation = np.sqrt(((descriptors[:, None, :] - descriptors[None, :, :])**2).sum(axis=2))
+        np.fill_diagonal(generation, np.inf)
+
+        k = min(self.k, len(descriptors) - 1)
+        generation = np.partition(generation, k-1, axis=1)[:, :k] if k > 0 else generation[:, :0]
+
+        nearest = np.concatenate([generation, self.archive_distances(descriptors)], axis=1)
+        nearest.sort(axis=1)
+        novelty = nearest[:, :self.k].mean(axis=1) if nearest.shape[1] else np.zeros(len(descriptors))
+
+        self.add(descriptors[novelty > self.threshold])
+
+        return novelty
+
+    def add(self, descriptors):
+        if not len(descriptors):
+            return
+
+        self.archive = np.concatenate([self.archive, descriptors])
+
+        # not rebuilt at each generation
+        if len(self.archive) - self.indexed > max(NOVELTY_REINDEX * self.indexed, NOVELTY_CHUNK):
+            self.reindex()
+
+    def reindex(self):
+        # the oldest entries are dropped
+        self.archive = self.archive[-self.max_size:]
+
+        if SCIPY_FOUND:
+            self.index = cKDTree(self.archive)
+        elif self.descriptor == "final_pos":
+            self.index = NoveltyGrid(self.archive)
+        else:
+            return
+
+        self.indexed = len(self.archive)
+
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+
+class NeatTraining():
+
+    def __init__(self, runs_per_net, max_gen, multi, render_every=RENDER_EVERY, display_fps=DISPLAY_FPS, start_sources=START_SOURCES, start_recorded=(), \
+                 selfplay=0, novelty="", trajectory_log=""):
+
+        self.runs_per_net = runs_per_net
+        self.max_gen = max_gen
+        self.multi = multi
+
+        # genomes per self-play match (SelfPlayEnv), 0 = each genome alone in its env
+        self.selfplay = selfplay
+
+        # novelty search, behaviour descriptors in genome.descriptor
+        self.novelty = NoveltyArchive(novelty) if novelty else None
+
+        # per step logs of some episodes, in this process only (workers would write the same files)
+        self.trajectory_logger = None
+        if trajectory_log:
+            if multi:
+                print("Trajectory logging is not available in multiprocess training")
+            else:
+                self.trajectory_logger = TrajectoryLogger(trajectory_log)
+
+        # training envs are never ticked, only the display rate can be reduced
+        self.render_every = render_every
+        self.display_fps = display_fps
+
+        # running observation statistics, shared by all the envs and saved along the genomes
+        self.obs_normalizer = None
+        if OBS_NORMALIZE == "running":
+            self.obs_normalizer = RunningNormalizer(ObservationSpec().frame_size)
+
+        # episodes start states, built in train_it()
+        self.start_sampler = None
+        if start_sources:
+            self.start_sampler = StartStateSampler(start_sources, start_recorded)
+
+    def render_loaded_genome(self, g):
+        config = neat.Config( neat.DefaultGenome, neat.DefaultReproduction,
+                              neat.DefaultSpeciesSet, neat.DefaultStagnation,
+                              os.path.join(os.getcwd(), 'config') )
+
+        self.check_config(config)
+
+        net = neat.nn.RecurrentNetwork.create(g, config)
+        #net = neat.nn.FeedForwardNetwork.create(g, config)
+
+        neat_env = MayhemEnv(game_window, False, 1, mode="training", motion="gravity", sensor="ray", record_play="", play_recorded="", \
+                             render_every=self.render_every, display_fps=self.display_fps, obs_normalizer=self.obs_normalizer)
+        observation = neat_env.reset()
+
+        done = False
+        while not done:
+            action = net.activate(observation)
+            #action = np.argmax(net.activate(observation))
+
+            observation, reward, done, info = neat_env.step(action, max_frame=20000)
+            neat_env.display(collision_check=False)
+
+    # the network inputs must match the observation built by MayhemEnv.step()
+    def check_config(self, config):
+        obs_size = ObservationSpec().size
+
+        if config.genome_config.num_inputs != obs_size:
+            print("config num_inputs=%s but the observation size is %s (OBS_FEATURES x OBS_FRAME_STACK)" % (config.genome_config.num_inputs, obs_size))
+            sys.exit(1)
+
+    # statistics saved with the genome (frozen for the evaluation)
+    def load_normalizer(self, net_name):
+        if OBS_NORMALIZE == "running":
+            if os.path.isfile(net_name + OBS_NORM_EXT):
+                self.obs_normalizer = RunningNormalizer.load(net_name + OBS_NORM_EXT)
+            else:
+                print("No observation statistics found for %s" % net_name)
+
+    def load_net(self, net_name=None):
+
+        if not net_name:
+            file_list = [ x for x in os.listdir(os.getcwd()) if os.path.isfile(os.path.join(os.getcwd(), x)) and x.startswith("gen") and not x.endswith(OBS_NORM_EXT) ]
+
+            for fname in file_list:
+                with open(fname, 'rb') as f:
+                    g = pickle.load(f)
+
+                self.load_normalizer(fname)
+
+                print('Loaded genome:')
+                print(g)
+
+                self.render_loaded_genome(g)
+                time.sleep(1)
+
+        with open(net_name, 'rb') as f:
+            g = pickle.load(f)
+
+        self.load_normalizer(net_name)
+
+        print('Loaded genome:')
+        print(g)
+
+        self.render_loaded_genome(g)
+
+    def train_it(self):
+        local_dir = os.path.dirname(__file__)
+        config_path = os.path.join(local_dir, 'config')
+
+        config = neat.Config(neat.DefaultGenome, neat.DefaultReproduction,
+                             neat.DefaultSpeciesSet, neat.DefaultStagnation,
+                             config_path)
+
+        self.check_config(config)
+
+        if self.start_sampler is not None:
+            self.start_sampler.build(MayhemEnv(game_window, False, 1, mode="training", motion="gravity", sensor="ray"))
+
+        pop = neat.Population(config)
+        stats = neat.StatisticsReporter()
+
+        pop.add_reporter(stats)
+        pop.add_reporter(neat.StdOutReporter(True))
+        pop.add_reporter(CustomNeatReporter(self.obs_normalizer))
+
+        if self.selfplay:
+            if self.multi:
+                with multiprocessing.Pool(multiprocessing.cpu_count()) as pool:
+                    winner = pop.run(lambda genomes, config: self.eval_genomes_selfplay(genomes, config, pool), self.max_gen)
+            else:
+                winner = pop.run(self.eval_genomes_selfplay, self.max_gen)
+
+        elif self.multi:
+            if self.obs_normalizer is not None or self.novelty is not None or self.start_sampler is not None:
+                with multiprocessing.Pool(multiprocessing.cpu_count()) as pool:
+                    winner = pop.run(lambda genomes, config: self.eval_genomes_multi(genomes, config, pool), self.max_gen)
+            else:
+                pe = neat.ParallelEvaluator(multiprocessing.cpu_count(), self.eval_genome)
+                winner = pop.run(pe.evaluate, self.max_gen)
+        else:
+            if 0:
+                pe = neat.ParallelEvaluator(1, self.eval_genome)
+                winner = pop.run(pe.evaluate, self.max_gen)
+            else:
+                winner = pop.run(self.eval_genomes, self.max_gen)
+
+        if self.trajectory_logger is not None:
+            self.trajectory_logger.close()
+
+        # Save the winner.
+        with open('winner', 'wb') as f:
+            pickle.dump(winner, f)
+
+        if self.obs_normalizer is not None:
+            self.obs_normalizer.save('winner' + OBS_NORM_EXT)
+
+        print(winner)
+
+    def eval_genome(self, genome, config, remote=False):
+        #for i, g in enumerate(genome):
+        #    print(i, g)
+
+        # worker process: normalize with the statistics of the generation start, return the new samples statistics
+        obs_collector = None
+        if remote and self.obs_normalizer is not None:
+            self.obs_normalizer.frozen = True
+            obs_collector = RunningNormalizer(self.obs_normalizer.size)
+
+        # worker process: the start states are a copy, their results go back to the parent (StartStateSampler.apply)
+        start_results = []
+
+        net = neat.nn.RecurrentNetwork.create(genome, config)
+        #net = neat.nn.FeedForwardNetwork.create(genome, config)
+
+        fitnesses = []
+        descriptors = []
+
+        for runs in range(self.runs_per_net):
+
+            neat_env = MayhemEnv(game_window, False, 1, mode="training", motion="gravity", sensor="ray", record_play="", play_recorded="", \
+                             render_every=self.render_every, display_fps=self.display_fps, obs_normalizer=self.obs_normalizer, obs_collector=obs_collector)
+
+            start = None
+            if self.start_sampler is not None:
+                start = self.start_sampler.sample()
+
+            observation = neat_env.reset(start.blob if start else None)
+
+            logged = self.trajectory_logger is not None and self.trajectory_logger.begin_episode(genome=genome.key)
+
+            # novelty descriptor
+            path = []
+
+            # to record where the agent was a bit before a crash
+            snapshots = deque(maxlen=2)
+            record_crashes = self.start_sampler is not None and "crashes" in self.start_sampler.sources
+
+            fitness = 0.0
+            done = False
+            while not done:
+
+                if record_crashes and neat_env.frames % START_CRASH_BACK == 0:
+                    snapshots.append(neat_env.get_state())
+
+                if self.novelty is not None and neat_env.frames % NOVELTY_PATH_EVERY == 0:
+                    path.append((neat_env.ship_1.xpos, neat_env.ship_1.ypos))
+
+                #action = np.argmax(net.activate(observation))
+                action = net.activate(observation) # [-1.0, -0.17934807670239852, 1.0, -0.3551236740213184]
+                #print(action)
+                observation, reward, done, info = neat_env.step(action, max_frame=4000)
+
+                if logged:
+                    self.trajectory_logger.record(neat_env, neat_env.ship_1, action, reward)
+
+                if not self.multi:
+                    neat_env.display(collision_check=False)
+
+                #print(observation)
+
+                fitness += reward
+                #print(fitness)
+
+                # dump network
+                for event in pygame.event.get():
+                    if event.type == pygame.KEYDOWN:
+                        if event.key == pygame.K_d:
+                            now = dt.datetime.now()
+                            net_name = f"gen_{genome.fitness}_{now.hour}h{now.minute}m{now.second}s"
+                            with open(net_name, 'wb') as f:
+                                pickle.dump(genome, f)
+                            print("Dumped ", net_name)
+
+
+            fitnesses.append(fitness)
+
+            if logged:
+                self.trajectory_logger.end_episode(fitness=fitness)
+
+            if self.novelty is not None:
+                descriptors.append(self.novelty.describe(path, (neat_env.ship_1.xpos, neat_env.ship_1.ypos)))
+
+            crashed = neat_env.ship_1.explod or neat_env.collision
+            crash = snapshots[0] if record_crashes and crashed and len(snapshots) == 2 else None
+
+            if remote:
+                if start or crash is not None:
+                    start_results.append( (self.start_sampler.states.index(start) if start else None, crashed, crash) )
+            else:
+                if start:
+                    self.start_sampler.report(start, crashed)
+
+                if crash is not None:
+                    self.start_sampler.add_crash(crash)
+
+
+        mean_fit = np.mean(fitnesses)
+        print(mean_fit)
+
+        if descriptors:
+            genome.descriptor = np.mean(descriptors, axis=0)
+
+        if remote:
+            return mean_fit, obs_collector, start_results
+
+        return mean_fit
+
+    def eval_genomes(self, genomes, config):
+        for genome_id, genome in genomes:
+            genome.fitness = self.eval_genome(genome, config)
+
+        self.score_novelty(genomes)
+
+    # multiprocess with running observation statistics, novelty and / or start states: the workers results are merged
+    # after each generation
+    def eval_genomes_multi(self, genomes, config, pool):
+        jobs = [ pool.apply_async(self.eval_genome_remote, (genome, config)) for genome_id, genome in genomes ]
+
+        start_results = []
+
+        for (genome_id, genome), job in zip(genomes, jobs):
+            genome.fitness, obs_collector, genome.descriptor, results = job.get()
+            if obs_collector is not None:
+                self.obs_normalizer.merge(obs_collector)
+            start_results += results
+
+        if self.start_sampler is not None:
+            self.start_sampler.apply(start_results)
+
+        self.score_novelty(genomes)
+
+    # worker process: the genome is a copy, its descriptor goes back with the fitness
+    def eval_genome_remote(self, genome, config):
+        fitness, obs_collector, start_results = self.eval_genome(genome, config, remote=True)
+
+        return fitness, obs_collector, getattr(genome, "descriptor", None), start_results
+
+    def score_novelty(self, genomes):
+        if self.novelty is None:
+            return
+
+        novelty = self.novelty.score([ genome.descriptor for genome_id, genome in genomes ])
+
+        for (genome_id, genome), n in zip(genomes, novelty):
+            genome.fitness = NOVELTY_WEIGHT * n + NOVELTY_REWARD_WEIGHT * genome.fitness
+
+        print("novelty: mean %.3f, max %.3f, archive %d" % (novelty.mean(), novelty.max(), len(self.novelty.archive)))
+
+    # self-play: the genomes are shuffled into matches of self.selfplay genomes, SELFPLAY_MATCHES times,
+    # the fitness is the mean reward of a genome over its matches
+    def eval_genomes_selfplay(self, genomes, config, pool=None):
+        genomes = [ genome for genome_id, genome in genomes ]
+        rewards = [ [] for genome in genomes ]
+
+        matches = [] # (genome indexes, scored)
+
+        for i in range(SELFPLAY_MATCHES):
+            order = list(range(len(genomes)))
+            random.shuffle(order)
+
+            # the last match is completed with genomes already playing in this round, not scored twice
+            nb_missing = -len(order) % self.selfplay
+            scored = [True] * len(order) + [False] * nb_missing
+            order += order[:nb_missing]
+
+            for m in range(0, len(order), self.selfplay):
+                matches.append( (order[m:m+self.selfplay], scored[m:m+self.selfplay]) )
+
+        collect = pool is not None and self.obs_normalizer is not None
+
+        if pool is not None:
+            jobs = [ pool.apply_async(self.play_match, ([genomes[i] for i in players], config, collect)) for players, scored in matches ]
+            results = [ job.get() for job in jobs ]
+        else:
+            results = [ self.play_match([genomes[i] for i in players], config) for players, scored in matches ]
+
+        for (players, scored), (match_rewards, obs_collector) in zip(matches, results):
+            if collect:
+                self.obs_normalizer.merge(obs_collector)
+
+            for i, is_scored, reward in zip(players, scored, match_rewards):
+                if is_scored:
+                    rewards[i].append(reward)
+
+        for genome, genome_rewards in zip(genomes, rewards):
+            genome.fitness = float(np.mean(genome_rewards))
+
+        print("self-play: %d matches, best %.1f" % (len(matches), max(genome.fitness for genome in genomes)))
+
+    # one match, returns the reward of each genome
+    def play_match(self, genomes, config, collect=False):
+
+        # worker process: normalize with the statistics of the generation start, return the new samples statistics
+        obs_collector = None
+        if collect:
+            self.obs_normalizer.frozen = True
+            obs_collector = RunningNormalizer(self.obs_normalizer.size)
+
+        env = SelfPlayEnv.shared(self.selfplay, self.render_every, self.display_fps)
+
+        for obs_spec in env.obs_specs:
+            if obs_spec.normalizer is not None:
+                obs_spec.normalizer = self.obs_normalizer
+                obs_spec.collector = obs_collector if collect else self.obs_normalizer
+
+        nets = [ neat.nn.RecurrentNetwork.create(genome, config) for genome in genomes ]
+
+        fitnesses = np.zeros(len(genomes))
+
+        observations = env.reset()
+
+        done = False
+        while not done:
+            actions = [ net.activate(observation) if observation is not None else None for net, observation in zip(nets, observations) ]
+
+            observations, rewards, dones, done = env.step(actions)
+            fitnesses += rewards
+
+            if not self.multi:
+                env.display()
+
+        return fitnesses.tolist(), obs_collector
+
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+
+# genome file (saved by the training) or "random" => (policy: observation => action, observation statistics)
+def load_bot_policy(name):
+
+    if name == "random":
+        rng = random.Random()
+        return (lambda observation: (rng.uniform(-1., 1.), rng.uniform(-1., 1.))), None
+
+    if not NEAT_FOUND:
+        print("Neat has not been found on the system")
+        sys.exit(0)
+
+    config = neat.Config( neat.DefaultGenome, neat.DefaultReproduction,
+                          neat.DefaultSpeciesSet, neat.DefaultStagnation,
+                          os.path.join(os.getcwd(), 'config') )
+
+    with open(name, 'rb') as f:
+        g = pickle.load(f)
+
+    net = neat.nn.RecurrentNetwork.create(g, config)
+
+    obs_normalizer = None
+    if OBS_NORMALIZE == "running" and os.path.isfile(name + OBS_NORM_EXT):
+        obs_normalizer = RunningNormalizer.load(name + OBS_NORM_EXT)
+
+    return net.activate, obs_normalizer
+
+# a ship played by a policy: the observation (ray sensor included) and the inference run in a background thread,
+# the game loop only posts the ship state and picks the last action, it never waits for the policy
+class BotPlayer():
+
+    def __init__(self, env, policy, obs_normalizer=None):
+
+        self.env = env
+        self.policy = policy
+
+        # the ship as seen by the bot: standalone copy of the game ship state
+        self.shadow = Ship("training", env.game.screen_width, env.game.screen_height, 1, 1, 0, 0, \
+                           SHIP_1_PIC, SHIP_1_PIC_THRUST, SHIP_1_PIC_SHIELD, None, None, 0, platforms=env.platforms)
+
+        self.obs_spec = ObservationSpec(normalizer=obs_normalizer)
+
+        # level cells visited since the ship (re)started, updated every frame even if the bot skips some
+        self.coverage = CoverageGrid()
+
+        # deque(maxlen=1): append / pop are atomic, a newer item replaces the one not consumed yet
+        self.states = deque(maxlen=1)  # game thread => bot
+        self.actions = deque(maxlen=1) # bot => game thread, pressed keys
+
+        self.pressed = (False, ) * 7   # last action, kept until a newer one is there
+        self.nb_frames = 0
+        self.nb_actions = 0
+
+        self.wakeup = threading.Event()
+        self.running = True
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+
+            if not self.running:
+                return
+
+            try:
+                state = self.states.pop()
+            except IndexError:
+                continue
+
+            state, self.shadow.new_cells = state
+
+            self.shadow.set_state(state)
+            self.shadow.ray_sensor(self.env, render=False)
+
+            observation = self.obs_spec.observe(self.shadow)
+
+            self.actions.append(action_to_pressed(self.policy(observation)))
+
+    # game thread, see Ship.read_input
+    def read_input(self, ship):
+        # a new life is a new episode for the policy
+        if ship.explod:
+            self.coverage.clear()
+        else:
+            self.coverage.visit(ship.xpos + SHIP_SPRITE_SIZE/2, ship.ypos + SHIP_SPRITE_SIZE/2)
+
+        self.states.append( (ship.get_state(), self.coverage.new_cells) )
+        self.wakeup.set()
+
+        self.nb_frames += 1
+
+        try:
+            self.pressed = self.actions.pop()
+            self.nb_actions += 1
+        except IndexError:
+            pass
+
+        return self.pressed
+
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+        self.thread.join(NET_TIMEOUT)
+
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+
+def encode_input(pressed):
+    bits = 0
+    for bit, p in zip(INPUT_BITS, pressed):
+        if p:
+            bits |= bit
+    return bits
+
+def decode_input(bits):
+    return tuple(bool(bits & bit) for bit in INPUT_BITS)
+
+# -------------------------------------------------------------------------------------------------
+
+# all the players on this machine (keyboard / joysticks), same interface as LockstepClient
+class LocalSession():
+
+    def __init__(self, nb_players, input_delay=0):
+
+        self.nb_players = nb_players
+        self.local_players = tuple(range(nb_players))
+        self.input_delay = input_delay
+        self.pending = {} # frame => inputs of every player
+
+    def send(self, frame, player, bits):
+        self.pending.setdefault(frame, [0] * self.nb_players)[player] = bits
+
+    # inputs of every player for this frame, None = not sent yet
+    def confirmed(self, frame):
+        if frame < self.input_delay:
+            return (0, ) * self.nb_players
+
+        inputs = self.pending.pop(frame, None)
+        return tuple(inputs) if inputs is not None else None
+
+    def predicted(self, frame):
+        return tuple(self.pending.get(frame, [0] * self.nb_players))
+
+    def close(self):
+        pass
+
+# -------------------------------------------------------------------------------------------------
+
+# lockstep relay: waits for the inputs of every player for a frame and sends them to all
+# the server does not simulate anything, the clients run the same deterministic game
+class LockstepServer():
+
+    def __init__(self, nb_players, host=NET_HOST, port=NET_PORT, input_delay=NET_INPUT_DELAY):
+
+        self.nb_players = nb_players
+        self.host = host
+        self.port = port
+        self.input_delay = input_delay
+
+        self.writers = []
+        self.dropped = set()
+        self.inputs = {}     # frame => inputs received so far (None = missing)
+        self.next_frame = 0  # next frame to send
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        print("Lockstep server on %s:%d, waiting for %d players" % (self.host, self.port, self.nb_players))
+
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def handle(self, reader, writer):
+
+        if len(self.writers) >= self.nb_players:
+            writer.close()
+            return
+
+        player = len(self.writers)
+        self.writers.append(writer)
+        writer.write(NET_HELLO.pack(player, self.nb_players, self.input_delay))
+
+        print("Player %d connected" % (player+1))
+
+        # everybody is there: the first input_delay frames have no inputs
+        if len(self.writers) == self.nb_players:
+            for frame in range(self.input_delay):
+                self.inputs[frame] = [0] * self.nb_players
+            self.flush()
+
+        try:
+            while True:
+                frame, bits = NET_INPUT.unpack(await reader.readexactly(NET_INPUT.size))
+                self.inputs.setdefault(frame, [None] * self.nb_players)[player] = bits
+                self.flush()
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print("Player %d disconnected" % (player+1))
+            self.dropped.add(player)
+            self.flush()
+
+    # send the complete frames, in order
+    def flush(self):
+        if len(self.writers) < self.nb_players:
+            return
+
+        while self.next_frame in self.inputs:
+            inputs = self.inputs[self.next_frame]
+
+            # dropped players do not move any more
+            for player in self.dropped:
+                if inputs[player] is None:
+                    inputs[player] = 0
+
+            if None in inputs:
+                break
+
+            packet = NET_FRAME.pack(self.next_frame) + bytes(inputs)
+
+            for player, writer in enumerate(self.writers):
+                if player not in self.dropped:
+                    writer.write(packet)
+
+            del self.inputs[self.next_frame]
+            self.next_frame += 1
+
+# -------------------------------------------------------------------------------------------------
+
+# lockstep client: the network runs in an asyncio loop in a background thread, the game loop only
+# posts its inputs and picks the confirmed frames
+class LockstepClient():
+
+    def __init__(self, host=NET_HOST, port=NET_PORT):
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        self.connected = False
+        self.frames = {}  # frame => inputs of every player, written by the network thread
+        self.latest = None
+        self.local_inputs = {} # frame => our inputs, for the prediction
+
+        future = asyncio.run_coroutine_threadsafe(self.connect(host, port), self.loop)
+        self.player, self.nb_players, self.input_delay = future.result(NET_TIMEOUT)
+
+        self.local_players = (self.player, )
+
+        print("Connected to %s:%d as player %d / %d" % (host, port, self.player+1, self.nb_players))
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        hello = NET_HELLO.unpack(await self.reader.readexactly(NET_HELLO.size))
+
+        self.connected = True
+        self.receiver = self.loop.create_task(self.receive(hello[1]))
+
+        return hello
+
+    async def receive(self, nb_players):
+        size = NET_FRAME.size + nb_players
+
+        try:
+            while True:
+                data = await self.reader.readexactly(size)
+                frame, = NET_FRAME.unpack_from(data)
+                inputs = tuple(data[NET_FRAME.size:])
+                self.frames[frame] = inputs
+                self.latest = inputs
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print("Disconnected from the server")
+            self.connected = False
+
+    def send(self, frame, player, bits):
+        self.local_inputs[frame] = bits
+        self.loop.call_soon_threadsafe(self.writer.write, NET_INPUT.pack(frame, bits))
+
+    # inputs of every player for this frame, None = not received yet
+    def confirmed(self, frame):
+        self.local_inputs.pop(frame, None)
+        return self.frames.pop(frame, None)
+
+    # not received yet: our own inputs and the last known inputs of the others
+    def predicted(self, frame):
+        inputs = self.frames.get(frame)
+        if inputs is not None:
+            return inputs
+
+        inputs = list(self.latest or [0] * self.nb_players)
+        inputs[self.player] = self.local_inputs.get(frame, inputs[self.player])
+
+        return tuple(inputs)
+
+    async def disconnect(self):
+        self.writer.close()
+
+        # cancel and wait for every task of the loop, a task still pending when the loop stops is destroyed pending
+        tasks = [ task for task in asyncio.all_tasks(self.loop) if task is not asyncio.current_task() ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.disconnect(), self.loop).result(NET_TIMEOUT)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+
+# rollback on top of a LockstepClient / LocalSession: the frames are simulated with the predicted inputs of the other
+# players, when the confirmed inputs differ the game is restored to that frame and re-simulated (env.sim_step is pure)
+class RollbackSession():
+
+    def __init__(self, session, max_frames=ROLLBACK_FRAMES):
+
+        self.session = session
+        self.max_frames = max_frames
+
+        self.checked = -1   # last frame simulated with the confirmed inputs
+        self.received = 0   # next confirmed frame to get from the session
+        self.confirmed = {} # frame => confirmed inputs
+        self.played = {}    # frame => inputs used by the simulation
+        self.states = {}    # frame => get_state() before the frame
+
+        self.nb_rollbacks = 0
+        self.nb_resimulated = 0
+
+    def advance(self, env):
+        env.send_inputs()
+
+        while True:
+            inputs = self.session.confirmed(self.received)
+            if inputs is None:
+                break
+            self.confirmed[self.received] = inputs
+            self.received += 1
+
+        # first wrong prediction
+        rollback_frame = None
+
+        while (self.checked + 1) in self.confirmed and (self.checked + 1) < env.frames:
+            frame = self.checked + 1
+
+            if self.played[frame] != self.confirmed[frame]:
+                rollback_frame = frame
+                break
+
+            env.record_inputs(self.confirmed[frame])
+            del self.confirmed[frame], self.played[frame], self.states[frame]
+            self.checked = frame
+
+        if rollback_frame is not None:
+            self.nb_rollbacks += 1
+            last_frame = env.frames
+
+            env.set_state(self.states[rollback_frame])
+
+            while env.frames < last_frame:
+                self.simulate(env)
+                self.nb_resimulated += 1
+
+            # the sounds of the re-simulated frames have been played (or predicted) already
+            env.audio.commands.clear()
+
+        # too far from the confirmed inputs: wait for them
+        if env.frames - self.checked > self.max_frames:
+            return False
+
+        self.simulate(env)
+        return True
+
+    def simulate(self, env):
+        frame = env.frames
+
+        inputs = self.confirmed.get(frame)
+        if inputs is None:
+            inputs = self.session.predicted(frame)
+
+        self.states[frame] = env.get_state()
+        self.played[frame] = inputs
+
+        env.sim_step(inputs)
+
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+
+# broadcast of a game to any number of spectators: per frame deltas (ship poses and flags, shot births and deaths)
+# and a full state every keyframe_every frames, the spectators do not simulate anything (see SpectatorClient)
+class BroadcastServer():
+
+    def __init__(self, host=NET_HOST, port=BROADCAST_PORT, keyframe_every=BROADCAST_KEYFRAME, max_buffer=BROADCAST_MAX_BUFFER):
+
+        self.keyframe_every = keyframe_every
+        self.max_buffer = max_buffer
+
+        # encoding, game thread
+        self.ships_sent = {}   # ship => last sent BC_SHIP fields
+        self.shot_ids = {}     # ship => {(xposprecise, yposprecise, dx, dy) expected next frame: shot id}
+        self.next_shot_id = 0
+        self.nb_published = 0
+
+        # sending, network thread
+        self.history = deque(maxlen=keyframe_every) # last keyframe and the deltas since, for the new spectators
+        self.spectators = {} # writer => in sync (False = deltas dropped, waiting for a keyframe)
+        self.nb_dropped = 0
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        future = asyncio.run_coroutine_threadsafe(asyncio.start_server(self.handle, host, port), self.loop)
+        self.server = future.result(NET_TIMEOUT)
+
+        print("Broadcast on %s:%d" % (host, port))
+
+    async def handle(self, reader, writer):
+
+        # catch up: last keyframe and the deltas since
+        for packet in self.history:
+            writer.write(packet)
+
+        self.spectators[writer] = len(self.history) > 0
+
+        print("Spectator connected (%d)" % len(self.spectators))
+
+        # spectators send nothing, read() returns when they disconnect
+        try:
+            await reader.read()
+        except ConnectionError:
+            pass
+
+        del self.spectators[writer]
+        writer.close()
+
+        print("Spectator disconnected (%d)" % len(self.spectators))
+
+    # after each simulated frame
+    def publish(self, env):
+        keyframe = (self.nb_published % self.keyframe_every) == 0
+        self.nb_published += 1
+
+        packet = self.encode(env, keyframe)
+        self.loop.call_soon_threadsafe(self.send, packet, keyframe)
+
+    def encode(self, env, keyframe):
+        ships = []
+        births = []
+        deaths = []
+
+        for ship in env.ships:
+            i = ship.state_index
+
+            flags = 0
+            if ship.image is ship.ship_pic_thrust:
+                flags |= BC_SHIP_THRUST
+            if ship.image is ship.ship_pic_shield:
+                flags |= BC_SHIP_SHIELD
+            if ship.landed:
+                flags |= BC_SHIP_LANDED
+
+            pose = (i, ship.xpos, ship.ypos, int(ship.angle) // SHIP_ANGLESTEP, flags, ship.lives)
+
+            if keyframe or self.ships_sent.get(i) != pose:
+                ships.append(BC_SHIP.pack(*pose))
+                self.ships_sent[i] = pose
+
+            # shots move in a straight line: a shot where one was expected is the same shot, anything else is new
+            expected = self.shot_ids.get(i, {})
+            shot_ids = {}
+
+            for shot in ship.shots:
+                key = (shot.xposprecise, shot.yposprecise, shot.dx, shot.dy)
+                shot_id = expected.pop(key, None)
+
+                if shot_id is None:
+                    shot_id = self.next_shot_id
+                    self.next_shot_id = (self.next_shot_id + 1) & 0xffff
+                    births.append(BC_BIRTH.pack(shot_id, i, *key))
+
+                # all the shots are sent again in a keyframe
+                elif keyframe:
+                    births.append(BC_BIRTH.pack(shot_id, i, *key))
+
+                shot_ids[(shot.xposprecise + shot.dx, shot.yposprecise + shot.dy, shot.dx, shot.dy)] = shot_id
+
+            # not there any more (the spectators drop all the shots on a keyframe)
+            if not keyframe:
+                deaths.extend(BC_DEATH.pack(shot_id) for shot_id in expected.values())
+
+            self.shot_ids[i] = shot_ids
+
+        body = b"".join(ships + births + deaths)
+        header = BC_FRAME.pack(env.frames, keyframe, len(ships), len(births), len(deaths))
+
+        return BC_LENGTH.pack(len(header) + len(body)) + header + body
+
+    def send(self, packet, keyframe):
+        if keyframe:
+            self.history.clear()
+        self.history.append(packet)
+
+        for writer, synced in self.spectators.items():
+
+            # backpressure: a spectator which does not read fast enough gets nothing until it has room for a keyframe
+            if writer.transport.get_write_buffer_size() > self.max_buffer:
+                if synced:
+                    self.nb_dropped += 1
+                self.spectators[writer] = False
+
+            elif synced or keyframe:
+                writer.write(packet)
+                self.spectators[writer] = True
+
+    async def shutdown(self):
+        self.server.close()
+        for writer in self.spectators:
+            writer.close()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result(NET_TIMEOUT)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+# -------------------------------------------------------------------------------------------------
+
+# draws a broadcast game: ships and shots are rebuilt from the BroadcastServer messages, the network runs in
+# an asyncio loop in a background thread and the display loop applies what has been received since the last frame
+class SpectatorClient():
+
+    def __init__(self, game, host=NET_HOST, port=BROADCAST_PORT):
+
+        self.game = game
+        self.hud = Hud()
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        self.connected = False
+        self.packets = deque(maxlen=BROADCAST_MAX_PENDING) # received, not applied yet (written by the network thread)
+
+        future = asyncio.run_coroutine_threadsafe(self.connect(host, port), self.loop)
+        future.result(NET_TIMEOUT)
+
+        print("Watching %s:%d" % (host, port))
+
+        # scene: display only ships (their state is what has been received, never simulated)
+        pics = ((SHIP_1_PIC, SHIP_1_PIC_THRUST, SHIP_1_PIC_SHIELD), (SHIP_2_PIC, SHIP_2_PIC_THRUST, SHIP_2_PIC_SHIELD), \
+                (SHIP_3_PIC, SHIP_3_PIC_THRUST, SHIP_3_PIC_SHIELD), (SHIP_4_PIC, SHIP_4_PIC_THRUST, SHIP_4_PIC_SHIELD))
+
+        self.ships = [ Ship("game", self.game.screen_width, self.game.screen_height, i+1, MAX_SHIPS, 0, 0, \
+                            pic, pic_thrust, pic_shield, None, None, 0, i) \
+                       for i, (pic, pic_thrust, pic_shield) in enumerate(pics) ]
+
+        for ship in self.ships:
+            ship.update_sprite()
+
+        self.shots = {}     # shot id => Shot
+        self.frame = None   # last applied frame, None = waiting for a keyframe
+        self.nb_ships = 0   # from the first keyframe
+        self.nb_gaps = 0
+
+        self.renderer = None
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+
+        self.connected = True
+        self.receiver = self.loop.create_task(self.receive())
+
+    async def receive(self):
+        try:
+            while True:
+                size, = BC_LENGTH.unpack(await self.reader.readexactly(BC_LENGTH.size))
+                self.packets.append(await self.reader.readexactly(size))
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print("Disconnected from the broadcast")
+            self.connected = False
+
+    def apply(self, data):
+        frame, keyframe, nb_ships, nb_births, nb_deaths = BC_FRAME.unpack_from(data)
+
+        # a delta is only valid on top of the previous frame: after a gap, wait for the next keyframe
+        if not keyframe and (self.frame is None or frame != self.frame + 1):
+            if self.frame is not None:
+                self.nb_gaps += 1
+                self.frame = None
+            return
+
+        self.frame = frame
+        offset = BC_FRAME.size
+
+        if keyframe:
+            self.nb_ships = max(self.nb_ships, nb_ships)
+            self.shots.clear()
+
+        # poses and flags
+        for i in range(nb_ships):
+            index, xpos, ypos, angle, flags, lives = BC_SHIP.unpack_from(data, offset)
+            offset += BC_SHIP.size
+
+            ship = self.ships[index]
+            ship.xpos = xpos
+            ship.ypos = ypos
+            ship.angle = angle * SHIP_ANGLESTEP
+            ship.landed = bool(flags & BC_SHIP_LANDED)
+            ship.lives = lives
+
+            if flags & BC_SHIP_SHIELD:
+                ship.image = ship.ship_pic_shield
+            elif flags & BC_SHIP_THRUST:
+                ship.image = ship.ship_pic_thrust
+            else:
+                ship.image = ship.ship_pic
+
+            ship.update_sprite()
+
+        # the known shots move as in Ship.move_shots, the new ones are already at this frame position
+        if not keyframe:
+            for shot in self.shots.values():
+                shot.xposprecise += shot.dx
+                shot.yposprecise += shot.dy
+                shot.x = int(shot.xposprecise)
+                shot.y = int(shot.yposprecise)
+
+        for i in range(nb_births):
+            shot_id, index, xposprecise, yposprecise, dx, dy = BC_BIRTH.unpack_from(data, offset)
+            offset += BC_BIRTH.size
+
+            shot = Shot()
+            shot.xposprecise = xposprecise
+            shot.yposprecise = yposprecise
+            shot.x = int(xposprecise)
+            shot.y = int(yposprecise)
+            shot.dx = dx
+            shot.dy = dy
+
+            self.shots[shot_id] = shot
+
+        for i in range(nb_deaths):
+            shot_id, = BC_DEATH.unpack_from(data, offset)
+            offset += BC_DEATH.size
+
+            self.shots.pop(shot_id, None)
+
+    def main_loop(self):
+        clock = pygame.time.Clock()
+
+        while self.connected or self.packets:
+
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
+                    self.close()
+                    return
+
+                elif event.type == pygame.VIDEOEXPOSE and self.renderer is not None:
+                    self.renderer.invalidate()
+
+            # everything received since the last display frame
+            while self.packets:
+                self.apply(self.packets.popleft())
+
+            # the number of views is known from the first keyframe
+            if self.renderer is None and self.nb_ships:
+                self.renderer = SplitScreenRenderer(self.game, self.ships[:self.nb_ships], dividers=True)
+
+            if self.renderer is not None:
+                self.draw()
+
+            clock.tick(MAX_FPS)
+
+        self.close()
+
+    def draw(self):
+        self.renderer.restore_map()
+
+        for shot in self.shots.values():
+            self.renderer.map_dirty_rects.append(pygame.draw.circle(self.game.map_buffer, WHITE, (shot.x, shot.y), 1))
+
+        for ship in self.renderer.ships:
+            self.renderer.map_dirty_rects.append(ship.draw(self.game.map_buffer))
+
+        self.renderer.draw_views()
+
+        if DEBUG_SCREEN:
+            for i, (ship, view_rect) in enumerate(zip(self.renderer.ships, self.renderer.view_rects)):
+                self.hud.draw(self.game.window, (i, 0), 'P%d Lives %d' % (i+1, ship.lives), (view_rect.left + DEBUG_TEXT_XPOS + 5, view_rect.top + 10))
+
+            view_rect = self.renderer.view_rects[0]
+            status = 'Frame %d' % self.frame if self.frame is not None else 'Waiting keyframe'
+
+            self.hud.draw(self.game.window, "frame", status, (view_rect.left + DEBUG_TEXT_XPOS + 5, view_rect.top + 10 + HUD_LINE_HEIGHT))
+            self.hud.draw(self.game.window, "gaps", 'Gaps %d' % self.nb_gaps, (view_rect.left + DEBUG_TEXT_XPOS + 5, view_rect.top + 10 + 2*HUD_LINE_HEIGHT))
+
+        self.renderer.present()
+
+    async def disconnect(self):
+        self.writer.close()
+
+        # cancel and wait for every task of the loop, a task still pending when the loop stops is destroyed pending
+        tasks = [ task for task in asyncio.all_tasks(self.loop) if task is not asyncio.current_task() ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.disconnect(), self.loop).result(NET_TIMEOUT)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+# -------------------------------------------------------------------------------------------------
+
+def run():
+    pygame.mixer.pre_init(frequency=22050)
+    pygame.init()
+    #pygame.display.init()
+
+    pygame.mouse.set_visible(False)
+    pygame.font.init()
+    pygame.mixer.init() # frequency=22050
+
+    #pygame.event.set_blocked((MOUSEMOTION, MOUSEBUTTONUP, MOUSEBUTTONDOWN))
+
+    # joystick
+    pygame.joystick.init()
+    joystick_count = pygame.joystick.get_count()
+    print("joystick_count", joystick_count)
+
+    for i in range(joystick_count):
+        j = pygame.joystick.Joystick(i)
+        j.init()
+
+    # options
+    parser = argparse.ArgumentParser()
 
     parser.add_argument('-width', '--width', help='', type=int, action="store", default=1200)
     parser.add_argument('-height', '--height', help='', type=int, action="store", default=800)
@@ -1556,23 +4810,106 @@ def run():
     parser.add_argument('-r', '--record_play', help='', action="store", default="")
     parser.add_argument('-pr', '--play_recorded', help='', action="store", default="")
     parser.add_argument('-s', '--sensor', help='', action="store", default="", choices=("ray", ""))
-    parser.add_argument('-rm', '--run_mode', help='', action="store", default="game", choices=("game", "training", ))
+    parser.add_argument('-rm', '--run_mode', help='', action="store", default="game", choices=("game", "training", "server", "benchmark", "spectator", "analytics"))
+
+    parser.add_argument('-ts', '--time_scale', help='Simulation speed: 1 = real time, N = N x real time, 0 = uncapped', type=float, action="store", default=TIME_SCALE)
+    parser.add_argument('-re', '--render_every', help='Display only 1 simulated frame out of N', type=int, action="store", default=RENDER_EVERY)
+    parser.add_argument('-dfps', '--display_fps', help='Max display refresh rate, 0 = no cap', type=int, action="store", default=DISPLAY_FPS)
+    parser.add_argument('-z', '--zoom', help='Player views scale, ie 0.5 = twice more of the level in each view', type=float, action="store", default=CAMERA_ZOOM)
+    parser.add_argument('-cf', '--camera_follow', help='Part of the distance to the ship closed per frame by the views, < 1 = smooth scrolling', type=float, action="store", default=CAMERA_FOLLOW)
+    parser.add_argument('-mm', '--minimap', help='Show the whole level with the ships', action="store_true")
+    parser.add_argument('-rs', '--render_scale', help='Render resolution scale, ie 0.5 = half resolution upscaled to the window', type=float, action="store", default=RENDER_SCALE)
+
+    parser.add_argument('-c', '--connect', help='Game inputs from a lockstep server (host:port) or "local" (all players on this machine), broadcast to watch (-rm=spectator)', action="store", default="")
+    parser.add_argument('-host', '--host', help='Lockstep server address (-rm=server)', action="store", default=NET_HOST)
+    parser.add_argument('-port', '--port', help='Lockstep server port (-rm=server)', type=int, action="store", default=NET_PORT)
+    parser.add_argument('-idl', '--input_delay', help='Lockstep input delay in frames', type=int, action="store", default=NET_INPUT_DELAY)
+    parser.add_argument('-bot', '--bot', help='Ship played by a genome file or "random", ie 2=gen_1068 (repeatable)', action="append", default=[])
+    parser.add_argument('-bc', '--broadcast', help='Stream the game to spectators on host:port', action="store", default="")
+    parser.add_argument('-tl', '--trajectory_log', help='Trajectory log directory to analyse (-rm=analytics, repeatable)', action="append", default=[])
+    parser.add_argument('-hm', '--heatmap', help='Heatmaps image (-rm=analytics)', action="store", default="heatmap.png")
+    parser.add_argument('-d', '--destructible', help='Shots carve the terrain (not with --rollback or --broadcast)', action="store_true")
+    parser.add_argument('-rb', '--rollback', help='Max frames played with predicted inputs (rollback), 0 = lockstep', type=int, action="store", default=0)
 
     result = parser.parse_args()
     args = dict(result._get_kwargs())
 
     print("Args", args)
 
+    # lockstep server: relays the players inputs, no game
+    if args["run_mode"] == "server":
+        LockstepServer(args["nb_player"], args["host"], args["port"], args["input_delay"]).run()
+        sys.exit(0)
+
+    # network / local session
+    session = None
+    if args["connect"] == "local":
+        session = LocalSession(args["nb_player"], args["input_delay"])
+    elif args["connect"] and args["run_mode"] != "spectator":
+        host, port = args["connect"].rsplit(":", 1)
+        session = LockstepClient(host, int(port))
+        args["nb_player"] = session.nb_players
+
     # window
     global game_window
-    game_window = GameWindow(args["width"], args["height"], args["run_mode"])
+    game_window = GameWindow(args["width"], args["height"], args["run_mode"], args["render_scale"])
 
     # game mode
     if args["run_mode"] == "game":
+
+        # the terrain is not part of the rolled back state
+        if args["destructible"] and args["rollback"]:
+            print("Destructible terrain is not available with rollback")
+            sys.exit(0)
+
+        # the craters are not streamed: the spectators would see the level as loaded
+        if args["destructible"] and args["broadcast"]:
+            print("Destructible terrain is not available with broadcast")
+            sys.exit(0)
+
+        broadcast = None
+        if args["broadcast"]:
+            host, port = args["broadcast"].rsplit(":", 1)
+            broadcast = BroadcastServer(host, int(port))
+
         env = MayhemEnv(game_window, True, args["nb_player"], mode=args["run_mode"], motion=args["motion"], \
-                        sensor=args["sensor"], record_play=args["record_play"], play_recorded=args["play_recorded"])
+                        sensor=args["sensor"], record_play=args["record_play"], play_recorded=args["play_recorded"], \
+                        time_scale=args["time_scale"], render_every=args["render_every"], display_fps=args["display_fps"], \
+                        session=session, rollback_frames=args["rollback"], broadcast=broadcast, destructible=args["destructible"], \
+                        zoom=args["zoom"], camera_follow=args["camera_follow"], minimap=args["minimap"])
+
+        # AI players (local ships only in a network game)
+        for bot in args["bot"]:
+            ship_number, name = bot.split("=", 1)
+            policy, obs_normalizer = load_bot_policy(name)
+            env.ships[int(ship_number)-1].bot = BotPlayer(env, policy, obs_normalizer)
+
         env.main_loop()
 
+    # watch a broadcast game, no simulation
+    elif args["run_mode"] == "spectator":
+        host, port = (args["connect"] or "%s:%d" % (NET_HOST, BROADCAST_PORT)).rsplit(":", 1)
+        SpectatorClient(game_window, host, int(port)).main_loop()
+
+    # headless simulation speed (rollback budget)
+    elif args["run_mode"] == "benchmark":
+        env = MayhemEnv(game_window, False, args["nb_player"], mode="game", motion=args["motion"])
+        env.benchmark(rollback_frames=args["rollback"] or ROLLBACK_FRAMES)
+
+    # deaths / landings / visits heatmaps of trajectory logs (-tl) and a recorded play (-pr)
+    elif args["run_mode"] == "analytics":
+        heatmaps = Heatmaps()
+
+        for path in args["trajectory_log"]:
+            heatmaps.add_trajectories(path)
+
+        if args["play_recorded"]:
+            env = MayhemEnv(game_window, False, 1, mode="training", motion=args["motion"], sensor="ray")
+            heatmaps.add_recorded(env, args["play_recorded"])
+
+        heatmaps.report()
+        heatmaps.save(game_window.map, args["heatmap"])
+
     # training mode
     else:
         USE_AI = 1
@@ -1582,12 +4919,17 @@ def run():
         NEAT_MAX_GEN      = 100 # stop if this number is reach (if not before per other criteria)
         NEAT_RUNS_PER_NET = 1   # useful if init position is random
         NEAT_MULTI        = 0   # multiprocess, if true no display
+        NEAT_START_STATES = ()  # ("positions", "recorded", "crashes"), see START_SOURCES
+        NEAT_SELFPLAY     = 0   # genomes per match (2 to 4, see SelfPlayEnv), 0 = single agent training
+        NEAT_NOVELTY      = ""  # "final_pos" / "path": novelty search (see NoveltyArchive), "" = episode reward only
+        NEAT_TRAJ_LOG     = ""  # directory: per step logs of 1 episode out of TRAJ_LOG_EVERY (see TrajectoryLogger), an existing log is continued
 
         if NEAT_MULTI:
             pygame.display.iconify()
 
         env = MayhemEnv(game_window, True, args["nb_player"], mode=args["run_mode"], motion=args["motion"], \
-                        sensor=args["sensor"], record_play=args["record_play"], play_recorded=args["play_recorded"])
+                        sensor=args["sensor"], record_play=args["record_play"], play_recorded=args["play_recorded"], \
+                        time_scale=args["time_scale"], render_every=args["render_every"], display_fps=args["display_fps"])
 
         # manual
         if not USE_AI:
@@ -1601,7 +4943,10 @@ def run():
                     print("Neat has not been found on the system")
                     sys.exit(0)
                 else:
-                    neat_training = NeatTraining(NEAT_RUNS_PER_NET, NEAT_MAX_GEN, NEAT_MULTI)
+                    neat_training = NeatTraining(NEAT_RUNS_PER_NET, NEAT_MAX_GEN, NEAT_MULTI, \
+                                                 render_every=args["render_every"], display_fps=args["display_fps"], \
+                                                 start_sources=NEAT_START_STATES, start_recorded=[args["play_recorded"]] if args["play_recorded"] else [], \
+                                                 selfplay=NEAT_SELFPLAY, novelty=NEAT_NOVELTY, trajectory_log=NEAT_TRAJ_LOG)
 
                     if NEAT_LOAD_WINNER:
                         #neat_training.load_net(net_name="gen2_1068.048876452548_22h31m52s")